@@ -0,0 +1,108 @@
+"""
+Download benchmark: the original handle_dl (read the whole file, then sendall) against the sendfile() path.
+
+For every (path, size) pair a fresh server process serves one download over loopback, so its peak RSS (VmHWM) is
+the cost of that single transfer. The client discards the bytes instead of writing them to disk.
+
+Usage: python bench_dl.py [size in MB ...]      (default: 1 100 2048)
+"""
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+TASK_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(TASK_DIR / "server"))
+sys.path.insert(0, str(TASK_DIR / "client"))
+
+from server import Server  # noqa: E402
+from client import Client  # noqa: E402
+
+
+class ReadAllDlServer(Server):
+    """handle_dl as it was before sendfile: the whole file in memory, then one sendall."""
+
+    def handle_dl(self, current_working_directory, file_name, service_socket, eof_token) -> None:
+        with open(os.path.join(current_working_directory, os.path.basename(file_name)), 'rb') as f:
+            file_data = f.read()
+        self.send_size_header(service_socket, len(file_data), eof_token)
+        service_socket.sendall(file_data)
+
+
+PATHS = {"read+sendall": ReadAllDlServer, "sendfile": Server}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(server_class, port, root) -> None:
+    os.chdir(root)
+    # The server prints every command (and the readiness probe's reset); keep the benchmark output readable
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    server_class("127.0.0.1", port).start()
+
+
+def peak_rss_mb(pid) -> float:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def run_one(server_class, root, file_name) -> tuple[float, float, float]:
+    """Returns (seconds, server peak RSS before the download, server peak RSS after) in MB."""
+    port = free_port()
+    process = multiprocessing.Process(target=serve, args=(server_class, port, root), daemon=True)
+    process.start()
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        client = Client("127.0.0.1", port)
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try:
+            client_socket, eof_token = client.initialize("127.0.0.1", port)
+            rss_before = peak_rss_mb(process.pid)
+            start = time.perf_counter()
+            client._send_request(f"dl {file_name}", client_socket, eof_token)
+            size = client._receive_size_header(client_socket, eof_token)
+            client._recv_to_file(client_socket, None, size)
+            elapsed = time.perf_counter() - start
+            client._receive_reply(client_socket, eof_token)
+            client_socket.close()
+        finally:
+            sys.stdout = stdout
+        return elapsed, rss_before, peak_rss_mb(process.pid)
+    finally:
+        process.terminate()
+        process.join()
+
+
+def main(sizes_mb) -> None:
+    with tempfile.TemporaryDirectory() as root:
+        print(f"{'size':>8} {'path':>14} {'MB/s':>9} {'peak RSS':>10} {'RSS growth':>11}")
+        for size_mb in sizes_mb:
+            file_name = f"bench_{size_mb}MB.bin"
+            with open(os.path.join(root, file_name), "wb") as f:
+                block = os.urandom(1024 * 1024)
+                for _ in range(size_mb):
+                    f.write(block)
+            for label, server_class in PATHS.items():
+                elapsed, rss_before, rss_after = run_one(server_class, root, file_name)
+                print(f"{size_mb:>6}MB {label:>14} {size_mb / elapsed:>9.1f} {rss_after:>8.1f}MB "
+                      f"{rss_after - rss_before:>9.1f}MB")
+            os.remove(os.path.join(root, file_name))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1, 100, 2048])
@@ -0,0 +1,284 @@
+"""
+Load benchmark: starts a local server on loopback and drives concurrent clients, each in its own process, through a
+scripted mix of commands on synthetic files for a fixed time. Reports throughput and p50/p95/p99 latency per
+command and samples the server's CPU use and RSS (its analytics processes included) while the load runs.
+
+Each engine gets a fresh server in an empty directory, with the command delay off. Every client works in a
+directory of its own on the server: it uploads the synthetic files there, then loops over the mix (see MIXES).
+Results, including the server's own stats reply and the CPU/RSS samples, go to a JSON file for comparing engines,
+mixes and releases.
+
+Usage: python bench_load.py [--engine thread event] [--clients 8] [--seconds 30] [--mix mixed]
+                            [--text-kb 512] [--binary-kb 4096] [--features fast v2] [--output bench_load.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+TASK_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(TASK_DIR / "server"))
+sys.path.insert(0, str(TASK_DIR / "client"))
+
+from server import EventLoopServer, Server  # noqa: E402
+from client import Client, ServerError  # noqa: E402
+
+# Relative weight of each command in a mix. "cd" enters a directory made by mkdir and leaves it again
+MIXES = {
+    "mixed": {"mkdir": 1, "cd": 1, "ul": 2, "dl": 4, "wordcount": 3, "wordsort": 1, "search": 3, "split": 1},
+    "transfer": {"ul": 1, "dl": 3},
+    "analytics": {"wordcount": 3, "wordsort": 1, "search": 3, "split": 1},
+    "metadata": {"mkdir": 1, "cd": 2},
+}
+# Server CPU and RSS are sampled this often
+SAMPLE_SECONDS = 0.5
+# Words the synthetic text files are made of; search looks for some of them
+VOCABULARY_SIZE = 20000
+SEARCH_WORDS = "the,and,zebra"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(port, root, engine) -> None:
+    os.chdir(root)
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    server = EventLoopServer("127.0.0.1", port) if engine == "event" else Server("127.0.0.1", port)
+    server.command_delay = 0
+    server.start()
+
+
+def make_files(directory, text_kb, binary_kb) -> None:
+    """Writes the synthetic files every client uploads: text.txt (words) and binary.bin (random bytes)."""
+    vocabulary = ["".join(random.choices("abcdefghijklmnopqrstuvwxyz", k=random.randint(2, 9)))
+                  for _ in range(VOCABULARY_SIZE)] + ["The", "and,", "Zebra."]
+    with open(os.path.join(directory, "text.txt"), "w") as f:
+        while f.tell() < text_kb * 1024:
+            f.write(" ".join(random.choices(vocabulary, k=1000)) + "\n")
+    with open(os.path.join(directory, "binary.bin"), "wb") as f:
+        f.write(os.urandom(binary_kb * 1024))
+
+
+def process_times(pid) -> tuple[float, int]:
+    """CPU seconds and RSS bytes of process pid and its children, from /proc."""
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu, rss = 0.0, 0
+    pids = [pid]
+    for entry in os.listdir("/proc"):
+        if entry.isdigit() and entry != str(pid):
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    for child in pids:
+        try:
+            with open(f"/proc/{child}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            with open(f"/proc/{child}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+        except (OSError, IndexError, ValueError):
+            continue
+    return cpu, rss
+
+
+def sample_server(pid, stop, samples) -> None:
+    """Appends {"t", "cpu_percent", "rss_mb"} to samples every SAMPLE_SECONDS until stop is set."""
+    start = last_time = time.perf_counter()
+    last_cpu, _ = process_times(pid)
+    while not stop.wait(SAMPLE_SECONDS):
+        cpu, rss = process_times(pid)
+        now = time.perf_counter()
+        samples.append({
+            "t": round(now - start, 2), "cpu_percent": round(100 * (cpu - last_cpu) / (now - last_time), 1),
+            "rss_mb": round(rss / 2 ** 20, 1)
+        })
+        last_cpu, last_time = cpu, now
+
+
+def run_client(index, port, local_dir, mix, seconds, features, start_at, results) -> None:
+    """
+    One simulated client: uploads the synthetic files into a directory of its own, then issues commands picked from
+    mix until seconds have passed since start_at. Puts (command, latency seconds, ok, bytes moved) tuples on results.
+    """
+    sys.stdout = open(os.devnull, "w")
+    rng = random.Random(index)
+    download_dir = tempfile.mkdtemp(prefix=f"client{index}-")
+    client = Client("127.0.0.1", port, features=features)
+    client_socket, eof_token = client.initialize("127.0.0.1", port)
+    records = []
+    sizes = {name: os.path.getsize(os.path.join(local_dir, name)) for name in ("text.txt", "binary.bin")}
+    directories = 0
+
+    def timed(command, function, command_and_arg, moved=0):
+        start = time.perf_counter()
+        ok = True
+        try:
+            function(command_and_arg, client_socket, eof_token)
+        except ServerError:
+            ok = False
+        records.append((command, time.perf_counter() - start, ok, moved))
+
+    os.chdir(local_dir)
+    client.issue_mkdir(f"mkdir client{index}", client_socket, eof_token)
+    client.issue_cd(f"cd client{index}", client_socket, eof_token)
+    for name in sizes:
+        client.issue_ul(f"ul {name}", client_socket, eof_token)
+    while time.time() < start_at:
+        time.sleep(0.01)
+    commands, weights = zip(*mix.items())
+    while time.time() < start_at + seconds:
+        command = rng.choices(commands, weights)[0]
+        if command == "mkdir":
+            directories += 1
+            timed(command, client.issue_mkdir, f"mkdir d{directories}")
+        elif command == "cd":
+            if not directories:
+                continue
+            timed(command, client.issue_cd, f"cd d{rng.randint(1, directories)}")
+            timed(command, client.issue_cd, "cd ..")
+        elif command == "ul":
+            name = rng.choice(list(sizes))
+            timed(command, client.issue_ul, f"ul {name}", sizes[name])
+        elif command == "dl":
+            name = rng.choice(list(sizes))
+            os.chdir(download_dir)
+            timed(command, client.issue_dl, f"dl {name}", sizes[name])
+            os.chdir(local_dir)
+        elif command == "search":
+            timed(command, client.issue_search, f"search text.txt {SEARCH_WORDS}")
+        elif command == "split":
+            timed(command, client.issue_split, "split text.txt the,zebra")
+        else:
+            timed(command, getattr(client, f"issue_{command}"), f"{command} text.txt")
+    server_stats = client.issue_stats("stats", client_socket, eof_token) if index == 0 else None
+    client.issue_exit("exit", client_socket, eof_token)
+    results.put((index, records, server_stats))
+
+
+def percentile(sorted_values, fraction) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))]
+
+
+def summarize(records, seconds) -> dict:
+    """Per-command and overall throughput, latency percentiles (milliseconds), errors and MB/s."""
+    by_command = {}
+    for command, latency, ok, moved in records:
+        by_command.setdefault(command, []).append((latency, ok, moved))
+    summary = {}
+    for command, runs in sorted(by_command.items()):
+        latencies = sorted(latency for latency, _, _ in runs)
+        summary[command] = {
+            "count": len(runs), "errors": sum(not ok for _, ok, _ in runs),
+            "ops_per_second": round(len(runs) / seconds, 2),
+            "mb_per_second": round(sum(moved for _, _, moved in runs) / 2 ** 20 / seconds, 2),
+            "p50_ms": round(1000 * percentile(latencies, 0.50), 3),
+            "p95_ms": round(1000 * percentile(latencies, 0.95), 3),
+            "p99_ms": round(1000 * percentile(latencies, 0.99), 3),
+        }
+    return summary
+
+
+def run(engine, args, local_dir) -> dict:
+    """One load run against a fresh server with the given engine."""
+    with tempfile.TemporaryDirectory() as server_dir:
+        port = free_port()
+        server = multiprocessing.Process(target=serve, args=(port, server_dir, engine))
+        server.start()
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        results = multiprocessing.Queue()
+        # Every client uploads its files first; the measured time starts together for all of them
+        start_at = time.time() + 2 + 0.2 * args.clients
+        clients = [
+            multiprocessing.Process(target=run_client, args=(
+                index, port, local_dir, MIXES[args.mix], args.seconds, args.features, start_at, results
+            ))
+            for index in range(args.clients)
+        ]
+        samples = []
+        stop = threading.Event()
+        sampler = threading.Thread(target=sample_server, args=(server.pid, stop, samples))
+        try:
+            for client in clients:
+                client.start()
+            while time.time() < start_at:
+                time.sleep(0.01)
+            sampler.start()
+            outcomes = [results.get() for _ in clients]
+        finally:
+            stop.set()
+            if sampler.is_alive():
+                sampler.join()
+            for client in clients:
+                client.join(timeout=10)
+            server.terminate()
+            server.join()
+    records = [record for _, client_records, _ in outcomes for record in client_records]
+    server_stats = next(stats for index, _, stats in outcomes if index == 0)
+    return {
+        "engine": engine, "total_ops_per_second": round(len(records) / args.seconds, 2),
+        "commands": summarize(records, args.seconds), "server_samples": samples, "server_stats": server_stats,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--engine", nargs="+", default=["thread", "event"], choices=["thread", "event"])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--mix", default="mixed", choices=sorted(MIXES))
+    parser.add_argument("--text-kb", type=int, default=512)
+    parser.add_argument("--binary-kb", type=int, default=4096)
+    parser.add_argument("--features", nargs="*", default=["fast", "v2"])
+    parser.add_argument("--output", default="bench_load.json")
+    args = parser.parse_args()
+
+    report = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "host": platform.node(), "cpus": os.cpu_count(),
+        "python": platform.python_version(), "clients": args.clients, "seconds": args.seconds, "mix": args.mix,
+        "text_kb": args.text_kb, "binary_kb": args.binary_kb, "features": args.features, "runs": [],
+    }
+    with tempfile.TemporaryDirectory() as local_dir:
+        make_files(local_dir, args.text_kb, args.binary_kb)
+        for engine in args.engine:
+            result = run(engine, args, local_dir)
+            report["runs"].append(result)
+            samples = result["server_samples"] or [{"cpu_percent": 0.0, "rss_mb": 0.0}]
+            print(f"{engine} engine, {args.clients} clients, {args.mix} mix: "
+                  f"{result['total_ops_per_second']:.1f} commands/s, server CPU "
+                  f"{sum(s['cpu_percent'] for s in samples) / len(samples):.0f}% mean, RSS "
+                  f"{max(s['rss_mb'] for s in samples):.0f} MB peak")
+            print(f"{'command':>10} {'count':>7} {'errors':>6} {'ops/s':>8} {'MB/s':>8} "
+                  f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+            for command, row in result["commands"].items():
+                print(f"{command:>10} {row['count']:>7} {row['errors']:>6} {row['ops_per_second']:>8.1f} "
+                      f"{row['mb_per_second']:>8.1f} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} "
+                      f"{row['p99_ms']:>8.2f}")
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
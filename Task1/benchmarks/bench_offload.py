@@ -0,0 +1,149 @@
+"""
+Analytics offload benchmark: ul/dl throughput of one client while 8 other clients run wordsort back to back.
+
+Each mode gets a fresh server with the word statistics cache disabled, so every wordsort tokenizes and sorts the
+file again, as it would for 8 different files. "in-thread" computes analytics in the connection's thread (the
+server holds the GIL while it tokenizes); "process pool" sends them to the analytics process pool (see
+Server.run_analytics()).
+
+Usage: python bench_offload.py [transfer size in MB] [wordsort file size in MB] [wordsort clients]
+       (default: 64 4 8)
+"""
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+TASK_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(TASK_DIR / "server"))
+sys.path.insert(0, str(TASK_DIR / "client"))
+
+from server import ANALYTICS_PROCESSES, Server  # noqa: E402
+from client import Client  # noqa: E402
+
+MODES = {"in-thread": 0, "process pool": ANALYTICS_PROCESSES}
+# Transfers timed per measurement; the mean is reported
+ROUNDS = 3
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(port, root, processes) -> None:
+    os.chdir(root)
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    server = Server("127.0.0.1", port)
+    server.command_delay = 0
+    server.token_cache.budget = 0
+    server.analytics_processes = processes
+    server.start()
+
+
+def connect(port) -> tuple[Client, socket.socket, str]:
+    client = Client("127.0.0.1", port, features=["fast"])
+    client_socket, eof_token = client.initialize("127.0.0.1", port)
+    return client, client_socket, eof_token
+
+
+def run_wordsorts(port, local_dir, stop, done) -> None:
+    """Runs wordsort on words.txt until stop is set, counting completed commands in done."""
+    sys.stdout = open(os.devnull, "w")
+    # These clients stand in for other machines: keep their own CPU use from slowing the server on a small host
+    os.nice(19)
+    os.chdir(local_dir)
+    client, client_socket, eof_token = connect(port)
+    while not stop.is_set():
+        client.issue_wordsort("wordsort words.txt", client_socket, eof_token)
+        with done.get_lock():
+            done.value += 1
+    client_socket.close()
+
+
+def measure(port, local_dir, size_mb) -> tuple[float, float]:
+    """Returns the mean (ul MB/s, dl MB/s) over ROUNDS transfers of a size_mb file."""
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    cwd = os.getcwd()
+    os.chdir(local_dir)
+    try:
+        client, client_socket, eof_token = connect(port)
+        ul_elapsed = dl_elapsed = 0.0
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            client.issue_ul("ul bench.bin", client_socket, eof_token)
+            ul_elapsed += time.perf_counter() - start
+            start = time.perf_counter()
+            client._send_request("dl bench.bin", client_socket, eof_token)
+            size = client._receive_size_header(client_socket, eof_token)
+            client._recv_to_file(client_socket, None, size)
+            client._receive_reply(client_socket, eof_token)
+            dl_elapsed += time.perf_counter() - start
+        client_socket.close()
+        return ROUNDS * size_mb / ul_elapsed, ROUNDS * size_mb / dl_elapsed
+    finally:
+        os.chdir(cwd)
+        sys.stdout = stdout
+
+
+def main(size_mb, text_mb, clients) -> None:
+    with tempfile.TemporaryDirectory() as root:
+        server_dir = os.path.join(root, "server")
+        local_dir = os.path.join(root, "client")
+        os.mkdir(server_dir)
+        os.mkdir(local_dir)
+        with open(os.path.join(local_dir, "bench.bin"), "wb") as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(size_mb):
+                f.write(block)
+        vocabulary = ["".join(random.choices("abcdefghijklmnopqrstuvwxyz", k=random.randint(3, 10)))
+                      for _ in range(200000)]
+        with open(os.path.join(server_dir, "words.txt"), "w") as f:
+            while f.tell() < text_mb * 1024 * 1024:
+                f.write(" ".join(random.choices(vocabulary, k=10000)) + "\n")
+
+        print(f"{size_mb} MB ul/dl, {clients} clients running wordsort on a {text_mb} MB file, "
+              f"{os.cpu_count()} CPUs")
+        print(f"{'mode':>13} {'idle ul':>9} {'idle dl':>9} {'busy ul':>9} {'busy dl':>9} {'wordsorts/s':>12}")
+        for label, processes in MODES.items():
+            port = free_port()
+            process = multiprocessing.Process(target=serve, args=(port, server_dir, processes))
+            process.start()
+            for _ in range(100):
+                try:
+                    socket.create_connection(("127.0.0.1", port)).close()
+                    break
+                except ConnectionRefusedError:
+                    time.sleep(0.05)
+            try:
+                idle_ul, idle_dl = measure(port, local_dir, size_mb)
+                stop = multiprocessing.Event()
+                done = multiprocessing.Value("i", 0)
+                loaders = [
+                    multiprocessing.Process(target=run_wordsorts, args=(port, local_dir, stop, done), daemon=True)
+                    for _ in range(clients)
+                ]
+                start = time.perf_counter()
+                for loader in loaders:
+                    loader.start()
+                # Let the wordsorts (and the process pool) get going
+                time.sleep(2)
+                busy_ul, busy_dl = measure(port, local_dir, size_mb)
+                rate = done.value / (time.perf_counter() - start)
+                stop.set()
+                for loader in loaders:
+                    loader.join()
+                print(f"{label:>13} {idle_ul:>9.1f} {idle_dl:>9.1f} {busy_ul:>9.1f} {busy_dl:>9.1f} {rate:>12.1f}")
+            finally:
+                process.terminate()
+                process.join()
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [64, 4, 8][len(args):]))
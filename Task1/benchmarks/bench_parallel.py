@@ -0,0 +1,99 @@
+"""
+Parallel analytics benchmark: wordcount, search and wordsort on one large text file with 1, 2, 4 and 8 analytics
+processes (one byte range per process, see Server._parallel_ranges()).
+
+Each worker count gets a fresh server with the word statistics cache disabled, so every command reads the whole
+file. The replies are compared against the 1-process run, which takes the serial path.
+
+Usage: python bench_parallel.py [file size in MB]      (default: 128)
+"""
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+TASK_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(TASK_DIR / "server"))
+sys.path.insert(0, str(TASK_DIR / "client"))
+
+from server import Server  # noqa: E402
+from client import Client  # noqa: E402
+
+WORKER_COUNTS = (1, 2, 4, 8)
+COMMANDS = ("wordcount words.txt", "search words.txt the,and,zebra", "wordsort words.txt")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(port, root, processes) -> None:
+    os.chdir(root)
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    server = Server("127.0.0.1", port)
+    server.command_delay = 0
+    server.token_cache.budget = 0
+    server.analytics_processes = processes
+    server.start()
+
+
+def run_commands(port) -> list[tuple[float, object]]:
+    """Returns (seconds, reply) of each command in COMMANDS."""
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        client = Client("127.0.0.1", port, features=["fast"])
+        client_socket, eof_token = client.initialize("127.0.0.1", port)
+        issue = {
+            "wordcount": client.issue_wordcount, "search": client.issue_search, "wordsort": client.issue_wordsort
+        }
+        results = []
+        for command in COMMANDS:
+            start = time.perf_counter()
+            reply = issue[command.split()[0]](command, client_socket, eof_token)
+            results.append((time.perf_counter() - start, reply))
+        client_socket.close()
+        return results
+    finally:
+        sys.stdout = stdout
+
+
+def main(size_mb) -> None:
+    with tempfile.TemporaryDirectory() as root:
+        vocabulary = ["".join(random.choices("abcdefghijklmnopqrstuvwxyz", k=random.randint(2, 9)))
+                      for _ in range(100000)] + ["The", "and,", "Zebra."]
+        with open(os.path.join(root, "words.txt"), "w") as f:
+            while f.tell() < size_mb * 1024 * 1024:
+                f.write(" ".join(random.choices(vocabulary, k=10000)) + "\n")
+
+        print(f"{size_mb} MB text file, {os.cpu_count()} CPUs; seconds per command")
+        print(f"{'workers':>8} " + " ".join(f"{command.split()[0]:>10}" for command in COMMANDS) + "  same result")
+        expected = None
+        for workers in WORKER_COUNTS:
+            port = free_port()
+            process = multiprocessing.Process(target=serve, args=(port, root, workers))
+            process.start()
+            for _ in range(100):
+                try:
+                    socket.create_connection(("127.0.0.1", port)).close()
+                    break
+                except ConnectionRefusedError:
+                    time.sleep(0.05)
+            try:
+                results = run_commands(port)
+            finally:
+                process.terminate()
+                process.join()
+            replies = [reply for _, reply in results]
+            expected = expected or replies
+            print(f"{workers:>8} " + " ".join(f"{elapsed:>10.2f}" for elapsed, _ in results)
+                  + f"  {replies == expected}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 128)
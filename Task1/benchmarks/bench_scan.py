@@ -0,0 +1,100 @@
+"""
+Word statistics benchmark: time and peak memory of counting the words of one text file (what wordcount and search
+need) with the original handlers' read() of the whole file, with text-mode chunks, and with the mmap bytes-level
+scan_frequencies().
+
+Every implementation runs in a fresh process, so its peak RSS (VmHWM) is the cost of that one count. The mapped
+file's pages count towards RSS while they are mapped, which scan_windows() limits to one window.
+
+Usage: python bench_scan.py [size in MB] [implementation ...]      (default: 1024 text mmap)
+       implementations: read text mmap
+"""
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+TASK_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(TASK_DIR / "server"))
+
+from server import WORD_PUNCTUATION, scan_frequencies  # noqa: E402
+
+
+def read_frequencies(path) -> dict[str, int]:
+    """As the original handlers did it: decode the whole file, lowercase it, split it."""
+    frequencies = {}
+    with open(path, 'r') as f:
+        for word in f.read().lower().split():
+            word = word.strip(WORD_PUNCTUATION)
+            frequencies[word] = frequencies.get(word, 0) + 1
+    return frequencies
+
+
+def text_frequencies(path) -> dict[str, int]:
+    """Text mode, 1M characters at a time, each word decoded and lowercased as str."""
+    frequencies = {}
+    carry = ""
+    with open(path, 'r') as f:
+        while chunk := f.read(1024 * 1024):
+            text = carry + chunk.lower()
+            words = text.split()
+            carry = words.pop() if words and not text[-1].isspace() else ""
+            for word in words:
+                word = word.strip(WORD_PUNCTUATION)
+                frequencies[word] = frequencies.get(word, 0) + 1
+    if carry:
+        word = carry.strip(WORD_PUNCTUATION)
+        frequencies[word] = frequencies.get(word, 0) + 1
+    return frequencies
+
+
+def mmap_frequencies(path) -> dict[str, int]:
+    with open(path, 'rb') as f:
+        return scan_frequencies(f)
+
+
+IMPLEMENTATIONS = {"read": read_frequencies, "text": text_frequencies, "mmap": mmap_frequencies}
+
+
+def peak_rss_mb() -> float:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def run_one(name, path, results) -> None:
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    frequencies = IMPLEMENTATIONS[name](path)
+    elapsed = time.perf_counter() - start
+    results.put((elapsed, rss_before, peak_rss_mb(), len(frequencies), sum(frequencies.values())))
+
+
+def main(size_mb, names) -> None:
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "words.txt")
+        vocabulary = ["".join(random.choices("abcdefghijklmnopqrstuvwxyzABC", k=random.randint(2, 9)))
+                      for _ in range(100000)] + ["café,", "naïve.", "Straße"]
+        with open(path, "w") as f:
+            while f.tell() < size_mb * 1024 * 1024:
+                f.write(" ".join(random.choices(vocabulary, k=10000)) + "\n")
+
+        print(f"{size_mb} MB text file")
+        print(f"{'implementation':>15} {'seconds':>8} {'peak RSS':>10} {'RSS growth':>11} {'distinct':>9} {'words':>11}")
+        for name in names:
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_one, args=(name, path, results))
+            process.start()
+            elapsed, rss_before, rss_after, distinct, words = results.get()
+            process.join()
+            print(f"{name:>15} {elapsed:>8.1f} {rss_after:>8.1f}MB {rss_after - rss_before:>9.1f}MB "
+                  f"{distinct:>9} {words:>11}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1024, sys.argv[2:] or ["text", "mmap"])
@@ -0,0 +1,178 @@
+"""
+Striped transfer benchmark: dl/ul throughput against the number of stripes (parallel sessions).
+
+Loopback has neither latency nor a congestion window, so every connection goes through an in-process proxy that
+delays each chunk by a fixed one-way latency and lets at most WINDOW bytes be in flight per direction. A single
+session is then capped at roughly WINDOW / latency, the way one TCP flow is on a long fat link.
+
+Usage: python bench_stripes.py [size in MB] [one-way latency in ms] [window in KB]      (default: 64 20 256)
+"""
+import heapq
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+from threading import Condition, Thread
+
+TASK_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(TASK_DIR / "server"))
+sys.path.insert(0, str(TASK_DIR / "client"))
+
+from server import Server  # noqa: E402
+from client import Client  # noqa: E402
+
+STRIPE_COUNTS = (1, 2, 4, 8)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(port, root) -> None:
+    os.chdir(root)
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    Server("127.0.0.1", port).start()
+
+
+class DelayedPipe:
+    """One direction of a proxied connection: chunks are released `latency` seconds after they were read, and no
+    more than `window` bytes are held at once."""
+
+    def __init__(self, source, destination, latency, window):
+        self.source = source
+        self.destination = destination
+        self.latency = latency
+        self.window = window
+        self.in_flight = 0
+        self.queue = []
+        self.sequence = 0
+        self.closed = False
+        self.condition = Condition()
+        Thread(target=self._read, daemon=True).start()
+        Thread(target=self._write, daemon=True).start()
+
+    def _read(self) -> None:
+        while True:
+            with self.condition:
+                while self.in_flight >= self.window:
+                    self.condition.wait()
+                room = self.window - self.in_flight
+            try:
+                chunk = self.source.recv(min(room, 65536))
+            except OSError:
+                chunk = b""
+            with self.condition:
+                if not chunk:
+                    self.closed = True
+                    self.condition.notify_all()
+                    return
+                self.in_flight += len(chunk)
+                heapq.heappush(self.queue, (time.monotonic() + self.latency, self.sequence, chunk))
+                self.sequence += 1
+                self.condition.notify_all()
+
+    def _write(self) -> None:
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue:
+                    break
+                due, _, chunk = self.queue[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.queue)
+            try:
+                self.destination.sendall(chunk)
+            except OSError:
+                break
+            with self.condition:
+                self.in_flight -= len(chunk)
+                self.condition.notify_all()
+        try:
+            self.destination.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+def run_proxy(listener, server_port, latency, window) -> None:
+    while True:
+        client_side, _ = listener.accept()
+        server_side = socket.create_connection(("127.0.0.1", server_port))
+        for s in (client_side, server_side):
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        DelayedPipe(client_side, server_side, latency, window)
+        DelayedPipe(server_side, client_side, latency, window)
+
+
+def transfer(port, stripes, file_name, local_dir) -> tuple[float, float]:
+    """Returns (ul seconds, dl seconds) for one file with the given stripe count."""
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    cwd = os.getcwd()
+    os.chdir(local_dir)
+    try:
+        client = Client("127.0.0.1", port)
+        client.initialize("127.0.0.1", port)
+        # Open the extra sessions before timing, as a long-running client would already have them
+        client._stripe_sessions(stripes)
+        start = time.perf_counter()
+        client.striped_ul(file_name, stripes)
+        ul_elapsed = time.perf_counter() - start
+        os.remove(file_name)
+        start = time.perf_counter()
+        client.striped_dl(file_name, stripes)
+        dl_elapsed = time.perf_counter() - start
+        client._drop_stripe_sessions()
+        client.client_socket.close()
+        return ul_elapsed, dl_elapsed
+    finally:
+        os.chdir(cwd)
+        sys.stdout = stdout
+
+
+def main(size_mb, latency_ms, window_kb) -> None:
+    with tempfile.TemporaryDirectory() as root:
+        server_dir = os.path.join(root, "server")
+        local_dir = os.path.join(root, "client")
+        os.mkdir(server_dir)
+        os.mkdir(local_dir)
+        server_port = free_port()
+        process = multiprocessing.Process(target=serve, args=(server_port, server_dir), daemon=True)
+        process.start()
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", server_port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        listener = socket.create_server(("127.0.0.1", 0))
+        Thread(target=run_proxy, args=(listener, server_port, latency_ms / 1000, window_kb * 1024),
+               daemon=True).start()
+        port = listener.getsockname()[1]
+        try:
+            print(f"{size_mb} MB file, {latency_ms} ms one-way latency, {window_kb} KB window per connection")
+            print(f"{'stripes':>8} {'ul MB/s':>9} {'dl MB/s':>9}")
+            for stripes in STRIPE_COUNTS:
+                file_name = f"bench_{stripes}.bin"
+                with open(os.path.join(local_dir, file_name), "wb") as f:
+                    block = os.urandom(1024 * 1024)
+                    for _ in range(size_mb):
+                        f.write(block)
+                ul_elapsed, dl_elapsed = transfer(port, stripes, file_name, local_dir)
+                print(f"{stripes:>8} {size_mb / ul_elapsed:>9.1f} {size_mb / dl_elapsed:>9.1f}")
+                os.remove(os.path.join(local_dir, file_name))
+        finally:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [64, 20, 256][len(args):]))
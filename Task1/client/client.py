@@ -1,45 +1,379 @@
 import socket
 import os
+import struct
+import bz2
+import hashlib
+import io
+import lzma
+import mmap
+import tarfile
+import zlib
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# v2 framing: every frame starts with a fixed header (opcode, flags, payload length) followed by the raw payload.
+# Same definitions as in server.py
+FRAME_HEADER = struct.Struct("!BBQ")
+OP_COMMAND = 1  # client command text
+OP_DATA = 2  # file contents: the header carries the size, the raw bytes follow
+OP_REPLY = 3  # result or listing text
+OP_ERROR = 4  # the command failed; payload is the error text
+# Frame flags
+FLAG_COMPRESSED = 0x01  # payload compressed with the session's codec (see CODECS)
+
+# Compression, negotiated by offering a codec name with "hello" (v2 framing only). A compressed reply is one codec
+# stream. Compressed file data is an OP_DATA header with FLAG_COMPRESSED and the uncompressed size, followed by
+# blocks of BLOCK_HEADER (stored length, raw length) and the stored bytes. Each block holds up to
+# TRANSFER_CHUNK_SIZE raw bytes compressed on their own, or stored as is when stored length == raw length.
+# Same definitions as in server.py
+BLOCK_HEADER = struct.Struct("!II")
+# codec name -> (compress(data, level), decompressor factory, default level)
+CODECS = {
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompressobj, 6),
+    "bz2": (lambda data, level: bz2.compress(data, level), bz2.BZ2Decompressor, 9),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.LZMADecompressor, 6),
+}
+# Files smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 4096
+# Files are sent compressed only if their first COMPRESS_SAMPLE_SIZE bytes shrink to COMPRESS_MAX_RATIO or less,
+# which keeps already compressed formats (jpg, mp3, pdf, ...) on the raw sendfile() path
+COMPRESS_SAMPLE_SIZE = 64 * 1024
+COMPRESS_MAX_RATIO = 0.9
+
+# Delta uploads (uldelta): the server describes its copy of the file with one DELTA_SIGNATURE per block (adler32,
+# 16-byte BLAKE2b) and the client answers with DELTA_OP records (op, a, b). Same definitions as in server.py
+DELTA_SIGNATURE = struct.Struct("!I16s")
+DELTA_OP = struct.Struct("!BQQ")
+DELTA_COPY = 1  # a: first block of the server's copy, b: number of consecutive blocks
+DELTA_LITERAL = 2  # a: number of literal bytes that follow the record (at most TRANSFER_CHUNK_SIZE)
+DELTA_END = 3  # a: size of the new file; its SHA-256 (32 bytes) follows the record
+# Modulus of adler32, whose sums block_matches() rolls
+ADLER_MOD = 65521
+# Longest unmatched run that block_matches() searches byte by byte (in Python); beyond it only whole-block steps are
+# tried until a block matches again, so a rewritten file costs about as much as a plain ul
+DELTA_ROLL_LIMIT = 1024 * 1024
+
+# Size of the reusable buffer that moves file data between the socket and disk
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+# Striped transfers never split a file into stripes smaller than this
+STRIPE_MIN_SIZE = 1024 * 1024
+# Start of the server's busy replies (same definition as in server.py)
+BUSY_MESSAGE = "Server busy"
+
+
+def compress_block(codec, data, level=None) -> bytes:
+    compress, _, default_level = CODECS[codec]
+    return compress(data, default_level if level is None else level)
+
+
+def decompress_block(codec, data, raw_len=None) -> bytes:
+    """Decompresses one block (or a whole reply when raw_len is None), never producing more than raw_len bytes. A
+    block must hold exactly raw_len bytes: one that would inflate to more is refused, not cut short."""
+    decompressor = CODECS[codec][1]()
+    if raw_len is None:
+        return decompressor.decompress(data)
+    raw = decompressor.decompress(data, raw_len)
+    if len(raw) != raw_len:
+        raise ValueError(f"Compressed block holds {len(raw)} bytes instead of {raw_len}")
+    if not decompressor.eof or decompressor.unused_data:
+        raise ValueError(f"Compressed block holds more than {raw_len} bytes")
+    return raw
+
+
+class ServerError(Exception):
+    """Raised when the server reports that a command failed (fast mode only)."""
+
+
+class ServerBusy(ServerError):
+    """Raised when the server refused a command or the connection because of load; it may be retried later."""
+
+
+def server_error(message) -> ServerError:
+    """The exception for an error reply: ServerBusy for busy replies (see BUSY_MESSAGE), ServerError otherwise."""
+    return (ServerBusy if message.startswith(BUSY_MESSAGE) else ServerError)(message)
+
+
+class ChunkReader:
+    """Read-only file object over the chunks of a data stream, for tarfile.open(mode="r|") or read_exact() (same
+    definition as in server.py)."""
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._chunk = b""
+        self._offset = 0
+
+    def read(self, size=-1) -> bytes:
+        if self._offset == len(self._chunk):
+            self._chunk, self._offset = next(self._chunks, b""), 0
+        end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + size)
+        data = bytes(self._chunk[self._offset:end])
+        self._offset = end
+        return data
+
+    def read_exact(self, size) -> bytes:
+        """Reads exactly size bytes, across chunks; ValueError if the stream ends first."""
+        data = self.read(size)
+        while len(data) < size:
+            more = self.read(size - len(data))
+            if not more:
+                raise ValueError("Data stream ended early")
+            data += more
+        return data
+
+
+class ChunkWriter:
+    """Write-only file object for tarfile.open(mode="w") that collects what it is given into chunks of
+    TRANSFER_CHUNK_SIZE bytes for send(chunk); flush() sends the rest (same definition as in server.py)."""
+    def __init__(self, send):
+        self._send = send
+        self._buffer = bytearray()
+        self.sent = 0
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= TRANSFER_CHUNK_SIZE:
+            self._send(self._buffer[:TRANSFER_CHUNK_SIZE])
+            del self._buffer[:TRANSFER_CHUNK_SIZE]
+            self.sent += TRANSFER_CHUNK_SIZE
+        return len(data)
+
+    def tell(self) -> int:
+        return self.sent + len(self._buffer)
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._send(self._buffer)
+            self.sent += len(self._buffer)
+            self._buffer = bytearray()
+
+
+def tree_path(root, name) -> str:
+    """Path of the archive member name below root; absolute names and '..' are refused with ValueError."""
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if name.startswith("/") or ".." in parts:
+        raise ValueError(f"Invalid path in archive: {name!r}")
+    return os.path.join(root, *parts)
+
+
+def tree_entries(root, relative=""):
+    """Yields (DirEntry, archive name) for the directories and regular files below root, depth first in name order,
+    each directory before its contents. Symbolic links are left out."""
+    with os.scandir(os.path.join(root, relative)) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        name = f"{relative}/{entry.name}" if relative else entry.name
+        if entry.is_dir(follow_symlinks=False):
+            yield entry, name
+            yield from tree_entries(root, name)
+        elif entry.is_file(follow_symlinks=False):
+            yield entry, name
+
+
+def block_matches(data, block_size, signatures, basis_size):
+    """
+    Finds the blocks of the server's copy in data, rsync style: at each position the adler32 of the next block_size
+    bytes is looked up among the server's weak sums, and on a hit its BLAKE2b confirms the match; otherwise the
+    window moves on by one byte, rolling the adler32 instead of computing it again. After DELTA_ROLL_LIMIT bytes
+    without a match the window moves on a whole block at a time instead, in step with the last match, which still
+    finds blocks that were changed in place. The server's last block may be short and can only match the end of
+    data.
+    :param data: the new file's bytes (a bytes-like object or mmap)
+    :param block_size: block size of the server's signatures
+    :param signatures: the server's (weak, strong) sums, in block order
+    :param basis_size: size of the server's copy
+    :return: yields (position in data, block index), in data order and without overlaps
+    """
+    weak_sums = set()
+    blocks = {}
+    for index, (weak, strong) in enumerate(signatures):
+        weak_sums.add(weak)
+        blocks.setdefault(strong, index)
+    last_block_size = basis_size - (len(signatures) - 1) * block_size if signatures else 0
+    size = len(data)
+    # Last position where a whole block starts
+    end = size - block_size
+    # Start of the current unmatched run
+    pos = run_start = 0
+    weak = None
+    while pos <= end and weak_sums:
+        if weak is None:
+            weak = zlib.adler32(data[pos:pos + block_size])
+        if weak in weak_sums:
+            index = blocks.get(hashlib.blake2b(data[pos:pos + block_size], digest_size=16).digest())
+            if index is not None and (index + 1) * block_size <= basis_size:
+                yield pos, index
+                pos += block_size
+                run_start = pos
+                weak = None
+                continue
+        if pos - run_start >= DELTA_ROLL_LIMIT:
+            pos += block_size - (pos - run_start) % block_size
+            weak = None
+            continue
+        # No match: roll the window forward until its weak sum is one of the server's
+        a, b = weak & 0xffff, weak >> 16
+        limit = min(end, run_start + DELTA_ROLL_LIMIT)
+        while pos < limit:
+            out, new = data[pos], data[pos + block_size]
+            a = (a - out + new) % ADLER_MOD
+            b = (b - block_size * out + a - 1) % ADLER_MOD
+            pos += 1
+            if (b << 16 | a) in weak_sums:
+                break
+        else:
+            if pos == end:
+                break
+        weak = b << 16 | a
+    if 0 < last_block_size < block_size and size - last_block_size >= pos:
+        tail = data[size - last_block_size:]
+        if zlib.adler32(tail) in weak_sums and blocks.get(
+            hashlib.blake2b(tail, digest_size=16).digest()
+        ) == len(signatures) - 1:
+            yield size - last_block_size, len(signatures) - 1
+
+
+def delta_instructions(data, block_size, signatures, basis_size):
+    """
+    The delta of data against the server's copy (see block_matches()): runs of consecutive matched blocks become
+    one copy, everything in between is literal.
+    :return: yields ("copy", first block, blocks) and ("literal", start, end) in file order
+    """
+    literal_start = copy_first = copy_count = 0
+    for pos, index in block_matches(data, block_size, signatures, basis_size):
+        if pos == literal_start and copy_count and copy_first + copy_count == index:
+            copy_count += 1
+        else:
+            if copy_count:
+                yield "copy", copy_first, copy_count
+            if literal_start < pos:
+                yield "literal", literal_start, pos
+            copy_first, copy_count = index, 1
+        literal_start = pos + min(block_size, basis_size - index * block_size)
+    if copy_count:
+        yield "copy", copy_first, copy_count
+    if literal_start < len(data):
+        yield "literal", literal_start, len(data)
+
 
 class Client:
-    def __init__(self, host, port):
+    # Protocol features offered to the server at handshake
+    FEATURES = ("fast", "v2", "range", "stripe", "dedup", "tree", "delta")
+
+    def __init__(self, host, port, features=FEATURES):
         self.host = host
         self.port = port
         self.client_socket = None
         self.eof_token = None
+        self.features = features
+        # Fast mode: no per-command pause, status-prefixed replies, listing only when the directory changed
+        self.fast = False
+        # "token" (frames end with eof_token) or "v2" (length-prefixed frames, see FRAME_HEADER)
+        self.framing = "token"
+        # Bytes received after the last complete frame, and how many of them were already searched for the token
+        self._recv_buffer = bytearray()
+        self._scanned = 0
+        # Features accepted by the server
+        self.server_features = set()
+        # Server-side working directory (from the last listing), restored after a reconnect
+        self.server_cwd = None
+        # Reconnect attempts before a resumable ul/dl gives up
+        self.max_retries = 5
+        # Number of parallel sessions used for each ul/dl (1 = no striping)
+        self.stripes = int(os.getenv("CLIENT_STRIPES", "1"))
+        # Extra sessions kept open for striped transfers
+        self._stripe_clients = []
+        # Codec offered at handshake (CLIENT_COMPRESSION=zlib|bz2|lzma) and the level used for uploads
+        # (CLIENT_COMPRESSION_LEVEL, default: the codec's default)
+        self.compression = os.getenv("CLIENT_COMPRESSION") or None
+        level = os.getenv("CLIENT_COMPRESSION_LEVEL")
+        self.compression_level = int(level) if level else None
+        # SHA-256 of local files already hashed for ulhash: (path, size, mtime_ns, inode) -> hex digest
+        self._digests = {}
+        # Codec accepted by the server, and whether the data frame being received is compressed
+        self.codec = None
+        self._data_compressed = False
 
     def _recv_exact(self, active_socket: socket.socket, n: int) -> bytearray:
-        """Receive exactly n bytes from the socket, or raise if connection closes early."""
-        data = bytearray()
+        """Receive exactly n bytes, starting with any bytes already buffered, or raise if connection closes early."""
+        data = bytearray(self._recv_buffer[:n])
+        del self._recv_buffer[:n]
         while len(data) < n:
-            packet = active_socket.recv(n - len(data))
+            try:
+                packet = active_socket.recv(n - len(data))
+            except socket.timeout:
+                # The socket keeps the timeout of _read_token_frame(); a slow reply is still on its way
+                continue
             if not packet:
                 raise ConnectionError("Socket closed before receiving expected bytes")
             data.extend(packet)
         return data
 
-    def _read_frame_with_remainder(self, active_socket: socket.socket, buffer_size: int, eof_token) -> tuple[bytearray, bytearray]:
-        """Read until the first occurrence of eof_token is found. Return (payload, remainder after token)."""
-        if isinstance(eof_token, (bytes, bytearray, memoryview)):
-            token_bytes = bytes(eof_token)
-        else:
-            token_bytes = str(eof_token).encode('utf-8')
-        buf = bytearray()
-        token_len = len(token_bytes)
-        active_socket.settimeout(10.0)
-        while True:
+    def _recv_to_file(self, active_socket: socket.socket, file, n: int) -> None:
+        """
+        Receive exactly n raw bytes into an open binary file (or discard them when file is None) through one reusable
+        buffer, so memory use does not depend on n. A compressed data frame is decompressed one block at a time.
+        """
+        if self._data_compressed:
+            for raw in self._inflate_blocks(active_socket, n):
+                if file is not None:
+                    file.write(raw)
+            return
+        head = self._recv_buffer[:n]
+        del self._recv_buffer[:n]
+        if file is not None:
+            file.write(head)
+        n -= len(head)
+        buffer = memoryview(bytearray(min(TRANSFER_CHUNK_SIZE, n)))
+        while n > 0:
+            try:
+                received = active_socket.recv_into(buffer, min(len(buffer), n))
+            except socket.timeout:
+                continue
+            if not received:
+                raise ConnectionError("Socket closed before receiving expected bytes")
+            if file is not None:
+                file.write(buffer[:received])
+            n -= received
+
+    def _recv_at(self, active_socket: socket.socket, fd: int, offset: int, n: int) -> None:
+        """Receive exactly n raw bytes and pwrite() them to fd starting at offset, through one reusable buffer."""
+        if self._data_compressed:
+            for raw in self._inflate_blocks(active_socket, n):
+                written = 0
+                while written < len(raw):
+                    written += os.pwrite(fd, raw[written:], offset + written)
+                offset += len(raw)
+            return
+        head = self._recv_buffer[:n]
+        del self._recv_buffer[:n]
+        if head:
+            os.pwrite(fd, head, offset)
+        offset += len(head)
+        n -= len(head)
+        buffer = memoryview(bytearray(min(TRANSFER_CHUNK_SIZE, n)))
+        while n > 0:
             try:
-                chunk = active_socket.recv(buffer_size)
-                if not chunk:
-                    return buf, bytearray()
-                buf.extend(chunk)
-                idx = buf.find(token_bytes)
-                if idx != -1:
-                    payload = buf[:idx]
-                    remainder = buf[idx + token_len:]
-                    return payload, remainder
+                received = active_socket.recv_into(buffer, min(len(buffer), n))
             except socket.timeout:
                 continue
+            if not received:
+                raise ConnectionError("Socket closed before receiving expected bytes")
+            written = 0
+            while written < received:
+                written += os.pwrite(fd, buffer[written:received], offset + written)
+            offset += received
+            n -= received
+
+    def _inflate_blocks(self, active_socket: socket.socket, n: int):
+        """Yields the decompressed bytes of a compressed data frame holding n bytes, block by block."""
+        self._data_compressed = False
+        while n > 0:
+            stored_len, raw_len = BLOCK_HEADER.unpack(self._recv_exact(active_socket, BLOCK_HEADER.size))
+            if not 0 < raw_len <= min(TRANSFER_CHUNK_SIZE, n):
+                raise ConnectionError(f"Invalid compressed block of {raw_len} bytes")
+            stored = self._recv_exact(active_socket, stored_len)
+            yield stored if stored_len == raw_len else decompress_block(self.codec, bytes(stored), raw_len)
+            n -= raw_len
 
     def receive_message_ending_with_token(
         self, active_socket, buffer_size, eof_token
@@ -48,37 +382,729 @@ class Client:
         Same implementation as in receive_message_ending_with_token() in server.py
         A helper method to receives a bytearray message of arbitrary size sent on the socket.
         This method returns the message WITHOUT the eof_token at the end of the last packet.
+        Bytes received after the token (e.g. the next pipelined reply) are kept for the next call.
         :param active_socket: a socket object that is connected to the server
         :param buffer_size: the buffer size of each recv() call
         :param eof_token: a token that denotes the end of the message.
         :return: a bytearray message with the eof_token stripped from the end.
         """
+        message = self._read_token_frame(active_socket, buffer_size, eof_token)
+        if message is None:
+            # Connection closed by the server: return whatever arrived
+            message = bytearray(self._recv_buffer)
+            self._recv_buffer.clear()
+            self._scanned = 0
+        return message
+        # raise NotImplementedError("Your implementation here.")
+
+    def _read_token_frame(self, active_socket, buffer_size, eof_token):
+        """Returns the next token-terminated frame without the token, or None if the connection closed first."""
         # Normalize token to bytes once
         token_bytes = eof_token if isinstance(eof_token, (bytes, bytearray)) else eof_token.encode('utf-8')
         token_len = len(token_bytes)
-        data = bytearray()
+        data = self._recv_buffer
         active_socket.settimeout(10.0)
         while True:
+            # Only search bytes not searched before (plus an overlap for a token split across recv() calls)
+            idx = data.find(token_bytes, max(0, self._scanned - token_len + 1))
+            if idx != -1:
+                message = data[:idx]
+                del data[:idx + token_len]
+                self._scanned = 0
+                return message
+            self._scanned = len(data)
             try:
                 packet = active_socket.recv(buffer_size)
                 if not packet:
-                    break  # Connection closed by the server
+                    return None  # Connection closed by the server
                 data.extend(packet)
-                # Only stop when buffer definitively ends with token
-                if len(data) >= token_len and data.endswith(token_bytes):
-                    data = data[:-token_len]
-                    break
             except socket.timeout:
                 # Continue waiting; otherwise return partial binary payloads on timeout
                 continue
-        return data
-        # raise NotImplementedError("Your implementation here.")
+
+    def _receive_reply(self, client_socket, eof_token) -> str:
+        """
+        Receives one reply frame as text. With v2 framing the opcode tells results from errors; in fast mode with
+        token framing every frame starts with a status character: '+' for a result and '-' for an error. Errors are
+        raised as ServerError.
+        """
+        if self.framing == "v2":
+            opcode, payload = self._receive_frame(client_socket)
+            if opcode == OP_ERROR:
+                raise server_error(payload.decode('utf-8'))
+            return payload.decode('utf-8')
+        reply = self._read_token_frame(client_socket, 1024, eof_token)
+        if reply is None:
+            raise ConnectionError("Socket closed before receiving a complete reply")
+        reply = reply.decode('utf-8')
+        if not self.fast:
+            return reply
+        if reply.startswith("-"):
+            raise server_error(reply[1:])
+        return reply[1:]
+
+    def _receive_header(self, client_socket) -> tuple[int, int, int]:
+        """Receives one v2 frame header: returns (opcode, flags, payload length)."""
+        return FRAME_HEADER.unpack(self._recv_exact(client_socket, FRAME_HEADER.size))
+
+    def _receive_frame(self, client_socket) -> tuple[int, bytearray]:
+        """Receives one complete v2 frame: returns (opcode, payload), decompressing the payload if needed."""
+        opcode, flags, length = self._receive_header(client_socket)
+        payload = self._recv_exact(client_socket, length)
+        if flags & FLAG_COMPRESSED:
+            payload = bytearray(decompress_block(self.codec, bytes(payload)))
+        return opcode, payload
+
+    def _send_command(self, command_and_arg, client_socket, eof_token) -> None:
+        if self.framing == "v2":
+            payload = command_and_arg.encode('utf-8')
+            client_socket.sendall(FRAME_HEADER.pack(OP_COMMAND, 0, len(payload)) + payload)
+        else:
+            client_socket.sendall((command_and_arg + eof_token).encode('utf-8'))
+
+    def _send_request(self, command_and_arg, client_socket, eof_token) -> None:
+        """Sends a command and, for ul, the size header and file contents that follow it (for uldir, the tar stream of
+        the directory)."""
+        command = command_and_arg.split(" ", 1)[0]
+        if command == "uldir":
+            self._send_tree(command_and_arg, client_socket, eof_token)
+            return
+        if command != "ul":
+            self._send_command(command_and_arg, client_socket, eof_token)
+            return
+        file_path = command_and_arg.split(" ", 1)[1].strip()
+        with open(file_path, 'rb') as file:
+            file_size = os.fstat(file.fileno()).st_size
+            print(f"[UL] Sending command and size: name={file_path}, size={file_size}")
+            self._send_command(command_and_arg, client_socket, eof_token)
+            self._send_file(client_socket, file, 0, file_size, eof_token)
+
+    def _send_file(self, client_socket, file, offset, count, eof_token) -> None:
+        """Sends the size header for count bytes, then streams them from the open file starting at offset."""
+        if self._compresses(file, offset, count):
+            self._send_compressed(client_socket, file, offset, count)
+            return
+        # Length header (token-terminated text, or an OP_DATA header), then raw bytes
+        if self.framing == "v2":
+            client_socket.sendall(FRAME_HEADER.pack(OP_DATA, 0, count))
+        else:
+            client_socket.sendall((str(count) + eof_token).encode('utf-8'))
+        if count > 0:
+            client_socket.sendfile(file, offset, count)
+
+    def _compresses(self, file, offset, count) -> bool:
+        """Whether count bytes of file from offset are worth sending compressed: the server accepted a codec and a
+        sample from the start of the range shrinks enough."""
+        if not self.codec or count < COMPRESS_MIN_SIZE:
+            return False
+        sample = os.pread(file.fileno(), min(COMPRESS_SAMPLE_SIZE, count), offset)
+        return len(compress_block(self.codec, sample, self.compression_level)) <= len(sample) * COMPRESS_MAX_RATIO
+
+    def _send_compressed(self, client_socket, file, offset, count) -> None:
+        """Sends a compressed OP_DATA frame for count bytes of file from offset, one block at a time."""
+        client_socket.sendall(FRAME_HEADER.pack(OP_DATA, FLAG_COMPRESSED, count))
+        end = offset + count
+        while offset < end:
+            raw = os.pread(file.fileno(), min(TRANSFER_CHUNK_SIZE, end - offset), offset)
+            if not raw:
+                raise ValueError(f"File changed during upload: {end - offset} bytes missing")
+            stored = compress_block(self.codec, raw, self.compression_level)
+            if len(stored) >= len(raw):
+                stored = raw
+            client_socket.sendall(BLOCK_HEADER.pack(len(stored), len(raw)) + stored)
+            offset += len(raw)
+
+    def _send_chunk(self, client_socket, data, eof_token) -> None:
+        """Sends one chunk of a data stream (uldir, at most TRANSFER_CHUNK_SIZE bytes): as a single compressed block
+        if the server accepted a codec and the block is smaller, otherwise the size header and the raw bytes. An
+        empty chunk ends the stream."""
+        if self.codec and len(data) >= COMPRESS_MIN_SIZE:
+            stored = compress_block(self.codec, data, self.compression_level)
+            if len(stored) < len(data):
+                client_socket.sendall(
+                    FRAME_HEADER.pack(OP_DATA, FLAG_COMPRESSED, len(data)) + BLOCK_HEADER.pack(len(stored), len(data))
+                    + stored
+                )
+                return
+        if self.framing == "v2":
+            client_socket.sendall(FRAME_HEADER.pack(OP_DATA, 0, len(data)))
+        else:
+            client_socket.sendall((str(len(data)) + eof_token).encode('utf-8'))
+        if data:
+            client_socket.sendall(data)
+
+    def _send_tree(self, command_and_arg, client_socket, eof_token) -> None:
+        """
+        Sends uldir and then the local directory it names as a tar stream, packed while it is sent: directories and
+        regular files only. A file that changes size while it is read leaves the server waiting for bytes that never
+        come, so the connection is dropped (and ConnectionError raised) instead.
+        """
+        local_dir = command_and_arg.split(" ", 1)[1].strip()
+        if not os.path.isdir(local_dir):
+            raise NotADirectoryError(f"{local_dir} is not a directory")
+        self._send_command(command_and_arg, client_socket, eof_token)
+        writer = ChunkWriter(lambda chunk: self._send_chunk(client_socket, chunk, eof_token))
+        try:
+            with tarfile.open(fileobj=writer, mode="w", format=tarfile.GNU_FORMAT,
+                              copybufsize=TRANSFER_CHUNK_SIZE) as tar:
+                for entry, name in tree_entries(local_dir):
+                    info = tarfile.TarInfo(name)
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                        f = None if entry.is_dir(follow_symlinks=False) else open(entry.path, 'rb')
+                    except OSError as e:
+                        print(f"[ULDIR] Skipping {name}: {e}")
+                        continue
+                    info.mtime = stat.st_mtime
+                    info.mode = stat.st_mode & 0o7777
+                    if f is None:
+                        info.type = tarfile.DIRTYPE
+                        tar.addfile(info)
+                        continue
+                    with f:
+                        info.size = os.fstat(f.fileno()).st_size
+                        tar.addfile(info, f)
+            writer.flush()
+            self._send_chunk(client_socket, b"", eof_token)
+        except OSError as e:
+            client_socket.close()
+            raise ConnectionError(f"Upload of {local_dir} interrupted: {e}") from e
+
+    def _receive_chunks(self, client_socket, eof_token):
+        """Yields the bytes of a data stream (dldir) chunk by chunk until the empty chunk that ends it."""
+        while size := self._receive_size_header(client_socket, eof_token):
+            if self._data_compressed:
+                yield from self._inflate_blocks(client_socket, size)
+                continue
+            while size > 0:
+                chunk = io.BytesIO()
+                self._recv_to_file(client_socket, chunk, min(size, TRANSFER_CHUNK_SIZE))
+                size -= min(size, TRANSFER_CHUNK_SIZE)
+                yield chunk.getvalue()
+
+    def _receive_tree(self, command_and_arg, client_socket, eof_token) -> tuple[int, int]:
+        """
+        Receives the tar stream of a dldir reply and unpacks it as it arrives into the directory of the same name in
+        the local working directory, then the server's "<files> <bytes>", which also tells whether the stream was
+        complete.
+        """
+        root = os.path.basename(command_and_arg.split(" ", 1)[1].strip().rstrip("/"))
+        chunks = self._receive_chunks(client_socket, eof_token)
+        error = None
+        try:
+            with tarfile.open(fileobj=ChunkReader(chunks), mode="r|") as tar:
+                os.makedirs(root, exist_ok=True)
+                # Directories known to exist, so that each is only created once
+                directories = {root}
+                for member in tar:
+                    path = tree_path(root, member.name)
+                    directory = path if member.isdir() else os.path.dirname(path)
+                    if directory not in directories:
+                        os.makedirs(directory, exist_ok=True)
+                        directories.add(directory)
+                    if member.isfile():
+                        source = tar.extractfile(member)
+                        with open(path, 'wb') as f:
+                            while data := source.read(TRANSFER_CHUNK_SIZE):
+                                f.write(data)
+        except ConnectionError:
+            raise
+        except (tarfile.TarError, OSError, ValueError) as e:
+            # Still consume the rest of the stream; the server's reply tells whether it was cut short
+            error = e
+        for _ in chunks:
+            pass
+        files, size = map(int, self._receive_reply(client_socket, eof_token).split())
+        if error is not None:
+            raise error
+        print(f"[DLDIR] {files} files, {size} bytes downloaded to: {root}")
+        return files, size
+
+    def _receive_size_header(self, client_socket, eof_token) -> int:
+        """Receives the size announced before the bytes of a download. If they arrive compressed, the next
+        _recv_to_file()/_recv_at() decompresses them."""
+        if self.framing == "v2":
+            opcode, flags, length = self._receive_header(client_socket)
+            if opcode == OP_DATA:
+                self._data_compressed = bool(flags & FLAG_COMPRESSED)
+                return length
+            payload = self._recv_exact(client_socket, length)
+            if flags & FLAG_COMPRESSED:
+                payload = decompress_block(self.codec, bytes(payload))
+            payload = payload.decode('utf-8')
+            if opcode == OP_ERROR:
+                raise server_error(payload)
+            raise ConnectionError(f"Expected a data frame, got opcode {opcode}")
+        return int(self._receive_reply(client_socket, eof_token).strip())
+
+    def _receive_response(self, command_and_arg, client_socket, eof_token):
+        """
+        Receives everything the server sends back for one command: the command's result (if any) and then the
+        directory listing. In fast mode the listing is empty when the directory did not change.
+        :return: (result, listing). The result is the downloaded file name for dl, (files, bytes) for uldir/dldir, the
+        parsed value for wordcount/wordsort/search/gsearch/split/stats, the goodbye message for exit and None
+        otherwise.
+        """
+        command = command_and_arg.split(" ", 1)[0]
+        result = None
+        # Every command but exit ends with the listing, even after an error reply
+        listing_due = command != "exit"
+        try:
+            if command == "exit":
+                return self._receive_reply(client_socket, eof_token), ""
+            if command == "dl":
+                result = self._receive_download(command_and_arg, client_socket, eof_token)
+            elif command == "dldir":
+                result = self._receive_tree(command_and_arg, client_socket, eof_token)
+            elif command == "uldir":
+                files, size = self._receive_reply(client_socket, eof_token).split()
+                result = int(files), int(size)
+            elif command == "wordcount":
+                result = int(self._receive_reply(client_socket, eof_token))
+            elif command == "wordsort":
+                result = self._receive_reply(client_socket, eof_token).splitlines()
+            elif command == "search":
+                result = self._parse_search(self._receive_reply(client_socket, eof_token))
+            elif command == "gsearch":
+                result = self._parse_gsearch(self._receive_reply(client_socket, eof_token))
+            elif command == "stats":
+                result = self._parse_stats(self._receive_reply(client_socket, eof_token))
+            elif command == "split":
+                result = int(self._receive_reply(client_socket, eof_token))
+            else:
+                # No result of its own: this frame is the listing, unless it is an error reply that precedes it
+                listing = self._receive_reply(client_socket, eof_token)
+                listing_due = False
+                self._note_listing(listing)
+        finally:
+            if listing_due:
+                listing = self._receive_reply(client_socket, eof_token)
+                self._note_listing(listing)
+        return result, listing
+
+    def _parse_search(self, reply) -> dict:
+        """
+        Parses a search reply. A single file gives {word: count}; a glob pattern gives
+        {"files": {file: {word: count}}, "total": {word: count}}.
+        """
+        sections = []
+        counts = result = {}
+        for line in reply.splitlines():
+            if line.startswith("== "):
+                counts = {}
+                sections.append((line[3:], counts))
+            elif ': ' in line:
+                word, count = line.split(': ', 1)
+                counts[word] = int(count)
+        if not sections:
+            return result
+        # The server sends the totals last
+        return {"files": dict(sections[:-1]), "total": sections[-1][1]}
+
+    def _parse_gsearch(self, reply) -> dict[str, dict[str, int]]:
+        """Parses a gsearch reply into {word: {path: count}}, files in the server's order (most matches first)."""
+        result = {}
+        files = {}
+        for line in reply.splitlines():
+            if line.startswith("== "):
+                files = result[line[3:]] = {}
+            elif ': ' in line:
+                path, count = line.rsplit(': ', 1)
+                files[path] = int(count)
+        return result
+
+    def _parse_stats(self, reply) -> dict[str, float]:
+        """Parses a stats reply (Prometheus text format) into {metric name with labels: value}."""
+        result = {}
+        for line in reply.splitlines():
+            if line and not line.startswith("#"):
+                name, _, value = line.rpartition(" ")
+                result[name] = float(value)
+        return result
+
+    def _receive_download(self, command_and_arg, client_socket, eof_token) -> str:
+        """Receives the size header and file bytes of a dl reply and writes the file locally."""
+        # First, receive the size header; any coalesced file bytes stay buffered
+        expected_len = self._receive_size_header(client_socket, eof_token)
+        # Then, stream exactly expected_len raw bytes to disk
+        file_name = command_and_arg.split(" ", 1)[1].strip()
+        try:
+            file = open(file_name, 'wb')
+        except Exception as e:
+            print(f"Error saving downloaded file: {e}")
+            # Still consume the bytes so the next reply is read correctly
+            self._recv_to_file(client_socket, None, expected_len)
+            return file_name
+        with file:
+            self._recv_to_file(client_socket, file, expected_len)
+        print(f"File downloaded successfully to: {file_name}")
+        return file_name
+
+    def _note_listing(self, listing) -> None:
+        """Remembers the server-side working directory from a "Current Directory: <path>:" listing."""
+        prefix = "Current Directory: "
+        if listing.startswith(prefix) and ":\n" in listing:
+            self.server_cwd = listing[len(prefix):listing.index(":\n")]
+
+    def _reconnect(self) -> None:
+        """Opens a new session after a dropped connection and changes back to the previous server directory."""
+        try:
+            self.client_socket.close()
+        except OSError:
+            pass
+        server_cwd = self.server_cwd
+        self.client_socket, self.eof_token = self.initialize(self.host, self.port)
+        if server_cwd and server_cwd != self.server_cwd:
+            # cd with an absolute path goes straight there
+            self._send_request(f"cd {server_cwd}", self.client_socket, self.eof_token)
+            self._receive_response(f"cd {server_cwd}", self.client_socket, self.eof_token)
+
+    def _retrying(self, action):
+        """
+        Runs action(); if the connection drops, reconnects and runs it again (with backoff), up to self.max_retries
+        times. The resumable transfers pass actions that continue from the bytes that already arrived. A busy reply
+        is retried the same way, on the same connection.
+        """
+        reconnect = False
+        for attempt in range(self.max_retries + 1):
+            try:
+                if attempt:
+                    time.sleep(min(2 ** (attempt - 1), 10))
+                    if reconnect:
+                        self._reconnect()
+                return action()
+            except ConnectionError as e:
+                if attempt == self.max_retries:
+                    raise
+                reconnect = True
+                print(f"Connection lost ({e}); reconnecting to resume")
+            except ServerBusy as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"{e}; retrying")
+
+    def _resumable_ul(self, file_path) -> None:
+        """
+        Uploads with ulstat/ulat so that a dropped connection resumes from the bytes the server already holds. Both
+        name the file's SHA-256, so only an interrupted upload of these same contents is resumed from.
+        """
+        digest = self._file_digest(file_path)
+        with open(file_path, 'rb') as file:
+            total_size = os.fstat(file.fileno()).st_size
+
+            def attempt():
+                self._send_command(f"ulstat {digest} {file_path}", self.client_socket, self.eof_token)
+                try:
+                    offset = int(self._receive_reply(self.client_socket, self.eof_token))
+                finally:
+                    self._note_listing(self._receive_reply(self.client_socket, self.eof_token))
+                if offset > total_size:
+                    offset = 0
+                if offset:
+                    print(f"[UL] Resuming {file_path} at byte {offset} of {total_size}")
+                self._send_command(
+                    f"ulat {offset} {total_size} {digest} {file_path}", self.client_socket, self.eof_token
+                )
+                self._send_file(self.client_socket, file, offset, total_size - offset, self.eof_token)
+                try:
+                    self._receive_reply(self.client_socket, self.eof_token)
+                finally:
+                    listing = self._receive_reply(self.client_socket, self.eof_token)
+                    self._note_listing(listing)
+                return listing
+
+            self._print_listing(self._retrying(attempt))
+
+    def _resumable_dl(self, file_name) -> None:
+        """
+        Downloads with dlrange into '<file_name>.dl-part' so that a dropped connection resumes from the bytes already
+        written. If the server's copy changed between attempts (size or mtime), the download starts over.
+        """
+        part_path = file_name + ".dl-part"
+        version = None
+
+        def request(offset, length):
+            """Sends dlrange and returns (file version, number of bytes that follow)."""
+            self._send_command(f"dlrange {offset} {length} {file_name}", self.client_socket, self.eof_token)
+            try:
+                size, mtime_ns = self._receive_reply(self.client_socket, self.eof_token).split()
+                return (int(size), int(mtime_ns)), self._receive_size_header(self.client_socket, self.eof_token)
+            except ServerError:
+                self._note_listing(self._receive_reply(self.client_socket, self.eof_token))
+                raise
+
+        def attempt():
+            nonlocal version
+            offset = 0
+            if version is not None and os.path.exists(part_path):
+                offset = os.path.getsize(part_path)
+            current, count = request(offset, -1)
+            with open(part_path, 'r+b' if offset else 'wb') as file:
+                if current != version and offset:
+                    # The file changed on the server since the bytes we hold were sent: start over
+                    self._recv_to_file(self.client_socket, None, count)
+                    self._note_listing(self._receive_reply(self.client_socket, self.eof_token))
+                    print(f"[DL] {file_name} changed on the server; restarting")
+                    offset = 0
+                    file.truncate(0)
+                    current, count = request(0, -1)
+                version = current
+                file.seek(offset)
+                if offset:
+                    print(f"[DL] Resuming {file_name} at byte {offset} of {current[0]}")
+                self._recv_to_file(self.client_socket, file, count)
+            listing = self._receive_reply(self.client_socket, self.eof_token)
+            self._note_listing(listing)
+            return listing
+
+        try:
+            listing = self._retrying(attempt)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        os.replace(part_path, file_name)
+        print(f"File downloaded successfully to: {file_name}")
+        self._print_listing(listing)
+
+    def _stripe_sessions(self, count) -> list:
+        """Returns count extra sessions to the same server, each in the same server directory as this one."""
+        while len(self._stripe_clients) < count:
+            stripe = Client(self.host, self.port, self.features)
+            stripe.stripes = 1
+            stripe.compression, stripe.compression_level = self.compression, self.compression_level
+            stripe.initialize(self.host, self.port)
+            self._stripe_clients.append(stripe)
+        sessions = self._stripe_clients[:count]
+        for stripe in sessions:
+            if self.server_cwd and stripe.server_cwd != self.server_cwd:
+                stripe._send_request(f"cd {self.server_cwd}", stripe.client_socket, stripe.eof_token)
+                stripe._receive_response(f"cd {self.server_cwd}", stripe.client_socket, stripe.eof_token)
+        return sessions
+
+    def _drop_stripe_sessions(self) -> None:
+        for stripe in self._stripe_clients:
+            try:
+                stripe.client_socket.close()
+            except OSError:
+                pass
+        self._stripe_clients = []
+
+    def _stripe_ranges(self, size, stripes) -> list[tuple[int, int]]:
+        """Splits size bytes into at most `stripes` contiguous (offset, length) ranges of at least STRIPE_MIN_SIZE."""
+        count = max(1, min(stripes, -(-size // STRIPE_MIN_SIZE)))
+        bounds = [size * i // count for i in range(count + 1)]
+        return [(bounds[i], bounds[i + 1] - bounds[i]) for i in range(count)]
+
+    def striped_dl(self, file_name, stripes) -> str:
+        """
+        Downloads file_name over several sessions at once: each fetches a disjoint byte range with dlrange and
+        pwrite()s it at its offset into a preallocated '<file_name>.dl-part', which is renamed into place only when
+        every stripe has arrived.
+        :param file_name: name of the file in the server's current directory
+        :param stripes: number of sessions to use
+        :return: the directory listing from this session
+        """
+        # An empty range returns the file's size and version
+        self._send_command(f"dlrange 0 0 {file_name}", self.client_socket, self.eof_token)
+        try:
+            size, mtime_ns = map(int, self._receive_reply(self.client_socket, self.eof_token).split())
+            self._receive_size_header(self.client_socket, self.eof_token)
+        finally:
+            listing = self._receive_reply(self.client_socket, self.eof_token)
+            self._note_listing(listing)
+        ranges = self._stripe_ranges(size, stripes)
+        part_path = file_name + ".dl-part"
+        fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+        def fetch(stripe, offset, length):
+            stripe._send_command(f"dlrange {offset} {length} {file_name}", stripe.client_socket, stripe.eof_token)
+            try:
+                version = tuple(map(int, stripe._receive_reply(stripe.client_socket, stripe.eof_token).split()))
+                count = stripe._receive_size_header(stripe.client_socket, stripe.eof_token)
+                stripe._recv_at(stripe.client_socket, fd, offset, count)
+            finally:
+                stripe._note_listing(stripe._receive_reply(stripe.client_socket, stripe.eof_token))
+            if version != (size, mtime_ns) or count != length:
+                raise ConnectionError(f"{file_name} changed on the server during the download")
+
+        try:
+            if hasattr(os, "posix_fallocate") and size:
+                os.posix_fallocate(fd, 0, size)
+            print(f"[DL] Downloading {file_name} ({size} bytes) in {len(ranges)} stripes")
+            sessions = self._stripe_sessions(len(ranges))
+            with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+                for future in [pool.submit(fetch, stripe, *r) for stripe, r in zip(sessions, ranges)]:
+                    future.result()
+        except BaseException:
+            # A failed stripe may leave its session mid-reply
+            self._drop_stripe_sessions()
+            os.close(fd)
+            os.remove(part_path)
+            raise
+        os.close(fd)
+        os.replace(part_path, file_name)
+        print(f"File downloaded successfully to: {file_name}")
+        return listing
+
+    def striped_ul(self, file_path, stripes) -> str:
+        """
+        Uploads file_path over several sessions at once: each sends a disjoint byte range with ulstripe and the
+        server pwrite()s it into a preallocated partial file, committed once every stripe has arrived.
+        :param file_path: path of the local file
+        :param stripes: number of sessions to use
+        :return: the directory listing that followed the committing stripe
+        """
+        upload_id = os.urandom(8).hex()
+        with open(file_path, 'rb') as file:
+            total_size = os.fstat(file.fileno()).st_size
+        ranges = self._stripe_ranges(total_size, stripes)
+
+        def send(stripe, offset, length):
+            with open(file_path, 'rb') as f:
+                stripe._send_command(
+                    f"ulstripe {upload_id} {offset} {total_size} {file_path}", stripe.client_socket, stripe.eof_token
+                )
+                stripe._send_file(stripe.client_socket, f, offset, length, stripe.eof_token)
+            try:
+                result = stripe._receive_reply(stripe.client_socket, stripe.eof_token)
+            finally:
+                listing = stripe._receive_reply(stripe.client_socket, stripe.eof_token)
+                stripe._note_listing(listing)
+            return result, listing
+
+        print(f"[UL] Uploading {file_path} ({total_size} bytes) in {len(ranges)} stripes")
+        try:
+            sessions = self._stripe_sessions(len(ranges))
+            with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+                results = [f.result() for f in [pool.submit(send, stripe, *r) for stripe, r in zip(sessions, ranges)]]
+        except BaseException:
+            self._drop_stripe_sessions()
+            raise
+        return next((listing for result, listing in results if result == "committed"), "")
+
+    def _file_digest(self, file_path) -> str:
+        """SHA-256 of a local file as hex; unchanged files are not read again."""
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        if key not in self._digests:
+            digest = hashlib.sha256()
+            buffer = memoryview(bytearray(TRANSFER_CHUNK_SIZE))
+            with open(file_path, 'rb') as file:
+                while n := file.readinto(buffer):
+                    digest.update(buffer[:n])
+            self._digests[key] = digest.hexdigest()
+        return self._digests[key]
+
+    def _upload_by_hash(self, file_path):
+        """
+        Sends ulhash so that a server that already stores the same bytes links them in place of an upload.
+        :return: the listing if the server linked the file, None if it has to be uploaded
+        """
+        size = os.path.getsize(file_path)
+        digest = self._file_digest(file_path)
+        self._send_command(f"ulhash {digest} {size} {file_path}", self.client_socket, self.eof_token)
+        try:
+            reply = self._receive_reply(self.client_socket, self.eof_token)
+        finally:
+            listing = self._receive_reply(self.client_socket, self.eof_token)
+            self._note_listing(listing)
+        if reply != "linked":
+            return None
+        print(f"[UL] Server already holds {file_path}; nothing to send")
+        return listing
+
+    def _delta_ul(self, file_path):
+        """
+        Uploads with uldelta: receives the signatures of the server's copy, sends the copy and literal records of
+        delta_instructions() and the file's SHA-256, and receives "<literal bytes> <copied bytes>". A dropped
+        connection or a busy reply starts it over.
+        :return: ((literal bytes, copied bytes), listing)
+        """
+        with open(file_path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+            def attempt():
+                client_socket, eof_token = self.client_socket, self.eof_token
+                self._send_command(f"uldelta {file_path}", client_socket, eof_token)
+                try:
+                    block_size, basis_size = map(int, self._receive_reply(client_socket, eof_token).split())
+                    chunks = self._receive_chunks(client_socket, eof_token)
+                    reader = ChunkReader(chunks)
+                    signatures = []
+                    try:
+                        while len(signatures) < -(-basis_size // block_size):
+                            signatures.append(DELTA_SIGNATURE.unpack(reader.read_exact(DELTA_SIGNATURE.size)))
+                    except ValueError:
+                        # Cut short by a server error, reported after the records below
+                        pass
+                    for _ in chunks:
+                        pass
+                    writer = ChunkWriter(lambda chunk: self._send_chunk(client_socket, chunk, eof_token))
+                    for op, start, end in delta_instructions(data, block_size, signatures, basis_size):
+                        if op == "copy":
+                            writer.write(DELTA_OP.pack(DELTA_COPY, start, end))
+                            continue
+                        for offset in range(start, end, TRANSFER_CHUNK_SIZE):
+                            piece = data[offset:min(offset + TRANSFER_CHUNK_SIZE, end)]
+                            writer.write(DELTA_OP.pack(DELTA_LITERAL, len(piece), 0))
+                            writer.write(piece)
+                    writer.write(DELTA_OP.pack(DELTA_END, size, 0) + bytes.fromhex(self._file_digest(file_path)))
+                    writer.flush()
+                    self._send_chunk(client_socket, b"", eof_token)
+                    literal, copied = map(int, self._receive_reply(client_socket, eof_token).split())
+                finally:
+                    listing = self._receive_reply(client_socket, eof_token)
+                    self._note_listing(listing)
+                return (literal, copied), listing
+
+            try:
+                return self._retrying(attempt)
+            finally:
+                if size:
+                    data.close()
+
+    def _print_listing(self, listing) -> None:
+        # In fast mode an unchanged directory comes back as an empty listing
+        if listing:
+            print(listing)
+
+    def pipeline(self, commands, window=32) -> list:
+        """
+        Issues several commands back-to-back without waiting for each reply. Up to `window` commands are in flight
+        at once; replies are read in order. Most useful in fast mode, where the server does not pause between
+        commands.
+        :param commands: full commands (with arguments), e.g. ["mkdir a", "ul about.txt", "rm a"]
+        :param window: maximum number of commands sent but not yet answered
+        :return: one result per command (see _receive_response); a ServerError instance for failed commands.
+        """
+        results = []
+        in_flight = deque()
+
+        def collect():
+            command_and_arg = in_flight.popleft()
+            try:
+                result, listing = self._receive_response(command_and_arg, self.client_socket, self.eof_token)
+            except ServerError as e:
+                result = e
+            results.append(result)
+
+        for command_and_arg in commands:
+            if len(in_flight) >= window:
+                collect()
+            self._send_request(command_and_arg, self.client_socket, self.eof_token)
+            in_flight.append(command_and_arg)
+        while in_flight:
+            collect()
+        return results
 
     def initialize(self, host, port) -> tuple[socket.socket, str]:
         """
         1) Creates a socket object and connects to the server.
         2) receives the random token (10 bytes) used to indicate end of messages.
         3) Displays the current working directory returned from the server (output of get_working_directory_info() at the server).
+        4) Offers the optional protocol features (see negotiate()).
         Use the helper method: receive_message_ending_with_token() to receive the message from the server.
         :param host: the ip address of the server
         :param port: the port number of the server
@@ -89,22 +1115,55 @@ class Client:
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client_socket.connect((host, port))
         print('Connected to server at IP:', host, 'and Port:', port)
+        self._recv_buffer = bytearray()
+        self._scanned = 0
+        self.fast = False
+        self.framing = "token"
+        self.codec = None
+        self._data_compressed = False
         # Step 2: Receive the EOF token from the server (exact 10 bytes)
-        expected_len = 10
-        eof_token = bytearray()
-        while len(eof_token) < expected_len:
-            chunk = client_socket.recv(expected_len - len(eof_token))
-            if not chunk:
-                raise ConnectionError("Failed to receive full EOF token from server")
-            eof_token.extend(chunk)
+        eof_token = self._recv_exact(client_socket, 10)
         print('Handshake Done. EOF is:', eof_token)
         # Step 3: Receive and display the current working directory from the server
         cwd_info = self.receive_message_ending_with_token(client_socket, 1024, eof_token)
+        if cwd_info.decode('utf-8').startswith(BUSY_MESSAGE):
+            # The server refused the connection instead of sending the listing
+            client_socket.close()
+            raise ServerBusy(cwd_info.decode('utf-8'))
         print('Current Working Directory:', cwd_info.decode('utf-8'))
-        return client_socket, eof_token.decode('utf-8')
+        self._note_listing(cwd_info.decode('utf-8'))
+        self.server_features = set()
+        eof_token = eof_token.decode('utf-8')
+        self.client_socket, self.eof_token = client_socket, eof_token
+        # Step 4: Negotiate protocol features
+        if self.features:
+            self.negotiate(client_socket, eof_token)
+        return client_socket, eof_token
 
         # raise NotImplementedError("Your implementation here.")
 
+    def negotiate(self, client_socket, eof_token) -> list[str]:
+        """
+        Offers self.features (and the self.compression codec) with a "hello" command. A server that supports it
+        answers "ok" followed by the accepted features; an older server treats it as an unknown command and just
+        sends the directory listing, in which case the client keeps the original protocol.
+        :return: the accepted features
+        """
+        offered = list(self.features) + ([self.compression] if self.compression else [])
+        client_socket.sendall(("hello " + " ".join(offered) + eof_token).encode('utf-8'))
+        reply = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8')).decode('utf-8')
+        if reply != "ok" and not reply.startswith("ok "):
+            print("Server does not support protocol features; using the original protocol")
+            return []
+        accepted = reply.split()[1:]
+        self.server_features = set(accepted)
+        self.fast = "fast" in accepted
+        if "v2" in accepted:
+            self.framing = "v2"
+        self.codec = next((feature for feature in accepted if feature in CODECS), None)
+        print('Protocol features:', ", ".join(accepted) or "none")
+        return accepted
+
     def issue_cd(self, command_and_arg, client_socket, eof_token) -> None:
         """
         Sends the full cd command entered by the user to the server. The server changes its cwd accordingly and sends back
@@ -114,9 +1173,9 @@ class Client:
         :param client_socket: the active client socket object.
         :param eof_token: a token to indicate the end of the message.
         """
-        client_socket.sendall((command_and_arg + eof_token).encode('utf-8'))
-        response = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        print(response.decode('utf-8'))
+        self._send_request(command_and_arg, client_socket, eof_token)
+        _, response = self._receive_response(command_and_arg, client_socket, eof_token)
+        self._print_listing(response)
         # raise NotImplementedError("Your implementation here.")
 
     def issue_mkdir(self, command_and_arg, client_socket, eof_token) -> None:
@@ -128,9 +1187,9 @@ class Client:
         :param client_socket: the active client socket object.
         :param eof_token: a token to indicate the end of the message.
         """
-        client_socket.sendall((command_and_arg + eof_token).encode('utf-8'))
-        response = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        print(response.decode('utf-8'))
+        self._send_request(command_and_arg, client_socket, eof_token)
+        _, response = self._receive_response(command_and_arg, client_socket, eof_token)
+        self._print_listing(response)
         # raise NotImplementedError("Your implementation here.")
 
     def issue_rm(self, command_and_arg, client_socket, eof_token) -> None:
@@ -142,11 +1201,23 @@ class Client:
         :param client_socket: the active client socket object.
         :param eof_token: a token to indicate the end of the message.
         """
-        client_socket.sendall((command_and_arg + eof_token).encode('utf-8'))
-        response = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        print(response.decode('utf-8'))
+        self._send_request(command_and_arg, client_socket, eof_token)
+        _, response = self._receive_response(command_and_arg, client_socket, eof_token)
+        self._print_listing(response)
         # raise NotImplementedError("Your implementation here.")
 
+    def issue_ls(self, command_and_arg, client_socket, eof_token) -> None:
+        """
+        Asks the server for the listing of its current working directory ("ls -l": with file sizes and modification
+        times). In fast mode this is the way to see the listing when the directory has not changed.
+        :param command_and_arg: full command provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        """
+        self._send_request(command_and_arg, client_socket, eof_token)
+        _, response = self._receive_response(command_and_arg, client_socket, eof_token)
+        self._print_listing(response)
+
     def issue_ul(self, command_and_arg, client_socket, eof_token) -> None:
         """
         Sends the full ul command entered by the user to the server. Then, it reads the file to be uploaded as binary
@@ -156,19 +1227,22 @@ class Client:
         :param client_socket: the active client socket object.
         :param eof_token: a token to indicate the end of the message.
         """
-        file_path = command_and_arg.split(" ", 1)[1].strip()
-        
         try:
-            with open(file_path, 'rb') as file:
-                file_data = file.read()
-            print(f"[UL] Sending command and size: name={file_path}, size={len(file_data)}")
-            client_socket.sendall((command_and_arg + eof_token).encode('utf-8'))
-            # Send length header (token-terminated), then raw bytes
-            client_socket.sendall((str(len(file_data)) + eof_token).encode('utf-8'))
-            client_socket.sendall(file_data)
+            if "dedup" in self.server_features:
+                listing = self._upload_by_hash(command_and_arg.split(" ", 1)[1].strip())
+                if listing is not None:
+                    self._print_listing(listing)
+                    return
+            if self.stripes > 1 and "stripe" in self.server_features:
+                self._print_listing(self.striped_ul(command_and_arg.split(" ", 1)[1].strip(), self.stripes))
+                return
+            if "range" in self.server_features:
+                self._resumable_ul(command_and_arg.split(" ", 1)[1].strip())
+                return
+            self._send_request(command_and_arg, client_socket, eof_token)
             print("[UL] Waiting for server response (cwd info)...")
-            response = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-            print(response.decode('utf-8'))
+            _, response = self._receive_response(command_and_arg, client_socket, eof_token)
+            self._print_listing(response)
         except Exception as e:
             print(f"An error occurred during upload: {e}")
         # raise NotImplementedError("Your implementation here.")
@@ -183,33 +1257,88 @@ class Client:
         :param client_socket: the active client socket object.
         :param eof_token: a token to indicate the end of the message.
         """
-        client_socket.sendall((command_and_arg + eof_token).encode('utf-8'))
-        # First, receive the size header (token-terminated), allowing for coalesced file bytes
-        size_bytes, remainder = self._read_frame_with_remainder(client_socket, 1024, eof_token.encode('utf-8'))
-        size_str = size_bytes.decode('utf-8').strip()
-        expected_len = int(size_str)
-        # Then, receive exactly expected_len raw bytes, accounting for any remainder already read
-        received = bytearray(remainder)
-        to_read = expected_len - len(received)
-        if to_read < 0:
-            received = received[:expected_len]
-            to_read = 0
-        if to_read > 0:
-            received.extend(self._recv_exact(client_socket, to_read))
-        file_data = bytes(received)
-        file_name = command_and_arg.split(" ", 1)[1].strip()
-                
-        try:
-            with open(file_name, 'wb') as file:
-                file.write(file_data)
-            print(f"File downloaded successfully to: {file_name}")
-        except Exception as e:
-            print(f"Error saving downloaded file: {e}")
-        
-        response = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        print(response.decode('utf-8'))
+        if self.stripes > 1 and "range" in self.server_features:
+            self._print_listing(self.striped_dl(command_and_arg.split(" ", 1)[1].strip(), self.stripes))
+            return
+        if "range" in self.server_features:
+            self._resumable_dl(command_and_arg.split(" ", 1)[1].strip())
+            return
+        self._send_request(command_and_arg, client_socket, eof_token)
+        _, response = self._receive_response(command_and_arg, client_socket, eof_token)
+        self._print_listing(response)
         # raise NotImplementedError("Your implementation here.")
 
+    def _issue_tree(self, command_and_arg):
+        """uldir/dldir: the command and its reply, again from the start after a dropped connection or a busy reply
+        (files already transferred are simply written again). Returns (files, bytes), or None after a local error."""
+        command = command_and_arg.split(" ", 1)[0]
+        if "tree" not in self.server_features:
+            raise ServerError(f"The server does not support {command}")
+
+        def attempt():
+            self._send_request(command_and_arg, self.client_socket, self.eof_token)
+            return self._receive_response(command_and_arg, self.client_socket, self.eof_token)
+
+        try:
+            result, listing = self._retrying(attempt)
+        except (OSError, tarfile.TarError, ValueError) as e:
+            print(f"An error occurred during {command}: {e}")
+            return None
+        self._print_listing(listing)
+        return result
+
+    def issue_uldir(self, command_and_arg, client_socket, eof_token) -> tuple[int, int]:
+        """
+        Sends a uldir command ("uldir <local directory>") and then the whole directory tree as one tar stream, which
+        the server unpacks as it arrives into a directory of the same name in its current working directory. Then it
+        receives the number of files and bytes stored and the latest cwd info from the server.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: (files, bytes), or None if the upload failed
+        """
+        result = self._issue_tree(command_and_arg)
+        if result is not None:
+            print(f"[ULDIR] {result[0]} files, {result[1]} bytes uploaded")
+        return result
+
+    def issue_dldir(self, command_and_arg, client_socket, eof_token) -> tuple[int, int]:
+        """
+        Sends a dldir command ("dldir <directory>"). Then, it receives the server directory's tree as one tar stream
+        and unpacks it as it arrives into a directory of the same name in the local working directory. Finally, it
+        receives the latest cwd info from the server.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: (files, bytes), or None if the download failed
+        """
+        return self._issue_tree(command_and_arg)
+
+    def issue_uldelta(self, command_and_arg, client_socket, eof_token) -> tuple[int, int]:
+        """
+        Sends a uldelta command ("uldelta <local file>"), an upload that only sends the parts of the file that the
+        server's copy does not already hold (see delta_instructions()). The server rebuilds the file from its copy
+        and those parts and sends back the number of literal and reused bytes and the new cwd info. Servers that do
+        not support it get a plain ul instead.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: (literal bytes, copied bytes), or None if the file was uploaded another way or the upload failed
+        """
+        file_path = command_and_arg.split(" ", 1)[1].strip()
+        if "delta" not in self.server_features:
+            print("[ULDELTA] The server does not support delta uploads; uploading the whole file")
+            self.issue_ul(f"ul {file_path}", client_socket, eof_token)
+            return None
+        try:
+            result, listing = self._delta_ul(file_path)
+        except (OSError, ValueError) as e:
+            print(f"An error occurred during upload: {e}")
+            return None
+        print(f"[ULDELTA] {file_path}: {result[0]} bytes sent, {result[1]} bytes reused")
+        self._print_listing(listing)
+        return result
+
     def issue_wordcount(self, command_and_arg, client_socket, eof_token) -> int:
         """
         Sends the full wordcount command entered by the user to the server. Then, it receives the number of words in the file via the socket. Finally, it receives the latest cwd info from
@@ -220,12 +1349,10 @@ class Client:
         :param eof_token: a token to indicate the end of the message.
         :return: wordcount int
         """
-        client_socket.sendall((command_and_arg + eof_token).encode('utf-8'))
-        wordcount_data = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        wordcount = int(wordcount_data.decode('utf-8'))
+        self._send_request(command_and_arg, client_socket, eof_token)
+        wordcount, response = self._receive_response(command_and_arg, client_socket, eof_token)
         print('Word Count:', wordcount)
-        response = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        print(response.decode('utf-8'))
+        self._print_listing(response)
         return wordcount
         # raise NotImplementedError("Your implementation here.")
 
@@ -239,18 +1366,18 @@ class Client:
         :param eof_token: a token to indicate the end of the message.
         :return: list
         """
-        client_socket.sendall((command_and_arg + eof_token).encode('utf-8'))
-        sorted_words_data = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        sorted_words = sorted_words_data.decode('utf-8').splitlines()
+        self._send_request(command_and_arg, client_socket, eof_token)
+        sorted_words, response = self._receive_response(command_and_arg, client_socket, eof_token)
         print('Sorted Words:', sorted_words)
-        response = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        print(response.decode('utf-8'))
+        self._print_listing(response)
         return sorted_words
         # raise NotImplementedError("Your implementation here.")
 
     def issue_search(self, command_and_arg, client_socket, eof_token) -> dict[str, int]:
         """
         Sends the full search command entered by the user to the server. Then, it receives the dictionary of words their the number of matches i.e {  token1: 5, token2: 6, ...,} via the socket.
+        With a glob pattern instead of a file name (e.g. "search *.txt word1,word2"), it receives per-file and total
+        counts (see _parse_search()).
         Finally, it receives the latest cwd info from the server.
         Use the helper method: receive_message_ending_with_token() to receive the message from the server.
         :param command_and_arg: full command (with argument) provided by the user.
@@ -258,21 +1385,46 @@ class Client:
         :param eof_token: a token to indicate the end of the message.
         :return: dict
         """
-        client_socket.sendall((command_and_arg + eof_token).encode('utf-8'))
-        search_results_data = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        search_results_lines = search_results_data.decode('utf-8').splitlines()
-        search_results = {}
-        for line in search_results_lines:
-            if ': ' in line:
-                word, count = line.split(': ', 1)
-                search_results[word] = int(count)
+        self._send_request(command_and_arg, client_socket, eof_token)
+        search_results, response = self._receive_response(command_and_arg, client_socket, eof_token)
         print('Search Results:', search_results)
-
-        response = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        print(response.decode('utf-8'))
+        self._print_listing(response)
         return search_results
         # raise NotImplementedError("Your implementation here.")
 
+    def issue_gsearch(self, command_and_arg, client_socket, eof_token) -> dict[str, dict[str, int]]:
+        """
+        Sends a gsearch command ("gsearch word1,word2") to the server. Then, it receives, for each word, the files of
+        the whole server tree that contain it and their number of matches, i.e. { token1: {"dir/a.txt": 5}, ...}.
+        Finally, it receives the latest cwd info from the server.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: dict
+        """
+        self._send_request(command_and_arg, client_socket, eof_token)
+        search_results, response = self._receive_response(command_and_arg, client_socket, eof_token)
+        print('Global Search Results:', search_results)
+        self._print_listing(response)
+        return search_results
+
+    def issue_stats(self, command_and_arg, client_socket, eof_token) -> dict[str, float]:
+        """
+        Sends the stats command to the server. Then, it receives the server's metrics, i.e. {'fileserver_command_
+        duration_seconds_count{command="dl"}': 3.0, ...}, and finally the latest cwd info from the server.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: dict
+        """
+        self._send_request(command_and_arg, client_socket, eof_token)
+        stats, response = self._receive_response(command_and_arg, client_socket, eof_token)
+        print('Server stats:')
+        for name, value in stats.items():
+            print(f"  {name} {value:g}")
+        self._print_listing(response)
+        return stats
+
     def issue_split(self, command_and_arg, client_socket, eof_token) -> int:
         """
         Sends the full split command entered by the user to the server. Then, save the splits into files with naming pattern filename}_split_{split number}.txt
@@ -283,12 +1435,10 @@ class Client:
         :param eof_token: a token to indicate the end of the message.
         :return: splitcount int
         """
-        client_socket.sendall((command_and_arg + eof_token).encode('utf-8'))
-        splitcount_data = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        splitcount = int(splitcount_data.decode('utf-8'))
+        self._send_request(command_and_arg, client_socket, eof_token)
+        splitcount, response = self._receive_response(command_and_arg, client_socket, eof_token)
         print('Number of splits:', splitcount)
-        response = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        print(response.decode('utf-8'))
+        self._print_listing(response)
         return splitcount
         # raise NotImplementedError("Your implementation here.")
 
@@ -302,13 +1452,14 @@ class Client:
         :param eof_token: a token to indicate the end of the message.
         :return:
         """
-        client_socket.sendall((command_and_arg + eof_token).encode('utf-8'))
-        
-        exit_message = self.receive_message_ending_with_token(client_socket, 1024, eof_token.encode('utf-8'))
-        print(exit_message.decode('utf-8'))
+        self._send_request(command_and_arg, client_socket, eof_token)
+
+        exit_message, _ = self._receive_response(command_and_arg, client_socket, eof_token)
+        print(exit_message)
         print("the client has exited")
 
         client_socket.close()
+        self._drop_stripe_sessions()
         # raise NotImplementedError("Your implementation here.")
 
     def start(self) -> None:
@@ -324,29 +1475,46 @@ class Client:
             user_input = input("Enter command (or 'exit' to quit): ")
             command_and_arg = user_input.strip().split(" ", 1)
             command = command_and_arg[0]
-            if command == "mkdir":
-                self.issue_mkdir(user_input, self.client_socket, self.eof_token)
-            elif command == "cd":
-                self.issue_cd(user_input, self.client_socket, self.eof_token)
-            elif command == "ul":
-                self.issue_ul(user_input, self.client_socket, self.eof_token)
-            elif command == "dl":
-                self.issue_dl(user_input, self.client_socket, self.eof_token)
-            elif command == "wordcount":
-                self.issue_wordcount(user_input, self.client_socket, self.eof_token)
-            elif command == "wordsort":
-                self.issue_wordsort(user_input, self.client_socket, self.eof_token)
-            elif command == "search":
-                self.issue_search(user_input, self.client_socket, self.eof_token)
-            elif command == "split":
-                self.issue_split(user_input, self.client_socket, self.eof_token)
-            elif command == "rm":
-                self.issue_rm(user_input, self.client_socket, self.eof_token)
-            elif command == "exit":
-                self.issue_exit(user_input, self.client_socket, self.eof_token)
-                break
-            else:
-                print("Invalid command. Please try again.")
+            try:
+                if command == "mkdir":
+                    self.issue_mkdir(user_input, self.client_socket, self.eof_token)
+                elif command == "cd":
+                    self.issue_cd(user_input, self.client_socket, self.eof_token)
+                elif command == "ls":
+                    self.issue_ls(user_input, self.client_socket, self.eof_token)
+                elif command == "ul":
+                    self.issue_ul(user_input, self.client_socket, self.eof_token)
+                elif command == "dl":
+                    self.issue_dl(user_input, self.client_socket, self.eof_token)
+                elif command == "uldelta":
+                    self.issue_uldelta(user_input, self.client_socket, self.eof_token)
+                elif command == "uldir":
+                    self.issue_uldir(user_input, self.client_socket, self.eof_token)
+                elif command == "dldir":
+                    self.issue_dldir(user_input, self.client_socket, self.eof_token)
+                elif command == "wordcount":
+                    self.issue_wordcount(user_input, self.client_socket, self.eof_token)
+                elif command == "wordsort":
+                    self.issue_wordsort(user_input, self.client_socket, self.eof_token)
+                elif command == "search":
+                    self.issue_search(user_input, self.client_socket, self.eof_token)
+                elif command == "gsearch":
+                    self.issue_gsearch(user_input, self.client_socket, self.eof_token)
+                elif command == "split":
+                    self.issue_split(user_input, self.client_socket, self.eof_token)
+                elif command == "stats":
+                    self.issue_stats(user_input, self.client_socket, self.eof_token)
+                elif command == "rm":
+                    self.issue_rm(user_input, self.client_socket, self.eof_token)
+                elif command == "exit":
+                    self.issue_exit(user_input, self.client_socket, self.eof_token)
+                    break
+                else:
+                    print("Invalid command. Please try again.")
+            except ServerError as e:
+                print(f"Server error: {e}")
+            except OSError as e:
+                print(f"Connection error: {e}")
 
         print('Exiting the application.')
 
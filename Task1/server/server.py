@@ -1,10 +1,1559 @@
 import socket
 import random
-from threading import Thread
+import bz2
+import lzma
+import zlib
+from threading import BoundedSemaphore, Condition, Event, Lock, Thread, local
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import atexit
+import bisect
+import codecs
+import glob
+import hashlib
+import heapq
+import itertools
+import math
+import mmap
+import multiprocessing
 import os
+import queue
+import re
+import selectors
 import shutil
-from pathlib import Path
+import sqlite3
+import struct
+import sys
+import tarfile
+import tempfile
 import time
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# v2 framing: every frame starts with a fixed header (opcode, flags, payload length) followed by the raw payload.
+# Same definitions as in client.py
+FRAME_HEADER = struct.Struct("!BBQ")
+OP_COMMAND = 1  # client command text
+OP_DATA = 2  # file contents: the header carries the size, the raw bytes follow
+OP_REPLY = 3  # result or listing text
+OP_ERROR = 4  # the command failed; payload is the error text
+# Frame flags
+FLAG_COMPRESSED = 0x01  # payload compressed with the session's codec (see CODECS)
+
+# Compression, negotiated by offering a codec name with "hello" (v2 framing only). A compressed reply is one codec
+# stream. Compressed file data is an OP_DATA header with FLAG_COMPRESSED and the uncompressed size, followed by
+# blocks of BLOCK_HEADER (stored length, raw length) and the stored bytes. Each block holds up to
+# TRANSFER_CHUNK_SIZE raw bytes compressed on their own, or stored as is when stored length == raw length, so neither
+# side ever holds more than one block. Same definitions as in client.py
+BLOCK_HEADER = struct.Struct("!II")
+# codec name -> (compress(data, level), decompressor factory, default level)
+CODECS = {
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompressobj, 6),
+    "bz2": (lambda data, level: bz2.compress(data, level), bz2.BZ2Decompressor, 9),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.LZMADecompressor, 6),
+}
+# Replies and files smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 4096
+# Files are sent compressed only if their first COMPRESS_SAMPLE_SIZE bytes shrink to COMPRESS_MAX_RATIO or less,
+# which keeps already compressed formats (jpg, mp3, pdf, ...) on the raw sendfile() path
+COMPRESS_SAMPLE_SIZE = 64 * 1024
+COMPRESS_MAX_RATIO = 0.9
+
+# Delta uploads (uldelta): the server describes its copy of the file with one DELTA_SIGNATURE per block (adler32 of
+# the block, which the client can roll one byte at a time, and its 16-byte BLAKE2b), and the client answers with
+# DELTA_OP records (op, a, b) saying how to rebuild the new file from those blocks and literal bytes.
+# Same definitions as in client.py
+DELTA_SIGNATURE = struct.Struct("!I16s")
+DELTA_OP = struct.Struct("!BQQ")
+DELTA_COPY = 1  # a: first block of the server's copy, b: number of consecutive blocks
+DELTA_LITERAL = 2  # a: number of literal bytes that follow the record (at most TRANSFER_CHUNK_SIZE)
+DELTA_END = 3  # a: size of the new file; its SHA-256 (32 bytes) follows the record
+# Delta block size bounds; in between, the square root of the file size (as rsync does)
+DELTA_MIN_BLOCK_SIZE = 2048
+DELTA_MAX_BLOCK_SIZE = 128 * 1024
+
+# Size of the reusable buffer that moves file data when the kernel cannot do it (no sendfile, uploads)
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+# Uploads are written to a hidden '.<name>.<random>' temp file with this suffix and renamed into place when complete.
+# Resumable uploads (ulat) use '.<name>.<start of the file's SHA-256>.resume' + suffix, which survives dropped
+# connections, and striped uploads (ulstripe) '.<name>.<upload id>.stripe' + suffix.
+UPLOAD_TEMP_SUFFIX = ".ul-part"
+# Resumable uploads whose running SHA-256 is kept between ulat commands, so that the next chunk need not re-read the
+# bytes already held; the least recently used are dropped first (and then re-read once if they are resumed)
+RESUME_HASHES_KEPT = 1024
+# Content-addressed store of uploaded files (see BlobStore), created in the directory the server starts in
+BLOB_DIR_NAME = ".blobs"
+# Directory under the server's start directory that holds the gsearch index (see SearchIndex)
+INDEX_DIR_NAME = ".index"
+# Longest gsearch waits for queued index updates before it answers from the index as it is
+INDEX_WAIT_SECONDS = 5
+# The indexer commits after this many postings (and whenever it runs out of work): one transaction per file would
+# spend more time committing than inserting
+INDEX_COMMIT_ROWS = 200_000
+# SQLite page cache of each index connection
+INDEX_CACHE_KB = 64 * 1024
+# Number of directories whose listing get_working_directory_info() keeps
+LISTING_CACHE_SIZE = 256
+# A directory modified less than this long before it was scanned may change again within the same mtime tick,
+# so its listing is not cached
+LISTING_MTIME_SLACK_NS = 1_000_000_000
+# Characters stripped from both ends of every word by wordcount, wordsort and search
+WORD_PUNCTUATION = '.,;:!?()[]{}"\''
+WORD_PUNCTUATION_BYTES = WORD_PUNCTUATION.encode('ascii')
+# Memory budget of the token statistics kept by TokenCache
+TOKEN_CACHE_BYTES = 64 * 1024 * 1024
+# Memory budget of the encoded wordcount, wordsort and search replies kept by ResponseCache
+RESPONSE_CACHE_BYTES = 32 * 1024 * 1024
+# Largest share of that budget one reply may take; larger replies are sent but not cached
+RESPONSE_CACHE_ENTRY_SHARE = 4
+# Characters read per step by split_stream(), which bounds the memory a split needs
+SPLIT_CHUNK_CHARS = 1024 * 1024
+# Bytes of a file looked at to tell whether a glob search should include it (see looks_like_text())
+TEXT_SNIFF_BYTES = 8192
+# Bytes tokenized per step by scan_windows()
+SCAN_WINDOW_BYTES = 1024 * 1024
+# wordsort and wordcount on files larger than this run in external memory (see sorted_unique_words())
+EXTERNAL_ANALYTICS_BYTES = 64 * 1024 * 1024
+# Approximate memory of the distinct words collected before they are spilled to a sorted run file
+EXTERNAL_RUN_BYTES = 32 * 1024 * 1024
+# Maximum number of run files merged at once
+EXTERNAL_MERGE_FAN_IN = 64
+# wordcount, wordsort, search and split are computed in a pool of this many processes, so that they hold neither the
+# GIL nor the connection's thread (0: compute them in the connection's thread)
+ANALYTICS_PROCESSES = os.cpu_count() or 1
+# Most commands of each kind computed at once; further ones wait for a slot, leaving CPU for transfers
+ANALYTICS_LIMITS = {"wordcount": 2, "wordsort": 2, "search": 2, "split": 1, "index": 1}
+# Files at least this large are tokenized in parallel, one byte range per analytics process (see text_ranges())
+PARALLEL_ANALYTICS_BYTES = 32 * 1024 * 1024
+# Bytes read per step while looking for the whitespace that starts a range
+TEXT_RANGE_SCAN_BYTES = 64 * 1024
+# Bytes that can start a range: ASCII whitespace, which is also whitespace to str.split()
+ASCII_WHITESPACE = re.compile(rb"[ \t\n\r\x0b\x0c]")
+# Bytes a token needs decoding for (see _token_words())
+NOT_PRINTABLE_ASCII = re.compile(rb"[^\x21-\x7e]")
+# Niceness of the analytics processes, so that transfers win when they compete with them for a CPU
+ANALYTICS_NICE = 10
+# Upper bounds in seconds of the command latency histogram buckets (see Metrics); a last bucket takes the rest
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Commands that move file payloads: counted as in-flight transfers, limited by max_transfers and bandwidth-shaped
+TRANSFER_COMMANDS = ("ul", "ulat", "ulstripe", "uldir", "uldelta", "dl", "dlrange", "dldir")
+# Transfer commands whose payload follows the command, so that they wait for a transfer slot instead of being refused
+UPLOAD_COMMANDS = ("ul", "ulat", "ulstripe", "uldir")
+# Most sessions at once of the thread engine, one thread each; further connections get a busy reply instead of the
+# first listing (0: no limit). The event engine derives its own limit from the open file limit (see
+# descriptor_session_limit())
+MAX_SESSIONS = 1024
+# File descriptors the event engine keeps free of sessions: served files, logs, the search index, the worker and
+# analytics pools, and connections accepted only to be refused
+RESERVED_DESCRIPTORS = 256
+# Most transfers at once (0: no limit). Over the limit, downloads get a busy reply; uploads, whose payload is already
+# on its way, wait for a slot. Sessions that do not understand error replies always wait
+MAX_TRANSFERS = 16
+# EventLoopServer: most commands waiting for a worker; further commands get a busy reply (see _refuse_command())
+WORKER_QUEUE_LIMIT = 64
+# Start of every busy reply: the command was not run and may be retried later
+BUSY_MESSAGE = "Server busy"
+# Largest burst a bandwidth limit lets through above its rate (see TokenBucket)
+BANDWIDTH_BURST_BYTES = 1024 * 1024
+# Prefix of every metric name in the stats reply and on the metrics endpoint
+METRICS_PREFIX = "fileserver"
+# Log levels (see Log), least severe first
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+# The log writer wakes up this often to write what has been queued, or sooner once LOG_BATCH_RECORDS are waiting
+LOG_FLUSH_SECONDS = 0.2
+LOG_BATCH_RECORDS = 1024
+# Records queued beyond this many are dropped (and counted) rather than letting the log slow the server down
+LOG_QUEUE_RECORDS = 100_000
+# Longest text of a single log argument, e.g. a command line; the rest is cut off
+LOG_TEXT_CHARS = 200
+
+
+def _loggable(value) -> str:
+    """How a log argument is shown: never a payload, so bytes only as their length and long text cut off."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<{len(value)} bytes>"
+    text = str(value)
+    if len(text) > LOG_TEXT_CHARS:
+        return f"{text[:LOG_TEXT_CHARS]}... ({len(text)} chars)"
+    return text
+
+
+class Log:
+    """
+    Asynchronous, batched server log. A call only compares the level, takes the sampling decision and appends the
+    record, unformatted, to a queue; a writer thread formats whatever has queued up and writes it with a single
+    write() every LOG_FLUSH_SECONDS (sooner once LOG_BATCH_RECORDS are waiting), so neither formatting nor console I/O
+    runs on the threads that serve clients. If the writer falls LOG_QUEUE_RECORDS behind, records are dropped and
+    counted instead of blocking. Payloads are never logged: every argument is shown through _loggable().
+    """
+    def __init__(self, level="info", stream=None):
+        """
+        :param level: least severe level written (see LOG_LEVELS)
+        :param stream: where the writer writes (default: sys.stdout at the time)
+        """
+        self.level = LOG_LEVELS[level]
+        self.stream = stream
+        # High-volume events (see the sample argument of log()) -> keep one record in this many
+        self.sample_every = {}
+        self.dropped = 0
+        self._samples = {}
+        self._records = deque()
+        self._wakeup = Event()
+        self._writer = None
+        self._lock = Lock()
+
+    def enabled(self, level) -> bool:
+        return LOG_LEVELS[level] >= self.level
+
+    def log(self, level, message, *args, sample=None) -> None:
+        """
+        Queues a record for the writer thread.
+        :param level: one of LOG_LEVELS
+        :param message: str.format() template, formatted with args by the writer thread
+        :param sample: name of a high-volume event, of which only one record in sample_every[sample] is kept
+        """
+        if LOG_LEVELS[level] < self.level:
+            return
+        if sample is not None and self.sample_every.get(sample, 1) > 1:
+            counter = self._samples.get(sample) or self._samples.setdefault(sample, itertools.count())
+            if next(counter) % self.sample_every[sample]:
+                return
+        if len(self._records) >= LOG_QUEUE_RECORDS:
+            self.dropped += 1
+            return
+        self._records.append((time.time(), level, message, args))
+        if self._writer is None:
+            self._start()
+        elif len(self._records) >= LOG_BATCH_RECORDS:
+            self._wakeup.set()
+
+    def debug(self, message, *args, sample=None) -> None:
+        self.log("debug", message, *args, sample=sample)
+
+    def info(self, message, *args, sample=None) -> None:
+        self.log("info", message, *args, sample=sample)
+
+    def warning(self, message, *args, sample=None) -> None:
+        self.log("warning", message, *args, sample=sample)
+
+    def error(self, message, *args, sample=None) -> None:
+        self.log("error", message, *args, sample=sample)
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._writer is None:
+                self._writer = Thread(target=self._run, name="log-writer", daemon=True)
+                self._writer.start()
+                # The writer is a daemon thread: write what is left when the interpreter exits
+                atexit.register(self.flush)
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(LOG_FLUSH_SECONDS)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        """Formats and writes every queued record."""
+        with self._lock:
+            lines = []
+            second = clock = None
+            while self._records:
+                stamp, level, message, args = self._records.popleft()
+                try:
+                    text = message.format(*map(_loggable, args)) if args else message
+                except (IndexError, KeyError, ValueError) as e:
+                    text = f"{message} (bad log arguments: {e})"
+                if int(stamp) != second:
+                    second = int(stamp)
+                    clock = time.strftime('%H:%M:%S', time.localtime(stamp))
+                lines.append(f"{clock}.{int(stamp % 1 * 1000):03d} {level.upper():<7} {text}\n")
+            if lines:
+                stream = self.stream or sys.stdout
+                stream.write("".join(lines))
+                stream.flush()
+
+
+# The server's log; each analytics process has its own, at the server's level
+log = Log()
+
+
+def file_digest(path) -> str:
+    """SHA-256 of a file's contents as hex, read through one reusable buffer."""
+    digest = hashlib.sha256()
+    buffer = memoryview(bytearray(TRANSFER_CHUNK_SIZE))
+    with open(path, 'rb') as f:
+        while n := f.readinto(buffer):
+            digest.update(buffer[:n])
+    return digest.hexdigest()
+
+
+class BlobStore:
+    """
+    Content-addressed storage for uploaded files. Every completed upload is stored once, as
+    <directory>/<first two hex digits>/<sha256>, and each directory entry with the same bytes is a hard link to that
+    blob, so uploading the same file again (or into another directory) takes no extra space, and with ulhash no
+    transfer either. A blob is deleted once no directory entry links to it any more. Where a hard link is not possible
+    (e.g. a directory on another filesystem) the upload is kept as a plain file.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = Lock()
+        # (st_dev, st_ino) of each blob -> its digest, loaded from disk on first use
+        self._inodes = None
+
+    def path(self, digest) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _index(self) -> dict:
+        if self._inodes is None:
+            self._inodes = {}
+            try:
+                prefixes = [entry.path for entry in os.scandir(self.directory) if entry.is_dir()]
+            except FileNotFoundError:
+                prefixes = []
+            for prefix in prefixes:
+                for entry in os.scandir(prefix):
+                    stat = entry.stat()
+                    if stat.st_nlink <= 1:
+                        # Left behind by an interrupted rm
+                        os.remove(entry.path)
+                    else:
+                        self._inodes[(stat.st_dev, stat.st_ino)] = entry.name
+        return self._inodes
+
+    @staticmethod
+    def _linked_inode(path):
+        """(st_dev, st_ino) of path if it may be a link to a blob, else None."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_dev, stat.st_ino) if stat.st_nlink > 1 else None
+
+    @staticmethod
+    def linked_inodes(path) -> list:
+        """Inodes of the blob links at or under path, collected before path is removed (see release())."""
+        if not os.path.isdir(path):
+            return [BlobStore._linked_inode(path)]
+        return [
+            BlobStore._linked_inode(os.path.join(parent, name))
+            for parent, _, names in os.walk(path) for name in names
+        ]
+
+    def release(self, inodes) -> None:
+        """Deletes the blobs among inodes that no directory entry links to any more."""
+        with self._lock:
+            index = self._index()
+            for inode in inodes:
+                digest = index.get(inode)
+                if digest is None:
+                    continue
+                try:
+                    if os.stat(self.path(digest)).st_nlink > 1:
+                        continue
+                    os.remove(self.path(digest))
+                except FileNotFoundError:
+                    pass
+                del index[inode]
+
+    def commit(self, temp_path, file_path, digest=None) -> None:
+        """
+        Moves a complete upload from temp_path to file_path, storing its bytes in the blob store unless they are
+        already there, in which case file_path becomes a link to the existing blob and the upload is dropped.
+        :param temp_path: the complete upload
+        :param file_path: the directory entry to create or replace
+        :param digest: SHA-256 of the upload as hex, if computed while it was received
+        """
+        if digest is None:
+            digest = file_digest(temp_path)
+        blob = self.path(digest)
+        with self._lock:
+            index = self._index()
+            replaced = self._linked_inode(file_path)
+            try:
+                if os.path.exists(blob):
+                    os.link(blob, temp_path + ".link")
+                    os.replace(temp_path + ".link", file_path)
+                    os.remove(temp_path)
+                    if os.path.exists(temp_path + ".link"):
+                        # file_path was already a link to this blob, and rename() between links to the same file
+                        # leaves both in place
+                        os.remove(temp_path + ".link")
+                else:
+                    os.makedirs(os.path.dirname(blob), exist_ok=True)
+                    os.link(temp_path, blob)
+                    stat = os.stat(blob)
+                    index[(stat.st_dev, stat.st_ino)] = digest
+                    os.replace(temp_path, file_path)
+            except OSError as e:
+                log.warning("[UL] Storing {} without deduplication: {}", file_path, e)
+                if os.path.exists(temp_path):
+                    os.replace(temp_path, file_path)
+        if replaced is not None:
+            self.release([replaced])
+
+    def link(self, digest, size, file_path) -> bool:
+        """
+        Creates (or replaces) file_path as a link to the blob with the given digest and size, if the store holds it.
+        :return: True if file_path now has those bytes, False if the client has to upload them.
+        """
+        blob = self.path(digest)
+        link_path = os.path.join(
+            os.path.dirname(file_path), f".{os.path.basename(file_path)}.{os.urandom(4).hex()}{UPLOAD_TEMP_SUFFIX}"
+        )
+        with self._lock:
+            try:
+                if os.stat(blob).st_size != size:
+                    return False
+                replaced = self._linked_inode(file_path)
+                os.link(blob, link_path)
+                os.replace(link_path, file_path)
+                if os.path.exists(link_path):
+                    # Already linked (see commit())
+                    os.remove(link_path)
+            except OSError:
+                return False
+        if replaced is not None:
+            self.release([replaced])
+        return True
+
+
+def tokenize(text) -> list[str]:
+    """The words of a text as the analytics commands see them: lowercased, split on whitespace and stripped of
+    WORD_PUNCTUATION."""
+    return [word.strip(WORD_PUNCTUATION) for word in text.lower().split()]
+
+
+def _token_words(token) -> list[str]:
+    """
+    tokenize() for one whitespace-free token of lowercased UTF-8 bytes, as produced by scan_windows() callers. Plain
+    printable ASCII only needs its punctuation stripped; anything else is decoded (bad UTF-8 becomes U+FFFD) and
+    tokenized as text, which also splits it on the Unicode whitespace that bytes.split() does not know.
+    """
+    if NOT_PRINTABLE_ASCII.search(token) is None:
+        return [token.strip(WORD_PUNCTUATION_BYTES).decode('ascii')]
+    return tokenize(token.decode('utf-8', 'replace'))
+
+
+def scan_windows(f, start=0, end=None):
+    """
+    Yields bytes [start, end) of a binary file in windows of about SCAN_WINDOW_BYTES, read through mmap. Every window
+    but the last ends at ASCII whitespace, so no token is cut. The pages of a window are dropped from the process
+    once it has been scanned (they stay in the page cache), so memory use does not grow with the file.
+    """
+    size = os.fstat(f.fileno()).st_size
+    end = size if end is None else min(end, size)
+    if start >= end:
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position = start
+        while position < end:
+            stop = min(position + SCAN_WINDOW_BYTES, end)
+            if stop < end:
+                match = ASCII_WHITESPACE.search(mm, stop, end)
+                stop = match.start() if match else end
+            yield mm[position:stop]
+            if hasattr(mmap, "MADV_DONTNEED"):
+                first = position - position % mmap.PAGESIZE
+                mm.madvise(mmap.MADV_DONTNEED, first, stop - stop % mmap.PAGESIZE - first)
+            position = stop
+
+
+def looks_like_text(path) -> bool:
+    """Whether the file at path starts like UTF-8 text: its first TEXT_SNIFF_BYTES decode and hold no NUL byte."""
+    with open(path, 'rb') as f:
+        head = f.read(TEXT_SNIFF_BYTES)
+    try:
+        # final=False: the sample may end inside a multi-byte character
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+    except UnicodeDecodeError:
+        return False
+    return b"\0" not in head
+
+
+def scan_frequencies(f, start=0, end=None) -> dict[str, int]:
+    """How often each word occurs in bytes [start, end) of a binary file. Tokens are counted as bytes and only the
+    distinct ones are decoded."""
+    tokens = Counter()
+    for window in scan_windows(f, start, end):
+        tokens.update(window.lower().split())
+    frequencies = {}
+    for token, count in tokens.items():
+        for word in _token_words(token):
+            frequencies[word] = frequencies.get(word, 0) + count
+    return frequencies
+
+
+def scan_words(f, start=0, end=None):
+    """Yields the words of bytes [start, end) of a binary file, each at least once per window (see scan_windows()),
+    for callers that only need the distinct words."""
+    for window in scan_windows(f, start, end):
+        for token in set(window.lower().split()):
+            yield from _token_words(token)
+
+
+def _write_run(words, directory) -> str:
+    """Writes sorted words to a new run file in directory, one per line (words never contain whitespace)."""
+    fd, path = tempfile.mkstemp(dir=directory, suffix=".run")
+    with open(fd, 'w', encoding='utf-8', newline='\n') as run:
+        for word in words:
+            run.write(word + "\n")
+    return path
+
+
+def _merge_runs(paths):
+    """Yields the distinct words of sorted run files in sorted order (a k-way merge)."""
+    runs = [open(path, 'r', encoding='utf-8', newline='\n') for path in paths]
+    try:
+        previous = None
+        for word in heapq.merge(*[(line[:-1] for line in run) for run in runs]):
+            if word != previous:
+                yield word
+                previous = word
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _spill_runs(words, directory):
+    """
+    Collects distinct words until they take about EXTERNAL_RUN_BYTES, then writes them to a sorted run file in
+    directory and starts over.
+    :return: the run files, and the distinct words collected since the last one
+    """
+    runs = []
+    distinct, size = set(), 0
+    for word in words:
+        if word not in distinct:
+            distinct.add(word)
+            # The string plus its set slot
+            size += sys.getsizeof(word) + 16
+            if size > EXTERNAL_RUN_BYTES:
+                runs.append(_write_run(sorted(distinct), directory))
+                distinct, size = set(), 0
+    return runs, distinct
+
+
+def merge_all_runs(runs, directory):
+    """Yields the distinct words of sorted run files in sorted order, in several merge passes if there are more than
+    EXTERNAL_MERGE_FAN_IN."""
+    while len(runs) > EXTERNAL_MERGE_FAN_IN:
+        runs = [
+            _write_run(_merge_runs(runs[i:i + EXTERNAL_MERGE_FAN_IN]), directory)
+            for i in range(0, len(runs), EXTERNAL_MERGE_FAN_IN)
+        ]
+    yield from _merge_runs(runs)
+
+
+def sorted_unique_words(f, directory):
+    """
+    Yields the distinct words of a binary file in sorted order without holding all of them in memory: distinct words
+    are collected until they take about EXTERNAL_RUN_BYTES, then written to a sorted run file in directory, and the
+    runs are merged at the end (see merge_all_runs()).
+    :param f: binary file object
+    :param directory: where the run files go; the caller removes it
+    """
+    runs, words = _spill_runs(scan_words(f), directory)
+    if not runs:
+        yield from sorted(words)
+        return
+    if words:
+        runs.append(_write_run(sorted(words), directory))
+    yield from merge_all_runs(runs, directory)
+
+
+def _write_wordsort_reply(words, directory) -> int:
+    """Writes sorted words to <directory>/reply, one per line. Returns the size of the reply in bytes."""
+    with open(os.path.join(directory, "reply"), 'wb') as reply:
+        batch = []
+        for word in words:
+            batch.append(word)
+            if len(batch) == 65536:
+                reply.write(("\n".join(batch) + "\n").encode('utf-8'))
+                batch = []
+        reply.write("\n".join(batch).encode('utf-8'))
+        size = reply.tell()
+    if not batch and size:
+        # The last batch was full: drop its trailing newline
+        size -= 1
+    return size
+
+
+def external_wordcount(path) -> int:
+    """Number of distinct words in the file at path, counted in external memory (see sorted_unique_words())."""
+    with tempfile.TemporaryDirectory() as work_dir, open(path, 'rb') as f:
+        return sum(1 for _ in sorted_unique_words(f, work_dir))
+
+
+def external_wordsort(path, directory) -> int:
+    """
+    Writes the wordsort reply for the file at path (its distinct words in sorted order, one per line) to
+    <directory>/reply, sorting in external memory (see sorted_unique_words()).
+    :return: the size of the reply in bytes
+    """
+    with open(path, 'rb') as f:
+        return _write_wordsort_reply(sorted_unique_words(f, directory), directory)
+
+
+def text_ranges(path, count) -> list[tuple[int, int]]:
+    """
+    Splits the file at path into at most count byte ranges of about the same size for parallel analytics. Every
+    range but the first starts at an ASCII whitespace byte, which is never part of a word or of a multi-byte UTF-8
+    character, so each range tokenizes to exactly the words the whole file has there.
+    :return: (start, end) of each range, in file order
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, count):
+            position = max(size * i // count, bounds[-1])
+            f.seek(position)
+            while block := f.read(TEXT_RANGE_SCAN_BYTES):
+                match = ASCII_WHITESPACE.search(block)
+                if match:
+                    position += match.start()
+                    break
+                position += len(block)
+            if position >= size:
+                break
+            if position > bounds[-1]:
+                bounds.append(position)
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def range_frequencies(path, start, end) -> dict[str, int]:
+    """How often each word occurs in bytes [start, end) of the file at path (see text_ranges())."""
+    with open(path, 'rb') as f:
+        return scan_frequencies(f, start, end)
+
+
+def range_runs(path, start, end, directory) -> list[str]:
+    """Sorted run files, in directory, of the distinct words in bytes [start, end) of the file at path (see
+    text_ranges() and merge_all_runs())."""
+    with open(path, 'rb') as f:
+        runs, words = _spill_runs(scan_words(f, start, end), directory)
+    if words:
+        runs.append(_write_run(sorted(words), directory))
+    return runs
+
+
+def merged_wordcount(runs, directory) -> int:
+    """Number of distinct words in sorted run files."""
+    return sum(1 for _ in merge_all_runs(runs, directory))
+
+
+def merged_wordsort(runs, directory) -> int:
+    """Writes the wordsort reply for sorted run files to <directory>/reply. Returns its size in bytes."""
+    return _write_wordsort_reply(merge_all_runs(runs, directory), directory)
+
+
+class TokenStats:
+    """Word statistics of one file: how often each word occurs, and the distinct words in sorted order."""
+    def __init__(self, frequencies):
+        """:param frequencies: how often each word occurs (see scan_frequencies())"""
+        self.frequencies = frequencies
+        self.sorted_words = sorted(self.frequencies)
+        # Rough memory footprint: the strings plus a dict entry, an int and a list slot per word
+        self.size = sum(sys.getsizeof(word) for word in self.frequencies) + 120 * len(self.frequencies)
+
+
+def _file_key(path, stat=None) -> tuple:
+    """TokenCache key of the file at path: (path, size, mtime_ns, inode)."""
+    stat = stat or os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def reply_fingerprint(paths) -> tuple:
+    """ResponseCache fingerprint of the files a reply is computed from: (size, mtime_ns, inode) of each, from stat()
+    alone. Files that are gone by now are left out."""
+    fingerprint = []
+    for path in paths:
+        try:
+            fingerprint.append(_file_key(path)[1:])
+        except FileNotFoundError:
+            continue
+    return tuple(fingerprint)
+
+
+def load_token_stats(path):
+    """Reads and tokenizes the file at path. Returns its TokenCache key and its TokenStats."""
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        stats = TokenStats(scan_frequencies(f))
+    return _file_key(path, stat), stats
+
+
+class TokenCache:
+    """
+    Server-wide cache of TokenStats, shared by wordcount, wordsort and search so that a file is read and tokenized
+    once, not once per command. Entries are keyed by (path, size, mtime, inode), so a file that changed on disk is
+    never served from the cache; the least recently used entries are evicted to stay within the memory budget.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self._lock = Lock()
+        # (path, size, mtime_ns, inode) -> TokenStats, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, path, load=None) -> TokenStats:
+        """
+        Returns the statistics of the file at path, reading and tokenizing it only if they are not cached.
+        :param path: the file
+        :param load: reads the file as load_token_stats() does (default: load_token_stats itself, in this thread)
+        """
+        path = os.path.abspath(path)
+        key = _file_key(path)
+        with self._lock:
+            stats = self._entries.get(key)
+            if stats is not None:
+                self._entries.move_to_end(key)
+                return stats
+        key, stats = (load or load_token_stats)(path)
+        with self._lock:
+            if key not in self._entries and stats.size <= self.budget:
+                self._drop([old for old in self._entries if old[0] == path])
+                self._entries[key] = stats
+                self._size += stats.size
+                while self._size > self.budget:
+                    self._drop([next(iter(self._entries))])
+        return stats
+
+    def _drop(self, keys) -> None:
+        for key in keys:
+            self._size -= self._entries.pop(key).size
+
+    def invalidate(self, path) -> None:
+        """Drops the entries of the file at path, or of every file below it if it is a directory."""
+        path = os.path.abspath(path)
+        prefix = os.path.join(path, "")
+        with self._lock:
+            self._drop([key for key in self._entries if key[0] == path or key[0].startswith(prefix)])
+
+
+class CachedReply:
+    """An encoded reply held by ResponseCache, and its compressed forms, each made once per codec when a v2 session
+    that negotiated the codec first gets the reply (None: the reply does not shrink)."""
+    def __init__(self, key, payload, directory=False):
+        """
+        :param key: the ResponseCache key
+        :param payload: the reply text as UTF-8
+        :param directory: whether key[1] is a directory whose files the reply was computed from (glob search)
+        """
+        self.key = key
+        self.payload = payload
+        self.directory = directory
+        self.compressed = {}
+        self.size = len(payload)
+
+    def depends_on(self, path, prefix) -> bool:
+        """Whether a change to path (a file or a directory, prefix being path with a trailing separator) affects
+        this reply."""
+        own_path = self.key[1]
+        return own_path == path or own_path.startswith(prefix) or (
+            self.directory and path.startswith(os.path.join(own_path, ""))
+        )
+
+
+class ResponseCache:
+    """
+    Server-wide cache of encoded wordcount, wordsort and search replies, keyed by (command, path, normalized
+    arguments, fingerprint), so that repeating a command sends the reply it got last time without reading the file.
+    The fingerprint (see reply_fingerprint()) takes one stat() per file, so files changed behind the server's back
+    get a new reply, which replaces the one cached under the old fingerprint; the server also drops the replies of a
+    file as soon as it changes it (see Server._file_changed()). The least recently used replies are evicted to stay
+    within the memory budget.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self._lock = Lock()
+        # key -> CachedReply, least recently used first
+        self._entries = OrderedDict()
+        # (command, path, normalized arguments) -> the key of its cached reply, i.e. with the latest fingerprint
+        self._latest = {}
+        self._size = 0
+        # Bumped by every invalidate(): a reply computed across an invalidation may be stale and is not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """The cached reply for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, payload, generation, directory=False) -> CachedReply:
+        """
+        Caches a reply unless it is too large or generation shows a file changed while it was computed.
+        :param key: (command, absolute path, normalized arguments, fingerprint)
+        :param payload: the reply text as UTF-8
+        :param generation: the value of self.generation before the reply was computed
+        :param directory: see CachedReply
+        :return: the reply, cached or not, for sending
+        """
+        entry = CachedReply(key, payload, directory)
+        with self._lock:
+            # The reply under an older fingerprint is stale now, whether or not this one is cached
+            previous = self._latest.get(key[:3])
+            if previous is not None:
+                self._drop(previous)
+            if generation != self.generation or entry.size > self.budget // RESPONSE_CACHE_ENTRY_SHARE:
+                return entry
+            self._entries[key] = entry
+            self._latest[key[:3]] = key
+            self._size += entry.size
+            self._evict()
+        return entry
+
+    def compressed(self, entry, codec, level=None):
+        """The payload of entry compressed with codec, or None if it does not shrink; made once per codec."""
+        if codec not in entry.compressed:
+            data = compress_block(codec, entry.payload, level)
+            data = data if len(data) < len(entry.payload) else None
+            with self._lock:
+                if codec not in entry.compressed:
+                    entry.compressed[codec] = data
+                    grown = len(data or b"")
+                    entry.size += grown
+                    if self._entries.get(entry.key) is entry:
+                        self._size += grown
+                        self._evict()
+        return entry.compressed[codec]
+
+    def _drop(self, key) -> None:
+        """Removes the reply of key, if cached (with the lock held)."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+            if self._latest.get(key[:3]) == key:
+                del self._latest[key[:3]]
+
+    def _evict(self) -> None:
+        while self._size > self.budget:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, path) -> None:
+        """Drops the replies computed from the file at path, from files below it if it is a directory, and glob
+        searches of the directories it is in."""
+        path = os.path.abspath(path)
+        prefix = os.path.join(path, "")
+        with self._lock:
+            self.generation += 1
+            for key in [key for key, entry in self._entries.items() if entry.depends_on(path, prefix)]:
+                self._drop(key)
+
+    def counters(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self._entries), "bytes": self._size
+            }
+
+
+class SearchIndex:
+    """
+    Persistent inverted index of the text files in the served tree (term -> file -> count) for gsearch, kept in an
+    SQLite database under <root>/INDEX_DIR_NAME. Commands that change the tree call update() with the path they
+    touched; a background thread then re-indexes the files under it whose size or mtime changed and drops the ones
+    that are gone. On start the whole tree is checked the same way, so after a restart only changed files are read.
+    """
+    def __init__(self, root, frequencies):
+        """
+        :param root: the served tree; paths in the index are relative to it
+        :param frequencies: returns how often each word occurs in a file (e.g. from the TokenCache)
+        """
+        self.root = root
+        self.path = os.path.join(root, INDEX_DIR_NAME, "search.sqlite")
+        self._frequencies = frequencies
+        self._reader = None
+        self._read_lock = Lock()
+        # Paths waiting for the indexer thread, in order (a dict as an ordered set)
+        self._pending = {}
+        self._busy = False
+        self._condition = Condition()
+        self._thread = None
+        # Postings written since the last commit (the indexer commits in batches, see INDEX_COMMIT_ROWS)
+        self._uncommitted = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        # WAL: searches read the last committed state while the indexer writes
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(f"PRAGMA cache_size=-{INDEX_CACHE_KB}")
+        return db
+
+    def start(self) -> None:
+        """Opens the index and starts the indexer thread with a check of the whole tree. Does nothing if started."""
+        with self._condition:
+            if self._thread is not None:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = self._connect()
+            with db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS files "
+                    "(id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, size INTEGER, mtime_ns INTEGER)"
+                )
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, file_id INTEGER NOT NULL, "
+                    "count INTEGER NOT NULL, PRIMARY KEY (term, file_id)) WITHOUT ROWID"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS postings_file ON postings (file_id)")
+            self._reader = self._connect()
+            self._pending[self.root] = None
+            self._thread = Thread(target=self._run, args=(db,), daemon=True)
+            self._thread.start()
+
+    def update(self, path) -> None:
+        """Queues a file or directory (created, changed or removed) to be brought up to date in the index."""
+        with self._condition:
+            if self._thread is None:
+                # Not started: start() checks the whole tree anyway
+                return
+            self._pending[os.path.abspath(path)] = None
+            self._condition.notify_all()
+
+    def search(self, words, wait=INDEX_WAIT_SECONDS) -> dict[str, list[tuple[str, int]]]:
+        """
+        Files that contain each word, with the number of occurrences, most first. Waits up to wait seconds for
+        queued updates, so that the result reflects the commands that finished before it.
+        """
+        self.start()
+        with self._condition:
+            self._condition.wait_for(lambda: not self._pending and not self._busy, wait)
+        results = {}
+        with self._read_lock:
+            for word in words:
+                results[word] = self._reader.execute(
+                    "SELECT files.path, postings.count FROM postings JOIN files ON files.id = postings.file_id "
+                    "WHERE postings.term = ? ORDER BY postings.count DESC, files.path", (word,)
+                ).fetchall()
+        return results
+
+    def _run(self, db) -> None:
+        while True:
+            with self._condition:
+                if not self._pending:
+                    # Everything queued is done: make it visible to searches before reporting idle
+                    db.commit()
+                    self._uncommitted = 0
+                    self._busy = False
+                    self._condition.notify_all()
+                    self._condition.wait_for(lambda: self._pending)
+                path = next(iter(self._pending))
+                del self._pending[path]
+                self._busy = True
+            try:
+                self._reconcile(db, path)
+            except sqlite3.Error as e:
+                log.error("[INDEX] Error indexing {}: {}", path, e)
+                db.rollback()
+                self._uncommitted = 0
+
+    def _relative(self, path):
+        """path relative to the root with '/' separators ("" for the root), or None if it is not indexed."""
+        relative = os.path.relpath(path, self.root)
+        if relative == ".":
+            return ""
+        parts = relative.split(os.sep)
+        if parts[0] in ("..", BLOB_DIR_NAME, INDEX_DIR_NAME):
+            return None
+        return "/".join(parts)
+
+    def _reconcile(self, db, path) -> None:
+        """Brings the index entries of path (and of everything under it) in line with the disk."""
+        relative = self._relative(path)
+        if relative is None:
+            return
+        on_disk = {}
+        if os.path.isdir(path):
+            for parent, directories, names in os.walk(path):
+                if parent == self.root:
+                    directories[:] = [name for name in directories if name not in (BLOB_DIR_NAME, INDEX_DIR_NAME)]
+                for name in names:
+                    if not name.endswith(UPLOAD_TEMP_SUFFIX):
+                        file_path = os.path.join(parent, name)
+                        on_disk[self._relative(file_path)] = file_path
+        elif os.path.isfile(path):
+            on_disk[relative] = path
+        if relative:
+            known = db.execute(
+                "SELECT path, id, size, mtime_ns FROM files WHERE path = ? OR (path >= ? AND path < ?)",
+                # Every path below relative sorts between "relative/" and "relative0" ('0' follows '/')
+                (relative, relative + "/", relative + "0")
+            ).fetchall()
+        else:
+            known = db.execute("SELECT path, id, size, mtime_ns FROM files").fetchall()
+        known = {row[0]: row[1:] for row in known}
+        for gone in known.keys() - on_disk.keys():
+            db.execute("DELETE FROM postings WHERE file_id = ?", (known[gone][0],))
+            db.execute("DELETE FROM files WHERE id = ?", (known[gone][0],))
+        for relative_path, file_path in on_disk.items():
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            row = known.get(relative_path)
+            if row is None or row[1:] != (stat.st_size, stat.st_mtime_ns):
+                self._index_file(db, relative_path, file_path, stat, row and row[0])
+
+    def _index_file(self, db, relative_path, file_path, stat, file_id) -> None:
+        try:
+            frequencies = self._frequencies(file_path) if looks_like_text(file_path) else {}
+        except Exception as e:
+            # Gone or unreadable since the walk: a later update() will catch up
+            log.warning("[INDEX] Skipping {}: {}", relative_path, e)
+            return
+        if file_id is None:
+            file_id = db.execute(
+                "INSERT INTO files (path, size, mtime_ns) VALUES (?, ?, ?)",
+                (relative_path, stat.st_size, stat.st_mtime_ns)
+            ).lastrowid
+        else:
+            db.execute("DELETE FROM postings WHERE file_id = ?", (file_id,))
+            db.execute(
+                "UPDATE files SET size = ?, mtime_ns = ? WHERE id = ?", (stat.st_size, stat.st_mtime_ns, file_id)
+            )
+        db.executemany(
+            "INSERT INTO postings (term, file_id, count) VALUES (?, ?, ?)",
+            ((term, file_id, count) for term, count in frequencies.items() if term)
+        )
+        self._uncommitted += len(frequencies)
+        if self._uncommitted >= INDEX_COMMIT_ROWS:
+            db.commit()
+            self._uncommitted = 0
+
+
+def _delimiters_overlap(delimiters) -> bool:
+    """Whether an occurrence of one delimiter can overlap an occurrence of a different one."""
+    for a in delimiters:
+        for b in delimiters:
+            if a != b and (a in b or any(a.endswith(b[:n]) for n in range(1, min(len(a), len(b))))):
+                return True
+    return False
+
+
+class _DelimiterFinder:
+    """
+    Finds the leftmost occurrence of any of a group of delimiters that cannot overlap each other. Each delimiter is
+    located with str.find and its next occurrence remembered, so the text is scanned once per delimiter rather than
+    once per match.
+    """
+    def __init__(self, delimiters):
+        self.delimiters = delimiters
+        self.width = max(map(len, delimiters))
+        # delimiter -> (position of its next occurrence or -1, end of the text searched)
+        self._next = {}
+
+    def search(self, buffer, base, start, end):
+        """Returns (start, end) of the leftmost occurrence within positions [start, end) of the text, where buffer
+        holds the text from position base, or None."""
+        best = None
+        for delimiter in self.delimiters:
+            hit, searched_end = self._next.get(delimiter, (-1, -1))
+            if not (start <= hit and hit + len(delimiter) <= end) and not (hit == -1 and searched_end == end):
+                hit = buffer.find(delimiter, start - base, end - base)
+                if hit != -1:
+                    hit += base
+                self._next[delimiter] = (hit, end)
+            if hit != -1 and (best is None or hit < best[0]):
+                best = (hit, hit + len(delimiter))
+        return best
+
+
+def split_stream(f, delimiters):
+    """
+    Splits the lowercased text read from f at the delimiters in a single streaming pass, with the same result as
+    splitting the whole text by the first delimiter, every part by the second, and so on. Yields the text of each
+    segment in pieces and None where a delimiter ends a segment; only about SPLIT_CHUNK_CHARS characters are held
+    at a time.
+
+    Delimiters that cannot overlap each other are found together by one _DelimiterFinder. Otherwise the earlier
+    delimiter wins where two occurrences overlap, so every delimiter gets its own "level": a level scans
+    the buffer once with str.find semantics, skipping occurrences that overlap a cut of an earlier level, and lags
+    behind that level by its delimiter length so the cuts it has to respect are already known.
+    :param f: text file object
+    :param delimiters: the split words, in order
+    """
+    delimiters = list(dict.fromkeys(delimiters))
+    if not all(delimiters):
+        raise ValueError("empty separator")
+    groups = [[d] for d in delimiters] if _delimiters_overlap(delimiters) else [delimiters]
+    levels = [_DelimiterFinder(group) for group in groups]
+    # Per level: the next position to scan and its cuts not yet emitted, as sorted (start, end) positions
+    positions = [0] * len(levels)
+    cuts = [[] for _ in levels]
+    buffer = ""
+    base = 0  # position of buffer[0] in the text
+    emitted = 0  # text before this position has been yielded
+    eof = False
+    while not eof:
+        chunk = f.read(SPLIT_CHUNK_CHARS)
+        eof = not chunk
+        buffer += chunk.lower()
+        end = base + len(buffer)
+        limit = end
+        for k, finder in enumerate(levels):
+            # Occurrences starting before limit are fully buffered, and so are the earlier levels' cuts they
+            # could overlap
+            if not eof:
+                limit = max(base, limit - (finder.width - 1))
+            # Cuts that were already emitted are gone from cuts, but nothing may start inside them either
+            position = max(positions[k], emitted)
+            while position < limit:
+                match = finder.search(buffer, base, position, limit + finder.width - 1)
+                if match is None or match[0] >= limit:
+                    break
+                start, stop = match
+                conflict = None
+                for earlier in cuts[:k]:
+                    i = bisect.bisect_right(earlier, (start, end))
+                    if i and earlier[i - 1][1] > start:
+                        conflict = earlier[i - 1][1]  # inside an earlier cut: continue after it
+                        break
+                    if i < len(earlier) and earlier[i][0] < stop:
+                        conflict = start + 1  # overlaps an earlier cut that starts later
+                        break
+                if conflict is not None:
+                    position = conflict
+                    continue
+                cuts[k].append((start, stop))
+                position = stop
+            positions[k] = max(position, limit)
+        # Every cut starting before limit is known now
+        ready = []
+        for level_cuts in cuts:
+            i = bisect.bisect_left(level_cuts, (limit,))
+            ready.extend(level_cuts[:i])
+            del level_cuts[:i]
+        for start, stop in sorted(ready):
+            if start > emitted:
+                yield buffer[emitted - base:start - base]
+            yield None
+            emitted = max(emitted, stop)
+        if emitted < limit:
+            yield buffer[emitted - base:limit - base]
+            emitted = limit
+        buffer = buffer[limit - base:]
+        base = limit
+
+
+class SplitOutput:
+    """
+    Writes the segments from split_stream() to '<file>_split_<n>.txt' files, numbering only the segments that contain
+    non-whitespace text. Each segment streams into a hidden temp file that is renamed into place when the segment
+    ends; leading whitespace is held back (up to SPLIT_CHUNK_CHARS) so blank segments usually touch no file at all.
+    Split files that replaced an existing file are listed in `replaced` with their blob inodes, for the server to
+    release and drop from its caches.
+    """
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.count = 0
+        self.replaced = []
+        self._file = None
+        self._temp_path = None
+        self._pending = []
+        self._pending_size = 0
+        self._blank = True
+
+    def write(self, piece) -> None:
+        if self._blank and piece.isspace() and self._pending_size + len(piece) <= SPLIT_CHUNK_CHARS:
+            self._pending.append(piece)
+            self._pending_size += len(piece)
+            return
+        if self._file is None:
+            directory, name = os.path.split(self.base_path)
+            self._temp_path = os.path.join(directory, f".{name}_split.{os.urandom(4).hex()}{UPLOAD_TEMP_SUFFIX}")
+            self._file = open(self._temp_path, 'w')
+        if self._pending:
+            self._file.write("".join(self._pending))
+            self._pending, self._pending_size = [], 0
+        self._file.write(piece)
+        self._blank = self._blank and piece.isspace()
+
+    def end_segment(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            if self._blank:
+                os.remove(self._temp_path)
+            else:
+                self.count += 1
+                split_path = f"{self.base_path}_split_{self.count}.txt"
+                # An existing file may be a link to a blob shared with other entries: replace it, never truncate it
+                if os.path.lexists(split_path):
+                    linked = BlobStore.linked_inodes(split_path)
+                    os.replace(self._temp_path, split_path)
+                    self.replaced.append((split_path, linked))
+                else:
+                    os.replace(self._temp_path, split_path)
+                log.debug("Wrote {}", os.path.basename(split_path), sample="split")
+        self._pending, self._pending_size = [], 0
+        self._blank = True
+
+    def abort(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._temp_path)
+
+
+def split_file(path, delimiters):
+    """
+    Splits the file at path on the given delimiters into '<file>_split_<n>.txt' files in one streaming pass (see
+    split_stream() and SplitOutput).
+    :return: the number of splits, and SplitOutput.replaced
+    """
+    output = SplitOutput(path)
+    try:
+        with open(path, 'r') as f:
+            for piece in split_stream(f, delimiters):
+                if piece is None:
+                    output.end_segment()
+                else:
+                    output.write(piece)
+        output.end_segment()
+    except BaseException:
+        output.abort()
+        raise
+    return output.count, output.replaced
+
+
+class ChunkReader:
+    """
+    Read-only file object over the chunks of a data stream (uldir and uldelta, see Session.read_chunks()), for
+    tarfile.open(mode="r|") to unpack a tree as it arrives, or read_exact() to take fixed-size records.
+    """
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._chunk = b""
+        self._offset = 0
+
+    def read(self, size=-1) -> bytes:
+        if self._offset == len(self._chunk):
+            self._chunk, self._offset = next(self._chunks, b""), 0
+        end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + size)
+        data = bytes(self._chunk[self._offset:end])
+        self._offset = end
+        return data
+
+    def read_exact(self, size) -> bytes:
+        """Reads exactly size bytes, across chunks; ValueError if the stream ends first."""
+        data = self.read(size)
+        while len(data) < size:
+            more = self.read(size - len(data))
+            if not more:
+                raise ValueError("Data stream ended early")
+            data += more
+        return data
+
+
+class ChunkWriter:
+    """
+    Write-only file object for tarfile.open(mode="w") that collects what it is given into chunks of
+    TRANSFER_CHUNK_SIZE bytes for send(chunk) (dldir, see Server.send_chunk()); flush() sends the rest. `sent`
+    counts the bytes handed over.
+    """
+    def __init__(self, send):
+        self._send = send
+        self._buffer = bytearray()
+        self.sent = 0
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= TRANSFER_CHUNK_SIZE:
+            self._send(self._buffer[:TRANSFER_CHUNK_SIZE])
+            del self._buffer[:TRANSFER_CHUNK_SIZE]
+            self.sent += TRANSFER_CHUNK_SIZE
+        return len(data)
+
+    def tell(self) -> int:
+        return self.sent + len(self._buffer)
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._send(self._buffer)
+            self.sent += len(self._buffer)
+            self._buffer = bytearray()
+
+
+def tree_path(root, name) -> str:
+    """
+    Path of the archive member name below root. Absolute names, '..', the blob store and the search index
+    directories and upload temp names are refused with ValueError, so an archive cannot write outside root.
+    """
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if name.startswith("/") or any(
+        part in ("..", BLOB_DIR_NAME, INDEX_DIR_NAME) or part.endswith(UPLOAD_TEMP_SUFFIX) for part in parts
+    ):
+        raise ValueError(f"Invalid path in archive: {name!r}")
+    return os.path.join(root, *parts)
+
+
+def tree_entries(root, relative=""):
+    """
+    Yields (DirEntry, archive name) for the directories and regular files below root, depth first in name order,
+    each directory before its contents. Symbolic links, uploads in progress, the blob store and the search index
+    are left out.
+    """
+    try:
+        with os.scandir(os.path.join(root, relative)) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+        log.warning("[DLDIR] Skipping {}: {}", relative or root, e)
+        return
+    for entry in entries:
+        if entry.name in (BLOB_DIR_NAME, INDEX_DIR_NAME) or entry.name.endswith(UPLOAD_TEMP_SUFFIX):
+            continue
+        name = f"{relative}/{entry.name}" if relative else entry.name
+        if entry.is_dir(follow_symlinks=False):
+            yield entry, name
+            yield from tree_entries(root, name)
+        elif entry.is_file(follow_symlinks=False):
+            yield entry, name
+
+
+def delta_block_size(size) -> int:
+    """Block size of the signatures of a file of the given size (see DELTA_SIGNATURE)."""
+    return max(DELTA_MIN_BLOCK_SIZE, min(DELTA_MAX_BLOCK_SIZE, math.isqrt(size)))
+
+
+def block_signatures(f, block_size):
+    """Yields the DELTA_SIGNATURE records of the blocks of an open binary file, several blocks at a time; the last
+    block may be short."""
+    buffer = memoryview(bytearray(max(1, TRANSFER_CHUNK_SIZE // block_size) * block_size))
+    while n := f.readinto(buffer):
+        yield b"".join(
+            DELTA_SIGNATURE.pack(
+                zlib.adler32(buffer[start:min(start + block_size, n)]),
+                hashlib.blake2b(buffer[start:min(start + block_size, n)], digest_size=16).digest(),
+            )
+            for start in range(0, n, block_size)
+        )
+
+
+def apply_delta(reader, basis, block_size, out, digest) -> tuple[int, int]:
+    """
+    Rebuilds a file from the DELTA_OP records of a uldelta upload: copied blocks are read from basis, literal bytes
+    from reader, and everything is written to out and fed to digest (a hashlib.sha256 object). Ends at DELTA_END,
+    whose size and SHA-256 have to match what was written, else ValueError.
+    :param reader: ChunkReader over the client's data stream
+    :param basis: the server's copy of the file, open for reading (None if there is none)
+    :param block_size: block size of the signatures sent for basis
+    :param out: binary file to write the new file to
+    :param digest: receives every byte written
+    :return: (literal bytes, copied bytes)
+    """
+    basis_size = os.fstat(basis.fileno()).st_size if basis is not None else 0
+    literal = copied = 0
+    while True:
+        op, a, b = DELTA_OP.unpack(reader.read_exact(DELTA_OP.size))
+        if op == DELTA_COPY:
+            offset, end = a * block_size, min((a + b) * block_size, basis_size)
+            if b == 0 or offset >= end:
+                raise ValueError(f"Copy of {b} blocks from block {a} is outside the server's copy")
+            copied += end - offset
+            while offset < end:
+                data = os.pread(basis.fileno(), min(TRANSFER_CHUNK_SIZE, end - offset), offset)
+                if not data:
+                    raise ValueError("The server's copy changed during the delta upload")
+                out.write(data)
+                digest.update(data)
+                offset += len(data)
+        elif op == DELTA_LITERAL:
+            if a > TRANSFER_CHUNK_SIZE:
+                raise ValueError(f"Literal of {a} bytes is too long")
+            data = reader.read_exact(a)
+            out.write(data)
+            digest.update(data)
+            literal += a
+        elif op == DELTA_END:
+            expected = reader.read_exact(hashlib.sha256().digest_size)
+            if a != literal + copied or expected != digest.digest():
+                raise ValueError("The rebuilt file does not match the client's (size or SHA-256 differs)")
+            return literal, copied
+        else:
+            raise ValueError(f"Unknown delta record {op}")
+
+
+def _init_analytics_process(server_pid, log_level=LOG_LEVELS["info"]) -> None:
+    """Runs in each analytics process as it starts."""
+    log.level = log_level
+    try:
+        os.nice(ANALYTICS_NICE)
+    except (AttributeError, OSError):
+        pass
+
+    # A server that is killed cannot shut its pool down: leave with it instead of lingering
+    def watch_server():
+        while os.getppid() == server_pid:
+            time.sleep(1)
+        os._exit(0)
+
+    Thread(target=watch_server, daemon=True).start()
+
+
+def compress_block(codec, data, level=None) -> bytes:
+    compress, _, default_level = CODECS[codec]
+    return compress(data, default_level if level is None else level)
+
+
+def decompress_block(codec, data, raw_len=None) -> bytes:
+    """Decompresses one block (or a whole reply when raw_len is None), never producing more than raw_len bytes. A
+    block must hold exactly raw_len bytes: one that would inflate to more is refused, not cut short."""
+    decompressor = CODECS[codec][1]()
+    if raw_len is None:
+        return decompressor.decompress(data)
+    raw = decompressor.decompress(data, raw_len)
+    if len(raw) != raw_len:
+        raise ValueError(f"Compressed block holds {len(raw)} bytes instead of {raw_len}")
+    if not decompressor.eof or decompressor.unused_data:
+        raise ValueError(f"Compressed block holds more than {raw_len} bytes")
+    return raw
+
+
+class Metrics:
+    """
+    Server-wide instrumentation: for each command a latency histogram (see LATENCY_BUCKETS), its count, errors and
+    bytes received and sent, plus gauges such as active sessions and in-flight transfers. Every thread records into
+    a shard of its own, so recording takes no lock and touches no counter another thread writes; a snapshot sums the
+    shards. A thread that is done for good (a ClientThread) folds its shard into the retired totals.
+    """
+    # Fields of a command's record, followed by one count per latency bucket
+    COUNT, ERRORS, SECONDS, BYTES_IN, BYTES_OUT, BUCKETS = range(6)
+
+    def __init__(self):
+        self._local = local()
+        self._lock = Lock()
+        # Shard of every live recording thread: ({command: record}, {gauge: value})
+        self._shards = []
+        self._retired = ({}, {})
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = ({}, {})
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def record(self, command, seconds, bytes_in, bytes_out, failed) -> None:
+        """Records one run of command that took seconds and moved the given bytes."""
+        commands = self._shard()[0]
+        record = commands.get(command)
+        if record is None:
+            record = commands[command] = [0, 0, 0.0, 0, 0] + [0] * (len(LATENCY_BUCKETS) + 1)
+        record[Metrics.COUNT] += 1
+        record[Metrics.ERRORS] += failed
+        record[Metrics.SECONDS] += seconds
+        record[Metrics.BYTES_IN] += bytes_in
+        record[Metrics.BYTES_OUT] += bytes_out
+        record[Metrics.BUCKETS + bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def add(self, gauge, delta) -> None:
+        """Moves a gauge by delta; the thread that raises a gauge need not be the one that lowers it."""
+        gauges = self._shard()[1]
+        gauges[gauge] = gauges.get(gauge, 0) + delta
+
+    @staticmethod
+    def _merge(into, shard) -> None:
+        commands, gauges = into
+        for command, record in list(shard[0].items()):
+            total = commands.get(command)
+            if total is None:
+                commands[command] = list(record)
+            else:
+                for i, value in enumerate(record):
+                    total[i] += value
+        for gauge, value in list(shard[1].items()):
+            gauges[gauge] = gauges.get(gauge, 0) + value
+
+    def retire(self) -> None:
+        """Folds the calling thread's shard into the retired totals (call when the thread is about to end)."""
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            return
+        self._local.shard = None
+        with self._lock:
+            self._shards.remove(shard)
+            self._merge(self._retired, shard)
+
+    def snapshot(self):
+        """Totals over every thread: ({command: record}, {gauge: value})."""
+        totals = ({}, {})
+        with self._lock:
+            for shard in [self._retired] + self._shards:
+                self._merge(totals, shard)
+        return totals
+
+    def exposition(self, counters=None) -> str:
+        """
+        The metrics in the Prometheus text format.
+        :param counters: further values to include, {name: value} (e.g. cache counters)
+        """
+        commands, gauges = self.snapshot()
+        name = f"{METRICS_PREFIX}_command_duration_seconds"
+        lines = [f"# TYPE {name} histogram"]
+        for command, record in sorted(commands.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), record[Metrics.BUCKETS:]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{command="{command}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{command="{command}"}} {record[Metrics.SECONDS]:.6f}')
+            lines.append(f'{name}_count{{command="{command}"}} {record[Metrics.COUNT]}')
+        for field, suffix in (
+            (Metrics.ERRORS, "command_errors_total"), (Metrics.BYTES_IN, "received_bytes_total"),
+            (Metrics.BYTES_OUT, "sent_bytes_total")
+        ):
+            lines.append(f"# TYPE {METRICS_PREFIX}_{suffix} counter")
+            lines.extend(
+                f'{METRICS_PREFIX}_{suffix}{{command="{command}"}} {record[field]}'
+                for command, record in sorted(commands.items())
+            )
+        for gauge, value in sorted(gauges.items()):
+            lines.append(f"# TYPE {METRICS_PREFIX}_{gauge} gauge")
+            lines.append(f"{METRICS_PREFIX}_{gauge} {value}")
+        for counter, value in (counters or {}).items():
+            lines.append(f"{METRICS_PREFIX}_{counter} {value}")
+        return "\n".join(lines)
+
+
+class TokenBucket:
+    """
+    Bandwidth limit in bytes per second. take(n) returns at once while the bucket holds n tokens and otherwise sleeps
+    until the rate has paid for them. The bucket goes into debt rather than making callers poll, so concurrent callers
+    are served in the order they asked: transfers that take a chunk at a time share the rate evenly.
+    """
+    def __init__(self, rate, burst=BANDWIDTH_BURST_BYTES):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = Lock()
+
+    def take(self, n) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate) - n
+            self._last = now
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
 
 
 class Server:
@@ -12,17 +1561,320 @@ class Server:
         self.host = host
         self.port = port
         self.server_socket = None
+        # Pause before the directory listing that follows every command
+        self.command_delay = 1
+        # Level for compressed replies and downloads (None: the codec's default)
+        self.compression_level = None
+        root = os.path.abspath(os.getcwd())
+        self.blobs = BlobStore(os.path.join(root, BLOB_DIR_NAME))
+        self.token_cache = TokenCache(TOKEN_CACHE_BYTES)
+        self.response_cache = ResponseCache(RESPONSE_CACHE_BYTES)
+        self.metrics = Metrics()
+        # (host, port) of the HTTP endpoint that serves the metrics in the Prometheus text format, or None
+        self.metrics_address = None
+        # Admission limits (see MAX_SESSIONS and MAX_TRANSFERS) and bandwidth limits in bytes per second of every
+        # session's transfers and of all transfers together (0: none)
+        self.max_sessions = MAX_SESSIONS
+        self.max_transfers = MAX_TRANSFERS
+        self.session_bandwidth = 0
+        self.total_bandwidth = 0
+        self._sessions = 0
+        self._transfers = 0
+        self._admission_lock = Condition()
+        self._bandwidth = None
+        self.search_index = SearchIndex(root, lambda path: self._token_stats("index", path).frequencies)
+        # Files larger than this get external-memory wordsort and wordcount
+        self.external_analytics_bytes = EXTERNAL_ANALYTICS_BYTES
+        # Analytics process pool size (see ANALYTICS_PROCESSES) and per-command limits (see ANALYTICS_LIMITS)
+        self.analytics_processes = ANALYTICS_PROCESSES
+        self.analytics_limits = dict(ANALYTICS_LIMITS)
+        # Files at least this large are analyzed in parallel byte ranges (see PARALLEL_ANALYTICS_BYTES)
+        self.parallel_analytics_bytes = PARALLEL_ANALYTICS_BYTES
+        # Created on first use: the pool, and a semaphore per analytics command
+        self._analytics_pool = None
+        self._admission = {}
+        self._analytics_lock = Lock()
+        # Directory listings: path -> (mtime_ns, listing, detailed listing or None, DirEntry list), least recently
+        # used first
+        self._listings = OrderedDict()
+        self._listings_lock = Lock()
+        # Striped uploads in progress: partial file path -> {"total": size, "ranges": [(offset, length), ...]}
+        self._stripes = {}
+        self._stripes_lock = Lock()
+        # Resumable uploads: partial file path -> (bytes held, SHA-256 of them), least recently used first
+        self._resume_hashes = OrderedDict()
+        self._resume_hashes_lock = Lock()
     
+    def _analytics_slot(self, command):
+        """The admission semaphore of command and the process pool (None if analytics_processes is 0)."""
+        with self._analytics_lock:
+            admission = self._admission.get(command)
+            if admission is None:
+                admission = self._admission[command] = BoundedSemaphore(self.analytics_limits.get(command, 1))
+            if self._analytics_pool is None and self.analytics_processes > 0:
+                # spawn: forking a process that runs many threads can copy locks held by other threads
+                self._analytics_pool = ProcessPoolExecutor(
+                    self.analytics_processes, mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_analytics_process, initargs=(os.getpid(), log.level)
+                )
+            return admission, self._analytics_pool
+
+    def _pool_broken(self, pool) -> None:
+        """A worker died (e.g. killed for memory): start a new pool for the next command."""
+        with self._analytics_lock:
+            if self._analytics_pool is pool:
+                self._analytics_pool = None
+        pool.shutdown(wait=False)
+
+    def run_analytics(self, command, function, *args):
+        """
+        Computes function(*args) for an analytics command in the analytics process pool (or in this thread if
+        analytics_processes is 0) and returns the result; the calling thread only waits for it. At most
+        analytics_limits[command] run at once, further callers wait for a slot.
+        :param command: "wordcount", "wordsort", "search" or "split"
+        :param function: module-level function, so that it can be sent to another process
+        """
+        admission, pool = self._analytics_slot(command)
+        with admission:
+            if pool is None:
+                return function(*args)
+            try:
+                return pool.submit(function, *args).result()
+            except BrokenProcessPool:
+                self._pool_broken(pool)
+                raise
+
+    def run_analytics_map(self, command, function, calls) -> list:
+        """
+        Like run_analytics(), for several calls of function that run in parallel in the pool and take one slot.
+        :param calls: argument tuple of each call
+        :return: the result of each call, in order
+        """
+        admission, pool = self._analytics_slot(command)
+        with admission:
+            if pool is None:
+                return [function(*args) for args in calls]
+            futures = [pool.submit(function, *args) for args in calls]
+            try:
+                return [future.result() for future in futures]
+            except BrokenProcessPool:
+                self._pool_broken(pool)
+                raise
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def _parallel_ranges(self, path):
+        """Byte ranges to analyze the file at path in parallel (see text_ranges()), or None if it is too small to be
+        worth it or there is only one analytics process."""
+        if self.analytics_processes < 2 or os.path.getsize(path) < self.parallel_analytics_bytes:
+            return None
+        ranges = text_ranges(path, self.analytics_processes)
+        return ranges if len(ranges) > 1 else None
+
+    def _load_token_stats(self, command, path):
+        """load_token_stats() for TokenCache, tokenizing large files in parallel byte ranges."""
+        key = _file_key(path)
+        ranges = self._parallel_ranges(path)
+        if ranges is not None:
+            parts = self.run_analytics_map(command, range_frequencies, [(path, start, end) for start, end in ranges])
+            # The ranges were read separately: only trust them if the file was not replaced in the meantime
+            if _file_key(path) == key:
+                frequencies = parts[0]
+                for part in parts[1:]:
+                    for word, count in part.items():
+                        frequencies[word] = frequencies.get(word, 0) + count
+                return key, TokenStats(frequencies)
+        return self.run_analytics(command, load_token_stats, path)
+
+    def _token_stats(self, command, path) -> TokenStats:
+        """TokenCache entry of the file at path, computed by run_analytics() if it is not cached."""
+        return self.token_cache.get(path, lambda path: self._load_token_stats(command, path))
+
+    def _external_analytics(self, command, path, work_dir):
+        """
+        wordcount or wordsort of a file above external_analytics_bytes, in external memory (see sorted_unique_words());
+        large files are tokenized into sorted runs in parallel byte ranges, then merged in one pass.
+        :return: the word count, or the size of the wordsort reply written to <work_dir>/reply
+        """
+        key = _file_key(path)
+        ranges = self._parallel_ranges(path)
+        if ranges is not None:
+            runs = self.run_analytics_map(
+                command, range_runs, [(path, start, end, work_dir) for start, end in ranges]
+            )
+            if _file_key(path) == key:
+                merge = merged_wordsort if command == "wordsort" else merged_wordcount
+                return self.run_analytics(command, merge, [run for part in runs for run in part], work_dir)
+        if command == "wordsort":
+            return self.run_analytics(command, external_wordsort, path, work_dir)
+        return self.run_analytics(command, external_wordcount, path)
+
+    def _file_changed(self, path) -> None:
+        """Drops the cached word statistics and replies of path (a file or a directory) and queues it for the search
+        index."""
+        self.token_cache.invalidate(path)
+        self.response_cache.invalidate(path)
+        self.search_index.update(path)
+
+    def admit_session(self) -> bool:
+        """Takes a session slot for a new connection; False if max_sessions are already being served."""
+        with self._admission_lock:
+            if self.max_sessions and self._sessions >= self.max_sessions:
+                return False
+            self._sessions += 1
+            return True
+
+    def session_closed(self) -> None:
+        with self._admission_lock:
+            self._sessions -= 1
+
+    def refuse_connection(self, client_socket, eof_token, address) -> None:
+        """Sends a connection that admit_session() refused a busy reply where the first listing would be, and closes
+        it."""
+        log.warning("Refusing {}: {} sessions", address, self._sessions)
+        self.metrics.add("busy_replies", 1)
+        try:
+            client_socket.sendall(f"{BUSY_MESSAGE}: too many sessions{eof_token}".encode('utf-8'))
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+
+    def acquire_transfer(self, wait) -> bool:
+        """Takes one of the max_transfers slots, waiting for one if wait is True. Returns whether it got one."""
+        with self._admission_lock:
+            while self.max_transfers and self._transfers >= self.max_transfers:
+                if not wait:
+                    return False
+                self._admission_lock.wait()
+            self._transfers += 1
+            return True
+
+    def release_transfer(self) -> None:
+        with self._admission_lock:
+            self._transfers -= 1
+            self._admission_lock.notify()
+
+    def bandwidth_limits(self, session_bucket):
+        """
+        The token buckets a transfer of a session takes its bytes from: the session's own and the server-wide one,
+        each only if its limit is set.
+        :param session_bucket: the session's TokenBucket, or None if it has none yet
+        :return: the buckets, and the session's bucket (created here on first use)
+        """
+        if self.session_bandwidth and (session_bucket is None or session_bucket.rate != self.session_bandwidth):
+            session_bucket = TokenBucket(self.session_bandwidth)
+        with self._admission_lock:
+            if self.total_bandwidth and (self._bandwidth is None or self._bandwidth.rate != self.total_bandwidth):
+                self._bandwidth = TokenBucket(self.total_bandwidth)
+            buckets = [
+                bucket for bucket in (
+                    session_bucket if self.session_bandwidth else None,
+                    self._bandwidth if self.total_bandwidth else None
+                ) if bucket is not None
+            ]
+        return buckets, session_bucket
+
+    def metrics_text(self) -> str:
+        """Metrics (see Metrics.exposition()) including the response cache counters and dropped log records."""
+        cache = self.response_cache.counters()
+        return self.metrics.exposition({
+            "response_cache_hits_total": cache["hits"], "response_cache_misses_total": cache["misses"],
+            "response_cache_evictions_total": cache["evictions"], "response_cache_bytes": cache["bytes"],
+            "log_dropped_total": log.dropped
+        })
+
+    def start_metrics_endpoint(self) -> None:
+        """Serves metrics_text() over HTTP at metrics_address (GET any path) from a daemon thread, if it is set."""
+        if self.metrics_address is None:
+            return
+        server = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = server.metrics_text().encode('utf-8') + b"\n"
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        endpoint = ThreadingHTTPServer(self.metrics_address, MetricsHandler)
+        Thread(target=endpoint.serve_forever, daemon=True).start()
+        log.info("Metrics on http://{}:{}/metrics", self.metrics_address[0], endpoint.server_address[1])
+
+    def _send_cached_reply(self, service_socket, key, eof_token) -> bool:
+        """Sends the cached reply for key (see ResponseCache), if there is one. Returns whether it did."""
+        entry = self.response_cache.get(key)
+        if entry is None:
+            return False
+        self.send_cached(service_socket, entry, eof_token)
+        return True
+
+    def _send_new_reply(self, service_socket, key, generation, message, eof_token, directory=False) -> None:
+        """Caches a reply just computed (see ResponseCache.put()) and sends it."""
+        entry = self.response_cache.put(key, message.encode('utf-8'), generation, directory)
+        self.send_cached(service_socket, entry, eof_token)
+
     def _recv_exact(self, active_socket: socket.socket, n: int) -> bytearray:
         """Receive exactly n bytes from the socket, or raise if connection closes early."""
-        data = bytearray()
-        while len(data) < n:
-            packet = active_socket.recv(n - len(data))
-            if not packet:
+        data = bytearray(n)
+        view = memoryview(data)
+        received = 0
+        while received < n:
+            packet_len = active_socket.recv_into(view[received:], n - received)
+            if not packet_len:
                 raise ConnectionError("Socket closed before receiving expected bytes")
-            data.extend(packet)
+            received += packet_len
         return data
 
+    def _recv_into_file(self, active_socket: socket.socket, file, n: int, digest=None) -> None:
+        """Receive exactly n bytes into an open binary file (or discard them when file is None) through one
+        preallocated buffer, or raise if connection closes early. The bytes are also fed to digest (a hashlib
+        object), if given. If writing fails, the rest of the bytes are still received (and discarded) before the
+        error is raised, so that the next command is read correctly."""
+        buffer = memoryview(bytearray(min(TRANSFER_CHUNK_SIZE, n)))
+        error = None
+        while n > 0:
+            packet_len = active_socket.recv_into(buffer, min(len(buffer), n))
+            if not packet_len:
+                raise ConnectionError("Socket closed before receiving expected bytes")
+            if file is not None:
+                try:
+                    file.write(buffer[:packet_len])
+                except OSError as e:
+                    error, file = e, None
+            if digest is not None:
+                digest.update(buffer[:packet_len])
+            n -= packet_len
+        if error is not None:
+            raise error
+
+    def _recv_at(self, active_socket: socket.socket, fd: int, offset: int, n: int) -> None:
+        """Receive exactly n bytes and pwrite() them to fd starting at offset, through one preallocated buffer. If
+        writing fails, the rest of the bytes are still received (and discarded) before the error is raised, so that
+        the next command is read correctly."""
+        buffer = memoryview(bytearray(min(TRANSFER_CHUNK_SIZE, n)))
+        error = None
+        while n > 0:
+            packet_len = active_socket.recv_into(buffer, min(len(buffer), n))
+            if not packet_len:
+                raise ConnectionError("Socket closed before receiving expected bytes")
+            written = 0
+            while error is None and written < packet_len:
+                try:
+                    written += os.pwrite(fd, buffer[written:packet_len], offset + written)
+                except OSError as e:
+                    error = e
+            offset += packet_len
+            n -= packet_len
+        if error is not None:
+            raise error
+
     def _read_frame_with_remainder(self, active_socket: socket.socket, buffer_size: int, eof_token):
         """Read from socket until the first occurrence of eof_token is found anywhere in the stream.
         Returns a tuple: (payload_without_token, remainder_after_token).
@@ -51,6 +1903,8 @@ class Server:
 
         Note: Use ClientThread for each client connection.
         """
+        self.search_index.start()
+        self.start_metrics_endpoint()
         # Create a socket
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         with self.server_socket as s:
@@ -60,43 +1914,104 @@ class Server:
             s.bind((self.host, self.port))
         # Listen for incoming connections
             s.listen()
-            print(f"Server listening on {self.host}:{self.port}")
+            log.info("Server listening on {}:{}", self.host, self.port)
         # while True:
         # Accept incoming connections
         # print(f"Accepted connection from {client_address}")
         # send random eof token
             while True:
                 client_socket, client_address = s.accept()
-                print(f"Accepted connection from {client_address}")
+                log.info("Accepted connection from {}", client_address, sample="connection")
                 # Generate a random EOF token
                 eof_token = self.generate_random_eof_token()
                 # Send the random EOF token to the client
                 client_socket.send(eof_token.encode('utf-8'))
+                if not self.admit_session():
+                    self.refuse_connection(client_socket, eof_token, client_address)
+                    continue
 
                 try:
                     # Handle the client requests using ClientThread
                     client_thread = ClientThread(self, client_socket, client_address, eof_token)
                     client_thread.start()
                 except Exception as e:
-                    print(f"Error: {e}")
+                    log.error("Error: {}", e)
+                    self.session_closed()
+                    client_socket.close()
                 # Do NOT close client_socket here; the ClientThread owns and closes it
 
         # raise NotImplementedError("Your implementation here.")
 
-    def get_working_directory_info(self, working_directory) -> str:
+    def get_working_directory_info(self, working_directory, details=False) -> str:
         """
-        Creates a string representation of a working directory and its contents.
+        Creates a string representation of a working directory and its contents. The listing is built in one
+        os.scandir() pass and cached until the directory's mtime changes or invalidate_listing() is called.
         :param working_directory: path to the directory
+        :param details: also show each file's size and modification time
         :return: string of the directory and its contents.
         """
-        dirs = "\n-- " + "\n-- ".join(
-            [i.name for i in Path(working_directory).iterdir() if i.is_dir()]
-        )
-        files = "\n-- " + "\n-- ".join(
-            [i.name for i in Path(working_directory).iterdir() if i.is_file()]
-        )
+        try:
+            mtime_ns = os.stat(working_directory).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        with self._listings_lock:
+            cached = self._listings.get(working_directory)
+            if cached is not None and cached[0] == mtime_ns:
+                self._listings.move_to_end(working_directory)
+                if not details:
+                    return cached[1]
+                if cached[2] is not None:
+                    return cached[2]
+        if cached is None or cached[0] != mtime_ns:
+            cached = (mtime_ns, *self._scan_directory(working_directory))
+        if details:
+            cached = (*cached[:2], self._detailed_listing(working_directory, cached[3]), cached[3])
+        if mtime_ns is not None and time.time_ns() - mtime_ns > LISTING_MTIME_SLACK_NS:
+            with self._listings_lock:
+                self._listings[working_directory] = cached
+                self._listings.move_to_end(working_directory)
+                while len(self._listings) > LISTING_CACHE_SIZE:
+                    self._listings.popitem(last=False)
+        return cached[2] if details else cached[1]
+
+    def _scan_directory(self, working_directory):
+        """Returns (listing, None, listed DirEntry objects) from one os.scandir() pass: subdirectories first, then
+        files. Uploads still in progress, the blob store and the search index are not listed."""
+        dir_entries, file_entries = [], []
+        with os.scandir(working_directory) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if entry.name not in (BLOB_DIR_NAME, INDEX_DIR_NAME):
+                        dir_entries.append(entry)
+                elif entry.is_file() and not entry.name.endswith(UPLOAD_TEMP_SUFFIX):
+                    file_entries.append(entry)
+        dirs = "\n-- " + "\n-- ".join([entry.name for entry in dir_entries])
+        files = "\n-- " + "\n-- ".join([entry.name for entry in file_entries])
         dir_info = f"Current Directory: {working_directory}:\n|{dirs}{files}"
-        return dir_info
+        return dir_info, None, dir_entries + file_entries
+
+    def _detailed_listing(self, working_directory, entries) -> str:
+        """The listing with "<size> <modified>" after every file name. DirEntry objects keep their stat() result, so
+        a cached listing is only stat()ed once."""
+        lines = [f"Current Directory: {working_directory}:", "|"]
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if entry.is_dir():
+                lines.append(f"-- {entry.name}/")
+            else:
+                modified = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stat.st_mtime))
+                lines.append(f"-- {entry.name}  {stat.st_size} bytes  {modified}")
+        return "\n".join(lines)
+
+    def invalidate_listing(self, working_directory) -> None:
+        """Drops the cached listings of working_directory and of every directory below it."""
+        prefix = os.path.join(working_directory, "")
+        with self._listings_lock:
+            for path in [path for path in self._listings if path == working_directory or path.startswith(prefix)]:
+                del self._listings[path]
 
     def generate_random_eof_token(self) -> str:
         """Helper method to generates a random token that starts with '<' and ends with '>'.
@@ -136,6 +2051,144 @@ class Server:
         return data
         # raise NotImplementedError("Your implementation here.")
 
+    def send_message(self, service_socket, message, eof_token) -> None:
+        """
+        Sends a text message followed by the eof_token. When service_socket is a Session, the session applies its
+        own framing instead.
+        :param service_socket: active socket (or Session) with the client
+        :param message: the text to send
+        :param eof_token: a token to indicate the end of the message.
+        """
+        if isinstance(service_socket, Session):
+            service_socket.send_message(message)
+        else:
+            service_socket.sendall((message + eof_token).encode('utf-8'))
+
+    def send_cached(self, service_socket, entry, eof_token) -> None:
+        """
+        send_message() for a reply from ResponseCache: the payload is already encoded, so it goes to the socket as is.
+        :param service_socket: active socket (or Session) with the client
+        :param entry: the CachedReply
+        :param eof_token: a token to indicate the end of the message.
+        """
+        if isinstance(service_socket, Session):
+            service_socket.send_cached(entry)
+        else:
+            service_socket.sendall(entry.payload + eof_token.encode('utf-8'))
+
+    def send_size_header(self, service_socket, size, eof_token) -> None:
+        """
+        Announces the size of the raw file bytes that follow (dl). Token framing sends the size as a message,
+        v2 sessions send an OP_DATA header.
+        :param service_socket: active socket (or Session) with the client
+        :param size: number of raw bytes that follow
+        :param eof_token: a token to indicate the end of the message.
+        """
+        if isinstance(service_socket, Session):
+            service_socket.send_size_header(size)
+        else:
+            service_socket.sendall((str(size) + eof_token).encode('utf-8'))
+
+    def send_file(self, service_socket, file, offset, count) -> None:
+        """
+        Streams count bytes of an open binary file, starting at offset, to the client. Uses sendfile() so the kernel
+        copies straight from the page cache to the socket; where that is not available, a loop over one reusable
+        buffer. Either way memory use does not depend on the file size. A transfer with bandwidth limits (see
+        Session.shape()) is sent one chunk at a time.
+        :param service_socket: active socket (or Session) with the client
+        :param file: file object opened in binary mode
+        :param offset: position of the first byte to send
+        :param count: number of bytes to send
+        """
+        session = None
+        if isinstance(service_socket, Session):
+            session, service_socket = service_socket, service_socket.service_socket
+        if count <= 0:
+            return
+        if session is not None and session.shaped:
+            # One chunk at a time, each paid for by the session's bandwidth limits
+            sent = 0
+            while sent < count:
+                chunk = min(TRANSFER_CHUNK_SIZE, count - sent)
+                session.shape(chunk)
+                n = service_socket.sendfile(file, offset + sent, chunk)
+                if not n:
+                    break
+                sent += n
+        elif hasattr(os, "sendfile"):
+            sent = service_socket.sendfile(file, offset, count)
+        else:
+            sent = 0
+            buffer = memoryview(bytearray(min(TRANSFER_CHUNK_SIZE, count)))
+            file.seek(offset)
+            while sent < count:
+                n = file.readinto(buffer[:min(len(buffer), count - sent)])
+                if not n:
+                    break
+                service_socket.sendall(buffer[:n])
+                sent += n
+        if session is not None:
+            session.bytes_out += sent
+        if sent != count:
+            raise ConnectionError(f"File changed during transfer: sent {sent} of {count} bytes")
+
+    def send_message_file(self, service_socket, file, size, eof_token) -> None:
+        """
+        Sends the first size bytes of a binary file (UTF-8 text) as one message, streamed with send_file() instead
+        of being loaded into memory.
+        :param service_socket: active socket (or Session) with the client
+        :param file: binary file object holding the message text
+        :param size: length of the message in bytes
+        :param eof_token: a token to indicate the end of the message.
+        """
+        file.flush()
+        if isinstance(service_socket, Session):
+            service_socket.send_message_file(file, size)
+        else:
+            self.send_file(service_socket, file, 0, size)
+            service_socket.sendall(eof_token.encode('utf-8'))
+
+    def send_data(self, service_socket, file, offset, count, eof_token) -> None:
+        """
+        Sends the size header and then count bytes of an open binary file starting at offset. Sessions that
+        negotiated compression get the bytes as compressed blocks, unless a sample from the start of the range does
+        not compress; everything else goes through send_file().
+        :param service_socket: active socket (or Session) with the client
+        :param file: file object opened in binary mode
+        :param offset: position of the first byte to send
+        :param count: number of bytes to send
+        :param eof_token: a token to indicate the end of the message.
+        """
+        if isinstance(service_socket, Session) and service_socket.compresses(file, offset, count):
+            service_socket.send_compressed(file, offset, count)
+            return
+        self.send_size_header(service_socket, count, eof_token)
+        self.send_file(service_socket, file, offset, count)
+
+    def send_chunk(self, service_socket, data, eof_token) -> None:
+        """
+        Sends one chunk of a data stream: the tar archive of a dldir reply, as a series of size headers each followed
+        by their bytes, ended by an empty chunk. Sessions that negotiated compression get compressed chunks.
+        :param service_socket: active socket (or Session) with the client
+        :param data: at most TRANSFER_CHUNK_SIZE bytes; empty to end the stream
+        :param eof_token: a token to indicate the end of the message.
+        """
+        if isinstance(service_socket, Session):
+            service_socket.send_chunk(data)
+        else:
+            service_socket.sendall((str(len(data)) + eof_token).encode('utf-8') + bytes(data))
+
+    def send_error(self, service_socket, message, eof_token) -> None:
+        """
+        Reports a failed command. Only sessions that negotiated status replies (fast mode or v2 framing) get an error
+        frame; the original protocol has no way to signal errors, so nothing is sent there.
+        :param service_socket: active socket (or Session) with the client
+        :param message: description of the error
+        :param eof_token: a token to indicate the end of the message.
+        """
+        if isinstance(service_socket, Session):
+            service_socket.send_error(message)
+
     def handle_cd(self, current_working_directory, new_working_directory) -> str:
         """
         Handles the client cd commands. Reads the client command and changes the current_working_directory variable
@@ -145,156 +2198,686 @@ class Server:
         :return: absolute path of new current working directory
         """
         try:
-            if new_working_directory == "..":
-                new_dir = os.path.join(current_working_directory, "..")
-            else:
-                new_dir = os.path.join(current_working_directory, new_working_directory)
-            if os.path.exists(new_dir) and os.path.isdir(new_dir):
-                return os.path.abspath(new_dir)
+            if new_working_directory == "..":
+                new_dir = os.path.join(current_working_directory, "..")
+            else:
+                new_dir = os.path.join(current_working_directory, new_working_directory)
+            if os.path.exists(new_dir) and os.path.isdir(new_dir):
+                return os.path.abspath(new_dir)
+            else:
+                return current_working_directory
+        except Exception as e:
+            log.error("Error changing directory to {}: {}", new_working_directory, e)
+            return current_working_directory
+
+    def handle_mkdir(self, current_working_directory, directory_name, service_socket=None, eof_token=None) -> None:
+        """
+        Handles the client mkdir commands. Creates a new sub directory with the given name in the current working directory.
+        :param current_working_directory: string of current working directory
+        :param directory_name: name of new sub directory
+        :param service_socket: active socket (or Session) with the client, for the error reply (see send_error())
+        :param eof_token: a token to indicate the end of the message.
+        """
+        try:
+            os.mkdir(os.path.join(current_working_directory, directory_name))
+            self.search_index.update(os.path.join(current_working_directory, directory_name))
+        except Exception as e:
+            log.error("Error creating directory {}: {}", directory_name, e)
+            self.send_error(service_socket, f"Error creating directory {directory_name}: {e}", eof_token)
+        # raise NotImplementedError("Your implementation here.")
+
+    def handle_rm(self, current_working_directory, object_name, service_socket=None, eof_token=None) -> None:
+        """
+        Handles the client rm commands. Removes the given file or sub directory. Uses the appropriate removal method
+        based on the object type (directory/file).
+        :param current_working_directory: string of current working directory
+        :param object_name: name of sub directory or file to remove
+        :param service_socket: active socket (or Session) with the client, for the error reply (see send_error())
+        :param eof_token: a token to indicate the end of the message.
+        """
+        path = os.path.join(current_working_directory, object_name)
+        try:
+            linked = self.blobs.linked_inodes(path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.isfile(path):
+                os.remove(path)
+            else:
+                raise FileNotFoundError(f"No such file or directory: {object_name}")
+            self.blobs.release(linked)
+            self._file_changed(path)
+        except Exception as e:
+            log.error("Error removing {}: {}", object_name, e)
+            self.send_error(service_socket, f"Error removing {object_name}: {e}", eof_token)
+        # raise NotImplementedError("Your implementation here.")
+
+    def handle_ul(
+        self,
+        current_working_directory,
+        file_name,
+        service_socket,
+        eof_token,
+        expected_len=None,
+        initial_remainder=b"",
+    ) -> None:
+        """
+        Handles the client ul commands. It streams the payload, i.e. file content from the client, into a hidden temp file
+        in the current working directory and renames it over the target once every byte has arrived, so readers never
+        see a partial file and an aborted upload leaves nothing behind.
+        Use the helper method: receive_message_ending_with_token() to receive the message from the client.
+        :param current_working_directory: string of current working directory
+        :param file_name: name of the file to be created.
+        :param service_socket: active socket with the client to read the payload/contents from.
+        :param eof_token: a token to indicate the end of the message.
+        """
+        try:
+            # Ensure file is created within server's current directory
+            safe_name = os.path.basename(file_name)
+            file_path = os.path.join(current_working_directory, safe_name)
+            log.debug("[UL] Start: name={}", safe_name)
+            if expected_len is None:
+                # Backward compatibility: read size header now
+                size_bytes, remainder = self._read_frame_with_remainder(service_socket, 1024, eof_token)
+                size_str = size_bytes.decode('utf-8').strip()
+                expected_len = int(size_str)
+                init_bytes = remainder
+            else:
+                init_bytes = initial_remainder or b""
+            if expected_len < 0:
+                raise ValueError("Invalid file size")
+            log.debug("[UL] Size header ok: expected_len={}, remainder_after_header={}", expected_len, len(init_bytes))
+
+            # We may have already received part of the file in 'init_bytes'; more bytes than needed are truncated
+            init_bytes = init_bytes[:expected_len]
+            to_read = expected_len - len(init_bytes)
+            temp_path = os.path.join(current_working_directory, f".{safe_name}.{os.urandom(4).hex()}{UPLOAD_TEMP_SUFFIX}")
+            try:
+                f = open(temp_path, 'xb')
+            except OSError:
+                # Still consume the payload so the next command is read correctly
+                self._recv_into_file(service_socket, None, to_read)
+                raise
+            digest = hashlib.sha256(init_bytes)
+            try:
+                with f:
+                    f.write(init_bytes)
+                    if to_read > 0:
+                        log.debug("[UL] Reading exact bytes: to_read={}", to_read, sample="upload")
+                        self._recv_into_file(service_socket, f, to_read, digest)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+            self.blobs.commit(temp_path, file_path, digest.hexdigest())
+            self._file_changed(file_path)
+            log.info("[UL] Done for {}: wrote={} bytes at {}", safe_name, expected_len, file_path)
+        except Exception as e:
+            log.error("Error uploading file {}: {}", file_name, e)
+            self.send_error(service_socket, f"Error uploading file {file_name}: {e}", eof_token)
+            # service_socket.sendall((eof_token).encode('utf-8'))
+        # raise NotImplementedError("Your implementation here.")
+
+    def handle_dl(
+        self, current_working_directory, file_name, service_socket, eof_token
+    ) -> None:
+        """
+        Handles the client dl commands. First, it sends the size of the given file, then streams the file to the client via
+        the given socket (see send_file()).
+        :param current_working_directory: string of current working directory
+        :param file_name: name of the file to be sent to client
+        :param service_socket: active service socket with the client
+        :param eof_token: a token to indicate the end of the message.
+        """
+        header_sent = False
+        try:
+            # Ensure file path is based on server's cwd
+            safe_name = os.path.basename(file_name)
+            file_path = os.path.join(current_working_directory, safe_name)
+            with open(file_path, 'rb') as f:
+                file_size = os.fstat(f.fileno()).st_size
+                # Send size header, then stream the file bytes
+                header_sent = True
+                self.send_data(service_socket, f, 0, file_size, eof_token)
+        except Exception as e:
+            log.error("Error downloading file {}: {}", file_name, e)
+            # Once the header is out the client expects raw bytes, so an error reply would corrupt the stream
+            if not header_sent:
+                self.send_error(service_socket, f"Error downloading file {file_name}: {e}", eof_token)
+            # service_socket.sendall((eof_token).encode('utf-8'))
+        # raise NotImplementedError("Your implementation here.")
+
+    def handle_dl_range(
+        self, current_working_directory, file_name, offset, length, service_socket, eof_token
+    ) -> None:
+        """
+        Handles the client dlrange commands, used to resume downloads. First, it sends "<file size> <mtime_ns>" so the
+        client can tell whether the file changed since its previous attempt, then the size header and up to length
+        bytes of the file starting at offset.
+        :param current_working_directory: string of current working directory
+        :param file_name: name of the file to be sent to client
+        :param offset: position of the first byte to send
+        :param length: maximum number of bytes to send; negative means up to the end of the file
+        :param service_socket: active service socket with the client
+        :param eof_token: a token to indicate the end of the message.
+        """
+        header_sent = False
+        try:
+            safe_name = os.path.basename(file_name)
+            file_path = os.path.join(current_working_directory, safe_name)
+            with open(file_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if not 0 <= offset <= stat.st_size:
+                    raise ValueError(f"offset {offset} is outside the file ({stat.st_size} bytes)")
+                count = stat.st_size - offset
+                if length >= 0:
+                    count = min(count, length)
+                self.send_message(service_socket, f"{stat.st_size} {stat.st_mtime_ns}", eof_token)
+                header_sent = True
+                self.send_data(service_socket, f, offset, count, eof_token)
+        except Exception as e:
+            log.error("Error downloading file {}: {}", file_name, e)
+            if not header_sent:
+                self.send_error(service_socket, f"Error downloading file {file_name}: {e}", eof_token)
+
+    def _resume_path(self, current_working_directory, file_name, digest) -> str:
+        """
+        Path of the partial file kept for a resumable upload of file_name whose complete contents have the given
+        SHA-256, so that an interrupted upload of other contents under the same name is never resumed from.
+        """
+        if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+            raise ValueError(f"Invalid SHA-256 {digest!r}")
+        return os.path.join(
+            current_working_directory, f".{os.path.basename(file_name)}.{digest[:16]}.resume{UPLOAD_TEMP_SUFFIX}"
+        )
+
+    def _resume_hash(self, partial_path, file, offset):
+        """
+        The running SHA-256 of the first offset bytes of a resumable upload's partial file: the one kept when the
+        previous chunk ended at offset, or else computed by reading those bytes from file (open for reading).
+        """
+        with self._resume_hashes_lock:
+            held, digest = self._resume_hashes.pop(partial_path, (None, None))
+        if held == offset:
+            return digest
+        digest = hashlib.sha256()
+        buffer = memoryview(bytearray(min(TRANSFER_CHUNK_SIZE, offset)))
+        file.seek(0)
+        remaining = offset
+        while remaining > 0:
+            n = file.readinto(buffer[:min(len(buffer), remaining)])
+            if not n:
+                raise ValueError(f"partial file ends before offset {offset}")
+            digest.update(buffer[:n])
+            remaining -= n
+        file.seek(offset)
+        return digest
+
+    def handle_ul_status(self, current_working_directory, file_name, digest, service_socket, eof_token) -> None:
+        """
+        Handles the client ulstat commands. Sends the number of bytes of a resumable upload of file_name with the given
+        SHA-256 that the server already holds (0 if there is none), i.e. the offset to continue from.
+        :param current_working_directory: string of current working directory
+        :param file_name: name of the file being uploaded
+        :param digest: SHA-256 of the complete file as hex
+        :param service_socket: active service socket with the client
+        :param eof_token: a token to indicate the end of the message.
+        """
+        try:
+            partial_path = self._resume_path(current_working_directory, file_name, digest)
+        except ValueError as e:
+            self.send_error(service_socket, f"Error checking upload of {file_name}: {e}", eof_token)
+            return
+        try:
+            held = os.path.getsize(partial_path)
+        except OSError:
+            held = 0
+        self.send_message(service_socket, str(held), eof_token)
+
+    def handle_ul_hash(self, current_working_directory, file_name, digest, size, service_socket, eof_token) -> None:
+        """
+        Handles the client ulhash commands, sent before an upload: if the blob store already holds a file with the
+        given SHA-256 and size, file_name is linked to it and "linked" is sent, so the client skips the upload;
+        otherwise "missing" is sent.
+        :param current_working_directory: string of current working directory
+        :param file_name: name of the file about to be uploaded
+        :param digest: SHA-256 of the file as hex
+        :param size: size of the file
+        :param service_socket: active service socket with the client
+        :param eof_token: a token to indicate the end of the message.
+        """
+        file_path = os.path.join(current_working_directory, os.path.basename(file_name))
+        linked = len(digest) == 64 and all(c in "0123456789abcdef" for c in digest) and self.blobs.link(
+            digest, size, file_path
+        )
+        if linked:
+            self._file_changed(file_path)
+            log.info("[UL] {} already stored as {}; linked without upload", file_name, digest)
+        self.send_message(service_socket, "linked" if linked else "missing", eof_token)
+
+    def handle_ul_at(
+        self, current_working_directory, file_name, offset, total_size, digest, service_socket, eof_token,
+        expected_len,
+    ) -> None:
+        """
+        Handles the client ulat commands. Writes the payload at offset into the partial file of a resumable upload,
+        keeping whatever arrived if the connection drops, and renames it over file_name once it holds total_size
+        bytes whose SHA-256 is digest (a partial that does not match is discarded). Then it sends the number of bytes
+        now held.
+        :param current_working_directory: string of current working directory
+        :param file_name: name of the file being uploaded
+        :param offset: position of the first payload byte; at most the number of bytes already held
+        :param total_size: size of the complete file
+        :param digest: SHA-256 of the complete file as hex
+        :param service_socket: active socket with the client to read the payload from.
+        :param eof_token: a token to indicate the end of the message.
+        :param expected_len: number of payload bytes that follow
+        """
+        try:
+            file_path = os.path.join(current_working_directory, os.path.basename(file_name))
+            try:
+                partial_path = self._resume_path(current_working_directory, file_name, digest)
+                if offset < 0 or offset + expected_len > total_size:
+                    raise ValueError(f"{offset} + {expected_len} bytes is more than the file size {total_size}")
+                f = open(partial_path, 'wb' if offset == 0 else 'r+b')
+            except Exception:
+                # Still consume the payload so the next command is read correctly
+                self._recv_into_file(service_socket, None, expected_len)
+                raise
+            with f:
+                held = os.fstat(f.fileno()).st_size
+                if offset > held:
+                    self._recv_into_file(service_socket, None, expected_len)
+                    raise ValueError(f"offset {offset} is past the {held} bytes held")
+                f.truncate(offset)
+                f.seek(offset)
+                running = self._resume_hash(partial_path, f, offset)
+                self._recv_into_file(service_socket, f, expected_len, running)
+            held = offset + expected_len
+            if held < total_size:
+                with self._resume_hashes_lock:
+                    self._resume_hashes[partial_path] = (held, running)
+                    while len(self._resume_hashes) > RESUME_HASHES_KEPT:
+                        self._resume_hashes.popitem(last=False)
             else:
-                return current_working_directory
+                if running.hexdigest() != digest:
+                    os.remove(partial_path)
+                    raise ValueError("the uploaded bytes do not match the file's SHA-256; upload it again")
+                self.blobs.commit(partial_path, file_path, digest)
+                self._file_changed(file_path)
+                # Interrupted uploads of other versions of the file are superseded now
+                for stale_path in glob.glob(os.path.join(
+                    glob.escape(current_working_directory),
+                    f".{glob.escape(os.path.basename(file_name))}.*.resume{UPLOAD_TEMP_SUFFIX}",
+                )):
+                    os.remove(stale_path)
+                    with self._resume_hashes_lock:
+                        self._resume_hashes.pop(stale_path, None)
+                log.info("[UL] Resumable upload of {} complete: {} bytes at {}", file_name, total_size, file_path)
+            self.send_message(service_socket, str(held), eof_token)
         except Exception as e:
-            print(f"Error changing directory to {new_working_directory}: {e}")
-            return current_working_directory
+            log.error("Error uploading file {}: {}", file_name, e)
+            self.send_error(service_socket, f"Error uploading file {file_name}: {e}", eof_token)
 
-    def handle_mkdir(self, current_working_directory, directory_name) -> None:
+    def handle_ul_stripe(
+        self, current_working_directory, file_name, upload_id, offset, total_size, service_socket, eof_token,
+        expected_len,
+    ) -> None:
         """
-        Handles the client mkdir commands. Creates a new sub directory with the given name in the current working directory.
+        Handles the client ulstripe commands: one stripe of an upload that the client sends over several sessions at
+        once. The first stripe to arrive preallocates a hidden partial file of total_size bytes; every stripe
+        pwrite()s its payload at its offset. When the stripes received so far cover the whole file it is renamed
+        into place. Then it sends "committed" or "stored". If any stripe fails, the whole upload is discarded.
         :param current_working_directory: string of current working directory
-        :param directory_name: name of new sub directory
+        :param file_name: name of the file being uploaded
+        :param upload_id: identifier shared by all stripes of one upload (letters and digits)
+        :param offset: position of this stripe in the file
+        :param total_size: size of the complete file
+        :param service_socket: active socket with the client to read the payload from.
+        :param eof_token: a token to indicate the end of the message.
+        :param expected_len: number of payload bytes that follow
         """
+        safe_name = os.path.basename(file_name)
+        partial_path = os.path.join(
+            current_working_directory, f".{safe_name}.{upload_id}.stripe{UPLOAD_TEMP_SUFFIX}"
+        )
+        payload_read = False
+        committed = False
         try:
-            os.mkdir(os.path.join(current_working_directory, directory_name))
+            if not upload_id.isalnum():
+                raise ValueError(f"invalid upload id {upload_id!r}")
+            if offset < 0 or offset + expected_len > total_size:
+                raise ValueError(f"{offset} + {expected_len} bytes is outside the file size {total_size}")
+            with self._stripes_lock:
+                upload = self._stripes.get(partial_path)
+                if upload is None:
+                    fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+                    try:
+                        if hasattr(os, "posix_fallocate") and total_size:
+                            os.posix_fallocate(fd, 0, total_size)
+                        else:
+                            os.ftruncate(fd, total_size)
+                    finally:
+                        os.close(fd)
+                    upload = self._stripes[partial_path] = {"total": total_size, "ranges": []}
+                elif upload["total"] != total_size:
+                    raise ValueError(f"total size {total_size} does not match the upload ({upload['total']})")
+            fd = os.open(partial_path, os.O_WRONLY)
+            try:
+                payload_read = True
+                self._recv_at(service_socket, fd, offset, expected_len)
+            finally:
+                os.close(fd)
+            with self._stripes_lock:
+                if self._stripes.get(partial_path) is not upload:
+                    raise ConnectionError("another stripe of this upload failed")
+                upload["ranges"].append((offset, expected_len))
+                covered = 0
+                for start, length in sorted(upload["ranges"]):
+                    if start > covered:
+                        break
+                    covered = max(covered, start + length)
+                committed = covered >= total_size
+                if committed:
+                    del self._stripes[partial_path]
+            if committed:
+                self.blobs.commit(partial_path, os.path.join(current_working_directory, safe_name))
+                self._file_changed(os.path.join(current_working_directory, safe_name))
+                log.info("[UL] Striped upload of {} complete: {} bytes", file_name, total_size)
+            self.send_message(service_socket, "committed" if committed else "stored", eof_token)
         except Exception as e:
-            print(f"Error creating directory {directory_name}: {e}")
-        # raise NotImplementedError("Your implementation here.")
+            log.error("Error uploading stripe of {}: {}", file_name, e)
+            if not payload_read:
+                # Still consume the payload so the next command is read correctly
+                try:
+                    self._recv_into_file(service_socket, None, expected_len)
+                except OSError:
+                    pass
+            with self._stripes_lock:
+                discard = self._stripes.pop(partial_path, None) is not None or committed
+                if discard and os.path.exists(partial_path):
+                    os.remove(partial_path)
+            self.send_error(service_socket, f"Error uploading stripe of {file_name}: {e}", eof_token)
+
+    def _tree_root(self, current_working_directory, directory_name) -> str:
+        """Path of the directory a uldir/dldir command names, in the current working directory."""
+        safe_name = os.path.basename(directory_name.rstrip("/"))
+        if safe_name in ("", ".", "..", BLOB_DIR_NAME, INDEX_DIR_NAME) or safe_name.endswith(UPLOAD_TEMP_SUFFIX):
+            raise ValueError(f"Invalid directory name {directory_name!r}")
+        return os.path.join(current_working_directory, safe_name)
 
-    def handle_rm(self, current_working_directory, object_name) -> None:
+    def handle_uldir(self, current_working_directory, directory_name, service_socket, eof_token) -> None:
         """
-        Handles the client rm commands. Removes the given file or sub directory. Uses the appropriate removal method
-        based on the object type (directory/file).
+        Handles the client uldir commands: a whole directory tree uploaded as one tar stream (see
+        Session.read_chunks()), unpacked as it arrives into directory_name in the current working directory, merging
+        with what is already there. Like ul, every file streams into a hidden temp file that is committed to the blob
+        store once complete. Only directories and regular files are created. Then it sends "<files> <bytes>".
         :param current_working_directory: string of current working directory
-        :param object_name: name of sub directory or file to remove
+        :param directory_name: name of the directory to create or update
+        :param service_socket: active socket with the client to read the stream from.
+        :param eof_token: a token to indicate the end of the message.
         """
-        path = os.path.join(current_working_directory, object_name)
+        chunks = service_socket.read_chunks()
+        files = size = 0
+        root = None
         try:
-            if os.path.isdir(path):
-                shutil.rmtree(path)
-            elif os.path.isfile(path):
-                os.remove(path)
+            root = self._tree_root(current_working_directory, directory_name)
+            os.makedirs(root, exist_ok=True)
+            # Directories known to exist, so that each is only created once
+            directories = {root}
+            with tarfile.open(fileobj=ChunkReader(chunks), mode="r|") as tar:
+                for member in tar:
+                    path = tree_path(root, member.name)
+                    if member.isdir():
+                        if path not in directories:
+                            os.makedirs(path, exist_ok=True)
+                            directories.add(path)
+                        continue
+                    if not member.isfile():
+                        log.warning("[ULDIR] Skipping {}: not a regular file or directory", member.name)
+                        continue
+                    directory, name = os.path.split(path)
+                    if directory not in directories:
+                        os.makedirs(directory, exist_ok=True)
+                        directories.add(directory)
+                    temp_path = os.path.join(directory, f".{name}.{os.urandom(4).hex()}{UPLOAD_TEMP_SUFFIX}")
+                    digest = hashlib.sha256()
+                    source = tar.extractfile(member)
+                    try:
+                        with open(temp_path, 'xb') as f:
+                            while data := source.read(TRANSFER_CHUNK_SIZE):
+                                f.write(data)
+                                digest.update(data)
+                    except BaseException:
+                        os.remove(temp_path)
+                        raise
+                    self.blobs.commit(temp_path, path, digest.hexdigest())
+                    files += 1
+                    size += member.size
+            log.info("[ULDIR] Done for {}: {} files, {} bytes", directory_name, files, size)
+            self.send_message(service_socket, f"{files} {size}", eof_token)
         except Exception as e:
-            print(f"Error removing {object_name}: {e}")
-        # raise NotImplementedError("Your implementation here.")
+            log.error("Error uploading directory {}: {}", directory_name, e)
+            self.send_error(service_socket, f"Error uploading directory {directory_name}: {e}", eof_token)
+        finally:
+            # Still consume the rest of the stream so the next command is read correctly
+            for _ in chunks:
+                pass
+            if root is not None:
+                self._file_changed(root)
 
-    def handle_ul(
-        self,
-        current_working_directory,
-        file_name,
-        service_socket,
-        eof_token,
-        expected_len=None,
-        initial_remainder=b"",
-    ) -> None:
+    def handle_dldir(self, current_working_directory, directory_name, service_socket, eof_token) -> None:
         """
-        Handles the client ul commands. First, it reads the payload, i.e. file content from the client, then creates the
-        file in the current working directory.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the client.
+        Handles the client dldir commands: sends the tree below directory_name as one tar stream, packed while it is
+        sent (see send_chunk()), then "<files> <bytes>". Only directories and regular files are sent. An error
+        before the stream starts replaces it; one during the stream ends it early and replaces "<files> <bytes>".
         :param current_working_directory: string of current working directory
-        :param file_name: name of the file to be created.
-        :param service_socket: active socket with the client to read the payload/contents from.
+        :param directory_name: name of the directory to send
+        :param service_socket: active service socket with the client
         :param eof_token: a token to indicate the end of the message.
         """
+        writer = ChunkWriter(lambda chunk: self.send_chunk(service_socket, chunk, eof_token))
+        files = size = 0
         try:
-            # Ensure file is created within server's current directory
-            safe_name = os.path.basename(file_name)
-            file_path = os.path.join(current_working_directory, safe_name)
-            print(f"[UL] Start: name={safe_name}")
-            if expected_len is None:
-                # Backward compatibility: read size header now
-                size_bytes, remainder = self._read_frame_with_remainder(service_socket, 1024, eof_token)
-                size_str = size_bytes.decode('utf-8').strip()
-                expected_len = int(size_str)
-                init_bytes = remainder
-            else:
-                init_bytes = initial_remainder or b""
-            if expected_len < 0:
-                raise ValueError("Invalid file size")
-            print(f"[UL] Size header ok: expected_len={expected_len}, remainder_after_header={len(init_bytes)}")
-
-            # We may have already received part of the file in 'init_bytes'
-            received = bytearray(init_bytes)
-            to_read = expected_len - len(received)
-            if to_read < 0:
-                # More bytes than needed were already read; truncate the extra
-                received = received[:expected_len]
-                to_read = 0
-
-            if to_read > 0:
-                print(f"[UL] Reading exact bytes: to_read={to_read}")
-                received.extend(self._recv_exact(service_socket, to_read))
-
-            with open(file_path, 'wb') as f:
-                f.write(received)
-            print(f"[UL] Done for {safe_name}: wrote={len(received)} bytes at {file_path}")
+            root = self._tree_root(current_working_directory, directory_name)
+            if not os.path.isdir(root):
+                raise NotADirectoryError(f"{directory_name} is not a directory")
+            with tarfile.open(fileobj=writer, mode="w", format=tarfile.GNU_FORMAT,
+                              copybufsize=TRANSFER_CHUNK_SIZE) as tar:
+                for entry, name in tree_entries(root):
+                    info = tarfile.TarInfo(name)
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                        f = None if entry.is_dir(follow_symlinks=False) else open(entry.path, 'rb')
+                    except OSError as e:
+                        log.warning("[DLDIR] Skipping {}: {}", name, e)
+                        continue
+                    info.mtime = stat.st_mtime
+                    info.mode = stat.st_mode & 0o7777
+                    if f is None:
+                        info.type = tarfile.DIRTYPE
+                        tar.addfile(info)
+                        continue
+                    with f:
+                        info.size = os.fstat(f.fileno()).st_size
+                        tar.addfile(info, f)
+                    files += 1
+                    size += info.size
+            writer.flush()
+            self.send_chunk(service_socket, b"", eof_token)
+            log.info("[DLDIR] Done for {}: {} files, {} bytes", directory_name, files, size)
+            self.send_message(service_socket, f"{files} {size}", eof_token)
         except Exception as e:
-            print(f"Error uploading file {file_name}: {e}")
-            # service_socket.sendall((eof_token).encode('utf-8'))
-        # raise NotImplementedError("Your implementation here.")
+            log.error("Error downloading directory {}: {}", directory_name, e)
+            if writer.sent:
+                # The client is reading the stream: end it early
+                self.send_chunk(service_socket, b"", eof_token)
+            self.send_error(service_socket, f"Error downloading directory {directory_name}: {e}", eof_token)
 
-    def handle_dl(
-        self, current_working_directory, file_name, service_socket, eof_token
-    ) -> None:
+    def handle_ul_delta(self, current_working_directory, file_name, service_socket, eof_token) -> None:
         """
-        Handles the client dl commands. First, it loads the given file as binary, then sends it to the client via the
-        given socket.
+        Handles the client uldelta commands, an upload that only sends what changed since the server's copy. First,
+        it sends "<block size> <size of the server's copy>" (0 if there is none) and the DELTA_SIGNATURE of each block
+        as a data stream (see send_chunk()). The client answers with a data stream of DELTA_OP records (see
+        Session.read_chunks()), from which the new file is rebuilt into a hidden temp file, checked against the
+        client's SHA-256 and committed to the blob store like ul. Then it sends "<literal bytes> <copied bytes>".
         :param current_working_directory: string of current working directory
-        :param file_name: name of the file to be sent to client
-        :param service_socket: active service socket with the client
+        :param file_name: name of the file to be updated or created
+        :param service_socket: active socket with the client
         :param eof_token: a token to indicate the end of the message.
         """
+        safe_name = os.path.basename(file_name)
+        file_path = os.path.join(current_working_directory, safe_name)
+        basis = writer = chunks = None
         try:
-            # Ensure file path is based on server's cwd
-            safe_name = os.path.basename(file_name)
-            file_path = os.path.join(current_working_directory, safe_name)
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-            # Send size header (token-terminated), then raw file bytes
-            service_socket.sendall((str(len(file_data)) + eof_token).encode('utf-8'))
-            service_socket.sendall(file_data)
+            try:
+                basis = open(file_path, 'rb')
+            except FileNotFoundError:
+                pass
+            basis_size = os.fstat(basis.fileno()).st_size if basis is not None else 0
+            block_size = delta_block_size(basis_size)
+            self.send_message(service_socket, f"{block_size} {basis_size}", eof_token)
+            writer = ChunkWriter(lambda chunk: self.send_chunk(service_socket, chunk, eof_token))
+            if basis is not None:
+                for signatures in block_signatures(basis, block_size):
+                    writer.write(signatures)
+            writer.flush()
+            self.send_chunk(service_socket, b"", eof_token)
+            writer = None
+            chunks = service_socket.read_chunks()
+            temp_path = os.path.join(current_working_directory, f".{safe_name}.{os.urandom(4).hex()}{UPLOAD_TEMP_SUFFIX}")
+            digest = hashlib.sha256()
+            try:
+                with open(temp_path, 'xb') as f:
+                    literal, copied = apply_delta(ChunkReader(chunks), basis, block_size, f, digest)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            self.blobs.commit(temp_path, file_path, digest.hexdigest())
+            self._file_changed(file_path)
+            log.info("[UL] Delta upload of {} done: {} literal bytes, {} bytes reused", safe_name, literal, copied)
+            self.send_message(service_socket, f"{literal} {copied}", eof_token)
         except Exception as e:
-            print(f"Error downloading file {file_name}: {e}")
-            # service_socket.sendall((eof_token).encode('utf-8'))
-        # raise NotImplementedError("Your implementation here.")
+            log.error("Error uploading file {}: {}", file_name, e)
+            if writer is not None:
+                # The client is reading the signatures: end them early; its answer is still read below
+                self.send_chunk(service_socket, b"", eof_token)
+                chunks = service_socket.read_chunks()
+            self.send_error(service_socket, f"Error uploading file {file_name}: {e}", eof_token)
+        finally:
+            # Consume the rest of the stream (at least the empty chunk after DELTA_END) so the next command is read
+            # correctly
+            if chunks is not None:
+                for _ in chunks:
+                    pass
+            if basis is not None:
+                basis.close()
 
     def handle_search(
         self, current_working_directory, file_name, wordslist, service_socket, eof_token
     ) -> None:
         """
         Handles the search  commands. First, it opens the file and  perform search, then sends  the dictionary of words with their the number of case-insensitive matches i.e {  token1: 5, token2: 6, ...,}. to the client via the given socket.
+        Counts come from the file's frequency table (see TokenCache), so the cost does not grow with the number of
+        search words. If file_name is a glob pattern ('*' for every file in the directory), the reply has a
+        "== <file>" section for each matching text file and a final "== total" section.
         :param current_working_directory: string of current working directory
-        :param file_name: name of the file to be sent to client
+        :param file_name: name of the file to be sent to client, or a glob pattern
         :param wordslist: list of search words
         :param service_socket: active service socket with the client
         :param eof_token: a token to indicate the end of the message.
         """
         try:
-            with open(os.path.join(current_working_directory, file_name), 'r') as f:
-                text = f.read().lower()
-            words = [word.strip('.,;:!?()[]{}"\'') for word in text.split()]
-            word_count = {word: words.count(word.lower()) for word in wordslist}
-            result = "\n".join([f"{word}: {count}" for word, count in word_count.items()])
-            service_socket.sendall((result + eof_token).encode('utf-8'))
+            path = os.path.join(current_working_directory, file_name)
+            # Repeated words get one line in the reply either way
+            key = ("search", os.path.abspath(path), tuple(dict.fromkeys(wordslist)))
+            is_glob = any(c in file_name for c in "*?[") and not os.path.exists(path)
+            if is_glob:
+                # Cached against the deepest directory the pattern cannot reach outside of, so that the server's own
+                # changes below it drop the reply
+                directory = key[1]
+                while any(c in directory for c in "*?["):
+                    directory = os.path.dirname(directory)
+                glob_pattern = os.path.join(glob.escape(current_working_directory), file_name)
+                match_paths = sorted(glob.glob(glob_pattern))
+                key = ("search", directory, (key[1],) + key[2], reply_fingerprint(match_paths))
+            else:
+                key += (_file_key(path)[1:],)
+            if self._send_cached_reply(service_socket, key, eof_token):
+                return
+            generation = self.response_cache.generation
+            if not is_glob:
+                result = self._format_search(self._search_file(path, wordslist))
+            else:
+                totals = dict.fromkeys(wordslist, 0)
+                sections = []
+                for match_path in match_paths:
+                    name = os.path.relpath(match_path, current_working_directory)
+                    if not os.path.isfile(match_path) or name.endswith(UPLOAD_TEMP_SUFFIX) \
+                            or not looks_like_text(match_path):
+                        continue
+                    try:
+                        word_count = self._search_file(match_path, wordslist)
+                    except OSError as e:
+                        log.warning("Skipping {} in search: {}", name, e)
+                        continue
+                    for word, count in word_count.items():
+                        totals[word] += count
+                    sections.append(f"== {name}\n" + self._format_search(word_count))
+                sections.append("== total\n" + self._format_search(totals))
+                result = "\n".join(sections)
+            self._send_new_reply(service_socket, key, generation, result, eof_token, directory=is_glob)
         except Exception as e:
-            print(f"Error searching in {file_name}: {e}")
+            log.error("Error searching in {}: {}", file_name, e)
+            self.send_error(service_socket, f"Error searching in {file_name}: {e}", eof_token)
             # service_socket.sendall((eof_token).encode('utf-8'))
         # raise NotImplementedError("Your implementation here.")
 
+    def _search_file(self, path, wordslist) -> dict[str, int]:
+        """Number of case-insensitive matches of each search word in the file at path."""
+        frequencies = self._token_stats("search", path).frequencies
+        return {word: frequencies.get(word.lower(), 0) for word in wordslist}
+
+    def _format_search(self, word_count) -> str:
+        return "\n".join([f"{word}: {count}" for word, count in word_count.items()])
+
+    def handle_gsearch(self, wordslist, service_socket, eof_token) -> None:
+        """
+        Handles the gsearch commands: which files of the whole served tree contain each word, and how often
+        (case-insensitive), answered from the search index (see SearchIndex) instead of reading any file.
+        The reply has a "== <word>" section per word with a "<path>: <count>" line per file, most matches first;
+        paths are relative to the directory the server started in.
+        :param wordslist: list of search words
+        :param service_socket: active service socket with the client
+        :param eof_token: a token to indicate the end of the message.
+        """
+        try:
+            results = self.search_index.search([word.lower() for word in wordslist])
+            sections = [
+                "\n".join([f"== {word}"] + [f"{path}: {count}" for path, count in results[word.lower()]])
+                for word in wordslist
+            ]
+            self.send_message(service_socket, "\n".join(sections), eof_token)
+        except Exception as e:
+            log.error("Error in global search: {}", e)
+            self.send_error(service_socket, f"Error in global search: {e}", eof_token)
+
+    def handle_stats(self, service_socket, eof_token) -> None:
+        """
+        Handles the stats commands: sends the server's metrics (see Metrics) in the Prometheus text format, the same
+        text the metrics endpoint serves.
+        :param service_socket: active service socket with the client
+        :param eof_token: a token to indicate the end of the message.
+        """
+        self.send_message(service_socket, self.metrics_text(), eof_token)
+
     def handle_split(
         self, current_working_directory, file_name, splitlist, service_socket, eof_token
     ) -> None:
         """
         Handles the split  commands. First, it opens the file and perform search, then save the splits into files with naming pattern {filename}_split_{split number}.txt
         then sends the number of splits to the client via the given socket.
+        The file is split in one streaming pass (see split_file()) and every split is written as it is found, so
+        memory use does not depend on the file size. The work is done by run_analytics().
         :param current_working_directory: string of current working directory
         :param file_name: name of the file to be sent to client
         :param splitlist: list of split words
@@ -302,33 +2885,21 @@ class Server:
         :param eof_token: a token to indicate the end of the message.
         """
         try:
-            with open(os.path.join(current_working_directory, file_name), 'r') as f:
-                text = f.read().lower()
-            
-            # Initialize splits with the entire text
-            splits = [text]
-            
-            # For each split word, further split all current segments
-            for split_word in splitlist:
-                new_splits = []
-                for segment in splits:
-                    # Split the segment by the current split word and filter out empty segments
-                    parts = [part for part in segment.split(split_word.strip()) if part.strip()]
-                    new_splits.extend(parts)
-                splits = new_splits
-            
-            # Write each split to a file
-            for i, split in enumerate(splits):
-                split_file_name = f"{file_name}_split_{i+1}.txt"
-                with open(os.path.join(current_working_directory, split_file_name), 'w') as sf:
-                    sf.write(split)
-                    print(split_file_name + " with")
-                    print("'" + split + "'\n")
-            
+            path = os.path.join(current_working_directory, file_name)
+            count, replaced = self.run_analytics(
+                "split", split_file, path, [split_word.strip() for split_word in splitlist]
+            )
+            for split_path, linked in replaced:
+                self.blobs.release(linked)
+            # New and replaced split files alike
+            for n in range(1, count + 1):
+                self._file_changed(f"{path}_split_{n}.txt")
+
             # Send the number of splits back to the client
-            service_socket.sendall((str(len(splits)) + eof_token).encode('utf-8'))
+            self.send_message(service_socket, str(count), eof_token)
         except Exception as e:
-            print(f"Error splitting {file_name}: {e}")
+            log.error("Error splitting {}: {}", file_name, e)
+            self.send_error(service_socket, f"Error splitting {file_name}: {e}", eof_token)
             # service_socket.sendall(("0" + eof_token).encode('utf-8'))
 
     def handle_wordsort(
@@ -337,6 +2908,9 @@ class Server:
         """
         Handles the wordsort commands. First, it opens the file and perform unique listing for words then sort them,  then sends the list of alphabetically sorted words via the
         to the client via the given socket.
+        Files larger than external_analytics_bytes are sorted in external memory (see sorted_unique_words()) and the
+        reply is spooled to a temp file and streamed from there. Files of parallel_analytics_bytes and more are
+        tokenized on several processes at once (see _parallel_ranges()).
         :param current_working_directory: string of current working directory
         :param file_name: name of the file to be sent to client
         :param splitlist: list of split words
@@ -344,15 +2918,27 @@ class Server:
         :param eof_token: a token to indicate the end of the message.
         """
         try:
-            with open(os.path.join(current_working_directory, file_name), 'r') as f:
-                text = f.read().lower()
-            words = [word.strip('.,;:!?()[]{}"\'') for word in text.split()]
-            unique_words = set(words)
-            sorted_words = sorted(unique_words)
-            result = "\n".join(sorted_words)
-            service_socket.sendall((result + eof_token).encode('utf-8'))
+            path = os.path.join(current_working_directory, file_name)
+            key = ("wordsort", os.path.abspath(path), (), _file_key(path)[1:])
+            if self._send_cached_reply(service_socket, key, eof_token):
+                return
+            generation = self.response_cache.generation
+            if os.path.getsize(path) <= self.external_analytics_bytes:
+                sorted_words = self._token_stats("wordsort", path).sorted_words
+                result = "\n".join(sorted_words)
+                self._send_new_reply(service_socket, key, generation, result, eof_token)
+                return
+            with tempfile.TemporaryDirectory() as work_dir:
+                size = self._external_analytics("wordsort", path, work_dir)
+                with open(os.path.join(work_dir, "reply"), 'rb') as reply:
+                    if size <= self.response_cache.budget // RESPONSE_CACHE_ENTRY_SHARE:
+                        entry = self.response_cache.put(key, reply.read(size), generation)
+                        self.send_cached(service_socket, entry, eof_token)
+                    else:
+                        self.send_message_file(service_socket, reply, size, eof_token)
         except Exception as e:
-            print(f"Error sorting words in {file_name}: {e}")
+            log.error("Error sorting words in {}: {}", file_name, e)
+            self.send_error(service_socket, f"Error sorting words in {file_name}: {e}", eof_token)
             # service_socket.sendall((eof_token).encode('utf-8'))
         # raise NotImplementedError("Your implementation here.")
 
@@ -361,6 +2947,8 @@ class Server:
     ) -> None:
         """
         Handles the wordcount commands. First, it opens the file and perform unique listing for words and count them,  then sends the count of unique words to the client via the given socket.
+        Files larger than external_analytics_bytes are counted in external memory (see sorted_unique_words()). Files of
+        parallel_analytics_bytes and more are tokenized on several processes at once (see _parallel_ranges()).
         :param current_working_directory: string of current working directory
         :param file_name: name of the file to be sent to client
         :param splitlist: list of split words
@@ -368,17 +2956,45 @@ class Server:
         :param eof_token: a token to indicate the end of the message.
         """
         try:
-            with open(os.path.join(current_working_directory, file_name), 'r') as f:
-                text = f.read().lower()
-            words = [word.strip('.,;:!?()[]{}"\'') for word in text.split()]
-            unique_words = set(words)
-            count = len(unique_words)
-            service_socket.sendall((str(count) + eof_token).encode('utf-8'))
+            path = os.path.join(current_working_directory, file_name)
+            key = ("wordcount", os.path.abspath(path), (), _file_key(path)[1:])
+            if self._send_cached_reply(service_socket, key, eof_token):
+                return
+            generation = self.response_cache.generation
+            if os.path.getsize(path) <= self.external_analytics_bytes:
+                count = len(self._token_stats("wordcount", path).frequencies)
+            else:
+                with tempfile.TemporaryDirectory() as work_dir:
+                    count = self._external_analytics("wordcount", path, work_dir)
+            self._send_new_reply(service_socket, key, generation, str(count), eof_token)
         except Exception as e:
-            print(f"Error counting words in {file_name}: {e}")
+            log.error("Error counting words in {}: {}", file_name, e)
+            self.send_error(service_socket, f"Error counting words in {file_name}: {e}", eof_token)
             # service_socket.sendall(("0" + eof_token).encode('utf-8'))
 
-class ClientThread(Thread):
+
+class Session:
+    """
+    Per-connection state shared by both server engines: the client's working directory, its EOF token and the bytes
+    read past the last frame. A Session is also what the handle_* methods receive as their service_socket, so recv()
+    first drains bytes that were buffered while reading a command frame.
+    """
+    # Outcomes of execute()
+    LISTING = "listing"  # send the directory listing after the command delay
+    NO_REPLY = "no_reply"  # nothing more to send for this command
+    CLOSE = "close"  # the session is over
+    # Optional protocol features a client can ask for with "hello <features>"
+    FEATURES = ("fast", "v2", "range", "stripe", "dedup", "tree", "delta")
+    # Features whose commands report a failed step with an error reply (fast mode or v2 framing), accepted only
+    # together with one of those: without them the client would take the next reply (e.g. the listing) for the
+    # answer it waits for, or a data stream would be left half-read
+    ERROR_REPLY_FEATURES = ("range", "stripe", "dedup", "tree", "delta")
+    # Command names the metrics are kept under; anything else is recorded as "unknown"
+    COMMANDS = (
+        "hello", "ls", "mkdir", "cd", "ul", "ulhash", "ulstat", "ulat", "ulstripe", "uldir", "uldelta", "dl", "dlrange",
+        "dldir", "wordcount", "wordsort", "search", "gsearch", "split", "rm", "stats", "exit"
+    )
+
     def __init__(
         self,
         server: Server,
@@ -386,154 +3002,1053 @@ class ClientThread(Thread):
         address: str,
         eof_token: str,
     ):
-        Thread.__init__(self)
         self.server_obj = server
         self.service_socket = service_socket
         self.address = address
         self.eof_token = eof_token
+        self.current_working_directory = os.path.abspath(os.getcwd())
         # Buffer to hold any bytes read beyond a token-delimited frame
         self._recv_buffer = bytearray()
+        # Replies waiting to be sent, while sendall() queues them (see queue_output()); None: sendall() sends
+        self._output = None
+        # Fast mode: no pause after commands, '+'/'-' status prefix on every reply, and the listing is only sent
+        # when asked for or when the directory changed (an empty listing frame is sent otherwise). Commands that
+        # modify the directory set _listing_due themselves, since mtime alone can miss changes within one clock tick;
+        # mtime catches changes made by other clients.
+        self.fast = False
+        self._listing_key = None
+        self._listing_due = False
+        # "ls -l" asks for sizes and modification times in the next listing
+        self._listing_details = False
+        # Directory changed by the current command, whose cached listing finish_command() drops
+        self._modified_directory = None
+        # "token" (frames end with eof_token) or "v2" (length-prefixed frames, see FRAME_HEADER)
+        self.framing = "token"
+        # Bytes of _recv_buffer already searched for the token
+        self._scanned = 0
+        # Negotiated compression codec (see CODECS), or None
+        self.codec = None
+        # Uncompressed bytes of the current compressed upload not yet returned by recv_into(), and the decompressed
+        # bytes of the block being returned
+        self._inflate_remaining = 0
+        self._inflated = bytearray()
+        # Bytes received and sent on the socket, and their values when the metrics last recorded them
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._metered = (0, 0)
+        # Whether the current command sent an error
+        self._failed = False
+        self._closed = False
+        server.metrics.add("active_sessions", 1)
+        # Token buckets the bytes of the current transfer are taken from (see Server.bandwidth_limits()), this
+        # session's own bucket, and whether a transfer slot is held
+        self._shaping = []
+        self._bucket = None
+        self._transferring = False
+
+    @property
+    def command_delay(self):
+        return 0 if self.fast else self.server_obj.command_delay
+
+    @property
+    def reports_errors(self) -> bool:
+        """Whether the client understands error replies."""
+        return self.fast or self.framing == "v2"
+
+    def fileno(self) -> int:
+        return self.service_socket.fileno()
+
+    def recv(self, buffer_size: int) -> bytes:
+        """Socket-like recv() that returns buffered bytes before reading from the socket."""
+        if self._inflate_remaining:
+            buffer = bytearray(buffer_size)
+            return bytes(buffer[:self.recv_into(buffer, buffer_size)])
+        if self._recv_buffer:
+            data = bytes(self._recv_buffer[:buffer_size])
+            del self._recv_buffer[:buffer_size]
+            return data
+        data = self.service_socket.recv(buffer_size)
+        self._count_in(len(data))
+        return data
+
+    def recv_into(self, buffer, nbytes: int = 0) -> int:
+        """Socket-like recv_into() that returns buffered bytes before reading from the socket. During a compressed
+        upload it returns the decompressed bytes, one block at a time."""
+        nbytes = nbytes or len(buffer)
+        if self._inflate_remaining:
+            if not self._inflated:
+                self._inflated = self._read_block()
+            n = min(nbytes, len(self._inflated))
+            buffer[:n] = self._inflated[:n]
+            del self._inflated[:n]
+            self._inflate_remaining -= n
+            return n
+        if self._recv_buffer:
+            n = min(nbytes, len(self._recv_buffer))
+            buffer[:n] = self._recv_buffer[:n]
+            del self._recv_buffer[:n]
+            return n
+        n = self.service_socket.recv_into(buffer, nbytes)
+        self._count_in(n)
+        return n
+
+    def sendall(self, data) -> None:
+        if self._output is not None:
+            self._output += data
+            self.bytes_out += len(data)
+            return
+        self.shape(len(data))
+        self.service_socket.sendall(data)
+        self.bytes_out += len(data)
+
+    def queue_output(self) -> None:
+        """Makes sendall() keep replies in a buffer until flush_output() sends them, so that the event loop can
+        reply without waiting for a slow reader (see EventLoopServer._refuse_command())."""
+        if self._output is None:
+            self._output = bytearray()
+
+    def flush_output(self, block=True) -> bool:
+        """
+        Sends the replies queued since queue_output(); afterwards sendall() sends directly again.
+        :param block: False to send only what the socket takes at once
+        :return: True once everything queued is sent, False if some of it is still waiting for the socket
+        """
+        if self._output is None:
+            return True
+        if not block:
+            self.service_socket.setblocking(False)
+        try:
+            while self._output:
+                sent = self.service_socket.send(self._output)
+                del self._output[:sent]
+        except BlockingIOError:
+            return False
+        except OSError:
+            # The connection is gone; whoever reads from it next finds out and closes the session
+            self._output = None
+            raise
+        finally:
+            if not block:
+                self.service_socket.setblocking(True)
+        self._output = None
+        return True
+
+    def _count_in(self, n) -> None:
+        self.bytes_in += n
+        self.shape(n)
+
+    def shape(self, n) -> None:
+        """Takes n bytes from the bandwidth limits of the current transfer, sleeping if they are used up."""
+        for bucket in self._shaping:
+            bucket.take(n)
+
+    @property
+    def shaped(self) -> bool:
+        return bool(self._shaping)
+
+    def _read_block(self) -> bytearray:
+        """Reads and decompresses the next block of a compressed upload."""
+        if not self._fill(BLOCK_HEADER.size):
+            return bytearray()
+        stored_len, raw_len = BLOCK_HEADER.unpack_from(self._recv_buffer)
+        del self._recv_buffer[:BLOCK_HEADER.size]
+        if not 0 < raw_len <= min(TRANSFER_CHUNK_SIZE, self._inflate_remaining):
+            raise ValueError(f"Invalid compressed block of {raw_len} bytes")
+        if not self._fill(stored_len):
+            return bytearray()
+        stored = bytes(self._recv_buffer[:stored_len])
+        del self._recv_buffer[:stored_len]
+        if stored_len == raw_len:
+            return bytearray(stored)
+        return bytearray(decompress_block(self.codec, stored, raw_len))
+
+    def _send_frame(self, opcode: int, payload: bytes) -> None:
+        flags = 0
+        if self.codec and len(payload) >= COMPRESS_MIN_SIZE:
+            compressed = compress_block(self.codec, payload, self.server_obj.compression_level)
+            if len(compressed) < len(payload):
+                payload, flags = compressed, FLAG_COMPRESSED
+        self.sendall(FRAME_HEADER.pack(opcode, flags, len(payload)) + payload)
 
-    def _read_frame(self) -> bytearray:
-        """Read a token-terminated frame from the socket using an internal buffer.
-        Returns payload without the token. Any bytes after the token stay in the buffer.
+    def compresses(self, file, offset, count) -> bool:
+        """Whether count bytes of file from offset are worth sending compressed: the session negotiated a codec and
+        a sample from the start of the range shrinks enough."""
+        if not self.codec or count < COMPRESS_MIN_SIZE:
+            return False
+        sample = os.pread(file.fileno(), min(COMPRESS_SAMPLE_SIZE, count), offset)
+        compressed = compress_block(self.codec, sample, self.server_obj.compression_level)
+        return len(compressed) <= len(sample) * COMPRESS_MAX_RATIO
+
+    def send_compressed(self, file, offset, count) -> None:
+        """Sends a compressed OP_DATA frame for count bytes of file from offset, one block at a time."""
+        self.sendall(FRAME_HEADER.pack(OP_DATA, FLAG_COMPRESSED, count))
+        end = offset + count
+        while offset < end:
+            raw = os.pread(file.fileno(), min(TRANSFER_CHUNK_SIZE, end - offset), offset)
+            if not raw:
+                raise ConnectionError(f"File changed during transfer: {end - offset} bytes missing")
+            stored = compress_block(self.codec, raw, self.server_obj.compression_level)
+            if len(stored) >= len(raw):
+                stored = raw
+            self.sendall(BLOCK_HEADER.pack(len(stored), len(raw)) + stored)
+            offset += len(raw)
+
+    def send_message(self, message: str) -> None:
+        if self.framing == "v2":
+            self._send_frame(OP_REPLY, message.encode('utf-8'))
+            return
+        if self.fast:
+            message = "+" + message
+        self.sendall((message + self.eof_token).encode('utf-8'))
+
+    def send_cached(self, entry) -> None:
+        """send_message() for a CachedReply: v2 sessions get the compressed form the cache keeps for their codec."""
+        if self.framing == "v2":
+            payload, flags = entry.payload, 0
+            if self.codec and len(payload) >= COMPRESS_MIN_SIZE:
+                compressed = self.server_obj.response_cache.compressed(
+                    entry, self.codec, self.server_obj.compression_level
+                )
+                if compressed is not None:
+                    payload, flags = compressed, FLAG_COMPRESSED
+            self.sendall(FRAME_HEADER.pack(OP_REPLY, flags, len(payload)) + payload)
+            return
+        self.sendall((b"+" if self.fast else b"") + entry.payload + self.eof_token.encode('utf-8'))
+
+    def send_message_file(self, file, size: int) -> None:
+        """send_message() for a message held in a binary file (uncompressed)."""
+        if self.framing == "v2":
+            self.sendall(FRAME_HEADER.pack(OP_REPLY, 0, size))
+        elif self.fast:
+            self.sendall(b"+")
+        self.server_obj.send_file(self, file, 0, size)
+        if self.framing != "v2":
+            self.sendall(self.eof_token.encode('utf-8'))
+
+    def send_error(self, message: str) -> None:
+        self._failed = True
+        if self.framing == "v2":
+            self._send_frame(OP_ERROR, message.encode('utf-8'))
+        elif self.fast:
+            self.sendall(("-" + message + self.eof_token).encode('utf-8'))
+
+    def send_size_header(self, size: int) -> None:
+        if self.framing == "v2":
+            self.sendall(FRAME_HEADER.pack(OP_DATA, 0, size))
+        else:
+            self.send_message(str(size))
+
+    def send_chunk(self, data) -> None:
+        """Sends one chunk of a data stream (at most TRANSFER_CHUNK_SIZE bytes) as a single compressed block if the
+        session negotiated a codec and the block is smaller, otherwise as raw bytes after the size header."""
+        if self.codec and len(data) >= COMPRESS_MIN_SIZE:
+            stored = compress_block(self.codec, data, self.server_obj.compression_level)
+            if len(stored) < len(data):
+                self.sendall(
+                    FRAME_HEADER.pack(OP_DATA, FLAG_COMPRESSED, len(data)) + BLOCK_HEADER.pack(len(stored), len(data))
+                    + stored
+                )
+                return
+        self.send_size_header(len(data))
+        if data:
+            self.sendall(data)
+
+    def send_listing(self, details=False) -> None:
+        dir_info = self.server_obj.get_working_directory_info(self.current_working_directory, details)
+        self.send_message(dir_info)
+
+    def finish_command(self) -> None:
+        """Sends the reply that closes every command: the directory listing (fast mode: only if it may differ from
+        the last one this client saw, otherwise an empty frame). Recorded in the metrics as "listing"."""
+        start = time.perf_counter()
+        try:
+            self._finish_command()
+        finally:
+            self._record("listing", time.perf_counter() - start)
+
+    def _finish_command(self) -> None:
+        if self._modified_directory is not None:
+            self.server_obj.invalidate_listing(self._modified_directory)
+            self._modified_directory = None
+        details, self._listing_details = self._listing_details, False
+        if not self.fast:
+            self.send_listing(details)
+            return
+        listing_key = self._current_listing_key()
+        if self._listing_due or listing_key is None or listing_key != self._listing_key:
+            self._listing_key = listing_key
+            self.send_listing(details)
+        else:
+            self.send_message("")
+        self._listing_due = False
+
+    def _current_listing_key(self):
+        cwd = self.current_working_directory
+        try:
+            return cwd, os.stat(cwd).st_mtime_ns
+        except OSError:
+            return None
+
+    def negotiate(self, requested) -> None:
+        """Handles "hello": replies "ok <accepted features>" (in the framing used so far) and switches to them."""
+        accepted = [feature for feature in requested if feature in Session.FEATURES]
+        # Compressed frames need v2 framing; the first codec offered wins
+        codecs = [feature for feature in requested if feature in CODECS]
+        if codecs and "v2" in accepted:
+            accepted.append(codecs[0])
+        if "fast" not in accepted and "v2" not in accepted:
+            accepted = [feature for feature in accepted if feature not in Session.ERROR_REPLY_FEATURES]
+        self.send_message(" ".join(["ok"] + accepted))
+        self.fast = "fast" in accepted
+        if "v2" in accepted:
+            self.framing = "v2"
+            self.codec = codecs[0] if codecs else None
+        # The client has just seen the listing sent on connect
+        self._listing_key = self._current_listing_key()
+        log.info("Protocol features for {}: {}", self.address, ", ".join(accepted) or "none")
+
+    def has_frame(self) -> bool:
+        """True if a complete frame is already buffered, i.e. the next read_frame() will not touch the socket."""
+        if self.framing == "v2":
+            if len(self._recv_buffer) < FRAME_HEADER.size:
+                return False
+            _, _, length = FRAME_HEADER.unpack_from(self._recv_buffer)
+            return len(self._recv_buffer) >= FRAME_HEADER.size + length
+        token_bytes = self.eof_token.encode('utf-8')
+        # As in read_frame(): only search bytes not searched before, so a command trickling in is scanned once
+        if self._recv_buffer.find(token_bytes, max(0, self._scanned - len(token_bytes) + 1)) != -1:
+            return True
+        self._scanned = len(self._recv_buffer)
+        return False
+
+    def _fill(self, n: int) -> bool:
+        """Read from the socket until at least n bytes are buffered. Returns False if the connection closed first."""
+        while len(self._recv_buffer) < n:
+            chunk = self.service_socket.recv(max(4096, n - len(self._recv_buffer)))
+            self._count_in(len(chunk))
+            if not chunk:
+                return False
+            self._recv_buffer.extend(chunk)
+        return True
+
+    def _read_header(self):
+        """Read one v2 frame header. Returns (opcode, flags, length), or None if the connection closed."""
+        if not self._fill(FRAME_HEADER.size):
+            return None
+        header = FRAME_HEADER.unpack_from(self._recv_buffer)
+        del self._recv_buffer[:FRAME_HEADER.size]
+        return header
+
+    def read_frame(self) -> bytearray:
+        """Read a frame from the socket using an internal buffer.
+        Returns payload without the token (or v2 header). Any bytes after the frame stay in the buffer.
+        An empty payload is returned when the connection closed.
         """
+        if self.framing == "v2":
+            header = self._read_header()
+            if header is None or not self._fill(header[2]):
+                self._recv_buffer.clear()
+                return bytearray()
+            payload = self._recv_buffer[:header[2]]
+            del self._recv_buffer[:header[2]]
+            return payload
         token_bytes = self.eof_token.encode('utf-8')
         token_len = len(token_bytes)
         # Check if token already in buffer
         while True:
-            idx = self._recv_buffer.find(token_bytes)
+            # Only search bytes not searched before (plus an overlap for a token split across recv() calls)
+            idx = self._recv_buffer.find(token_bytes, max(0, self._scanned - token_len + 1))
             if idx != -1:
                 payload = self._recv_buffer[:idx]
                 # keep remainder after token in buffer
-                self._recv_buffer = self._recv_buffer[idx + token_len:]
+                del self._recv_buffer[:idx + token_len]
+                self._scanned = 0
                 return payload
+            self._scanned = len(self._recv_buffer)
             # Need more data
             chunk = self.service_socket.recv(4096)
+            self._count_in(len(chunk))
             if not chunk:
                 # Return whatever is left (no token)
                 payload = bytes(self._recv_buffer)
                 self._recv_buffer.clear()
+                self._scanned = 0
                 return bytearray(payload)
             self._recv_buffer.extend(chunk)
 
+    def read_size_header(self) -> int:
+        """Read the size announced before the raw bytes of an upload."""
+        if self.framing == "v2":
+            header = self._read_header()
+            if header is None:
+                raise ConnectionError("Socket closed before the upload header")
+            opcode, flags, length = header
+            if opcode != OP_DATA:
+                raise ValueError(f"Expected a data frame, got opcode {opcode}")
+            if flags & FLAG_COMPRESSED:
+                if not self.codec:
+                    raise ValueError("Compressed data on a session without compression")
+                # recv_into() decompresses the blocks that follow
+                self._inflate_remaining = length
+            else:
+                self._inflate_remaining = 0
+            self._inflated = bytearray()
+            return length
+        return int(self.read_frame().decode('utf-8').strip())
+
+    def read_chunks(self):
+        """Yields the payload of each chunk of a data stream (uldir) until the empty chunk that ends it, at most
+        TRANSFER_CHUNK_SIZE bytes at a time. Each chunk is sent like an upload: a size header, then the (possibly
+        compressed) bytes."""
+        while size := self.read_size_header():
+            while size > 0:
+                data = self.server_obj._recv_exact(self, min(size, TRANSFER_CHUNK_SIZE))
+                size -= len(data)
+                yield data
+
+    def _record(self, command, seconds) -> None:
+        """Records a command in the server's metrics with the bytes moved since the last one."""
+        bytes_in, bytes_out = self._metered
+        self._metered = (self.bytes_in, self.bytes_out)
+        self.server_obj.metrics.record(
+            command, seconds, self.bytes_in - bytes_in, self.bytes_out - bytes_out, self._failed
+        )
+        self._failed = False
+
+    def execute(self, raw_msg: bytearray) -> str:
+        """
+        Runs one command frame against the server handlers, recording it in the server's metrics (see Metrics):
+        its latency, the bytes moved since the last command (its frame included), whether it failed, and for
+        TRANSFER_COMMANDS the transfer in flight.
+        :param raw_msg: the command frame as read by read_frame()
+        :return: one of Session.LISTING, Session.NO_REPLY or Session.CLOSE
+        """
+        if not raw_msg:
+            return self._execute(raw_msg)
+        command = self._command_name(raw_msg)
+        start = time.perf_counter()
+        try:
+            if command in TRANSFER_COMMANDS and not self._start_transfer(command):
+                return self._busy("too many transfers")
+            return self._execute(raw_msg)
+        except BaseException:
+            self._failed = True
+            raise
+        finally:
+            self._record(command, time.perf_counter() - start)
+            if self._transferring:
+                self._end_transfer()
+
+    @staticmethod
+    def _command_name(raw_msg) -> str:
+        """The command a frame starts with, as the metrics know it."""
+        command = bytes(raw_msg[:16]).split(b" ", 1)[0].strip().decode('utf-8', 'replace')
+        return command if command in Session.COMMANDS else "unknown"
+
+    def _start_transfer(self, command) -> bool:
+        """Takes a transfer slot (see MAX_TRANSFERS) and the bandwidth limits. Returns False if the command has to be
+        refused instead."""
+        server = self.server_obj
+        if not server.acquire_transfer(wait=command in UPLOAD_COMMANDS or not self.reports_errors):
+            return False
+        self._transferring = True
+        self._shaping, self._bucket = server.bandwidth_limits(self._bucket)
+        server.metrics.add("transfers_in_flight", 1)
+        return True
+
+    def _end_transfer(self) -> None:
+        self._transferring = False
+        self._shaping = []
+        self.server_obj.metrics.add("transfers_in_flight", -1)
+        self.server_obj.release_transfer()
+
+    def _busy(self, reason) -> str:
+        """Refuses the current command with a busy reply (see BUSY_MESSAGE) and the usual listing."""
+        log.warning("{}: {} for {}", BUSY_MESSAGE, reason, self.address, sample="busy")
+        self.server_obj.metrics.add("busy_replies", 1)
+        self.send_error(f"{BUSY_MESSAGE}: {reason}")
+        return Session.LISTING
+
+    def next_command(self) -> str:
+        """The command of the frame has_frame() found buffered, without taking it from the buffer."""
+        start = FRAME_HEADER.size if self.framing == "v2" else 0
+        return self._command_name(self._recv_buffer[start:start + 16])
+
+    def read_available(self) -> bool:
+        """Buffers what the socket already holds, without waiting for more. Returns False if the connection closed."""
+        self.service_socket.setblocking(False)
+        try:
+            chunk = self.service_socket.recv(TRANSFER_CHUNK_SIZE)
+        except BlockingIOError:
+            return True
+        finally:
+            self.service_socket.setblocking(True)
+        self._count_in(len(chunk))
+        self._recv_buffer.extend(chunk)
+        return bool(chunk)
+
+    def refuse(self, raw_msg) -> None:
+        """Answers a command frame with a busy reply and the listing without running it (see
+        EventLoopServer._refuse_command())."""
+        self._busy("too many commands waiting")
+        self._record(self._command_name(raw_msg), 0.0)
+        self.finish_command()
+
+    def _execute(self, raw_msg: bytearray) -> str:
+        server = self.server_obj
+        cwd = self.current_working_directory
+        try:
+            command_and_arg = raw_msg.decode('utf-8').strip()
+        except UnicodeDecodeError:
+            # If decoding fails, we most likely consumed a leftover binary chunk
+            # (e.g., from an upload). Discard and continue waiting for the next
+            # proper UTF-8 command instead of crashing.
+            log.warning("Discarded non-UTF-8 payload of {} bytes from {}", len(raw_msg), self.address)
+            return Session.NO_REPLY
+        log.info("Received command: {} from {}", command_and_arg, self.address, sample="command")
+        if not command_and_arg:
+            return Session.CLOSE  # client disconnected
+        # Handle protocol negotiation
+        if command_and_arg == "hello" or command_and_arg.startswith("hello "):
+            self.negotiate(command_and_arg[6:].split())
+            return Session.NO_REPLY
+        # Handle ls command ("ls -l" adds sizes and modification times)
+        if command_and_arg in ("ls", "ls -l"):
+            self._listing_due = True
+            self._listing_details = command_and_arg == "ls -l"
+            return Session.LISTING
+        # Commands that modify the current directory
+        if command_and_arg.split(" ", 1)[0] in (
+            "mkdir", "rm", "ul", "ulat", "ulstripe", "ulhash", "uldir", "uldelta", "split"
+        ):
+            self._listing_due = True
+            self._modified_directory = cwd
+        # Handle mkdir command
+        if command_and_arg.startswith("mkdir "):
+            directory_name = command_and_arg[6:].strip()
+            server.handle_mkdir(cwd, directory_name, self, self.eof_token)
+        # Handle cd command
+        elif command_and_arg.startswith("cd "):
+            new_working_directory = command_and_arg[3:].strip()
+            self.current_working_directory = server.handle_cd(cwd, new_working_directory)
+        # Handle ul command
+        elif command_and_arg.startswith("ul "):
+            file_name = command_and_arg[3:].strip()
+            # Next frame is the size header
+            expected_len = self._read_upload_size()
+            # Bytes already buffered are drained by recv(), so nothing is handed over here
+            server.handle_ul(cwd, file_name, self, self.eof_token, expected_len)
+        # Handle ulhash command: ulhash <sha256> <size> <name>
+        elif command_and_arg.startswith("ulhash "):
+            parts = command_and_arg[7:].strip().split(" ", 2)
+            try:
+                digest, size, file_name = parts[0].lower(), int(parts[1]), parts[2].strip()
+            except (ValueError, IndexError):
+                return self._reject("Invalid ulhash command format")
+            server.handle_ul_hash(cwd, file_name, digest, size, self, self.eof_token)
+        # Handle ulstat command: ulstat <sha256> <name>
+        elif command_and_arg.startswith("ulstat "):
+            parts = command_and_arg[7:].strip().split(" ", 1)
+            if len(parts) < 2:
+                return self._reject("Invalid ulstat command format")
+            server.handle_ul_status(cwd, parts[1].strip(), parts[0].lower(), self, self.eof_token)
+        # Handle ulat command: ulat <offset> <total size> <sha256> <name>, then the size header and payload as for ul
+        elif command_and_arg.startswith("ulat "):
+            parts = command_and_arg[5:].strip().split(" ", 3)
+            expected_len = self._read_upload_size()
+            try:
+                offset, total_size, digest, file_name = int(parts[0]), int(parts[1]), parts[2].lower(), parts[3].strip()
+            except (ValueError, IndexError):
+                server._recv_into_file(self, None, expected_len)
+                return self._reject("Invalid ulat command format")
+            server.handle_ul_at(cwd, file_name, offset, total_size, digest, self, self.eof_token, expected_len)
+        # Handle ulstripe command: ulstripe <upload id> <offset> <total size> <name>, then size header and payload
+        elif command_and_arg.startswith("ulstripe "):
+            parts = command_and_arg[9:].strip().split(" ", 3)
+            expected_len = self._read_upload_size()
+            try:
+                upload_id, offset, total_size, file_name = parts[0], int(parts[1]), int(parts[2]), parts[3].strip()
+            except (ValueError, IndexError):
+                server._recv_into_file(self, None, expected_len)
+                return self._reject("Invalid ulstripe command format")
+            server.handle_ul_stripe(cwd, file_name, upload_id, offset, total_size, self, self.eof_token, expected_len)
+        # Handle uldir command: uldir <name>, then the tar stream of the tree (see Server.handle_uldir())
+        elif command_and_arg.startswith("uldir "):
+            server.handle_uldir(cwd, command_and_arg[6:].strip(), self, self.eof_token)
+        # Handle uldelta command: uldelta <name>, then the exchange described in Server.handle_ul_delta()
+        elif command_and_arg.startswith("uldelta "):
+            server.handle_ul_delta(cwd, command_and_arg[8:].strip(), self, self.eof_token)
+        # Handle dl command
+        elif command_and_arg.startswith("dl "):
+            file_name = command_and_arg[3:].strip()
+            server.handle_dl(cwd, file_name, self, self.eof_token)
+        # Handle dlrange command: dlrange <offset> <length or -1> <name>
+        elif command_and_arg.startswith("dlrange "):
+            parts = command_and_arg[8:].strip().split(" ", 2)
+            try:
+                offset, length, file_name = int(parts[0]), int(parts[1]), parts[2].strip()
+            except (ValueError, IndexError):
+                return self._reject("Invalid dlrange command format")
+            server.handle_dl_range(cwd, file_name, offset, length, self, self.eof_token)
+        # Handle dldir command: dldir <name>
+        elif command_and_arg.startswith("dldir "):
+            server.handle_dldir(cwd, command_and_arg[6:].strip(), self, self.eof_token)
+        # Handle wordcount command
+        elif command_and_arg.startswith("wordcount "):
+            file_name = command_and_arg[10:].strip()
+            server.handle_wordcount(cwd, file_name, self, self.eof_token)
+        elif command_and_arg.startswith("wordsort "):
+            file_name = command_and_arg[9:].strip()
+            server.handle_wordsort(cwd, file_name, self, self.eof_token)
+        # Handle search command
+        elif command_and_arg.startswith("search "):
+            parts = command_and_arg[7:].strip().split()
+            # Handle invalid format
+            if(len(parts) < 2):
+                return self._reject("Invalid search command format")
+
+            file_name = parts[0]
+            wordslist = [word.strip() for word in parts[1].split(',')]
+
+            server.handle_search(cwd, file_name, wordslist, self, self.eof_token)
+        # Handle gsearch command: gsearch word1,word2 (the whole served tree, from the search index)
+        elif command_and_arg.startswith("gsearch "):
+            wordslist = [word.strip() for word in command_and_arg[8:].strip().split(',') if word.strip()]
+            if not wordslist:
+                return self._reject("Invalid gsearch command format")
+            server.handle_gsearch(wordslist, self, self.eof_token)
+        # Handle split command
+        elif command_and_arg.startswith("split "):
+            parts = command_and_arg[6:].strip().split()
+            # Handle invalid format
+            if(len(parts) < 2):
+                return self._reject("Invalid split command format")
+
+            file_name = parts[0]
+            splitlist = [split.strip() for split in parts[1].split(',')]
+
+            server.handle_split(cwd, file_name, splitlist, self, self.eof_token)
+        # Handle stats command: the server's metrics
+        elif command_and_arg == "stats":
+            server.handle_stats(self, self.eof_token)
+        # Handle rm command
+        elif command_and_arg.startswith("rm "):
+            object_name = command_and_arg[3:].strip()
+            server.handle_rm(cwd, object_name, self, self.eof_token)
+        # Handle exit command
+        elif command_and_arg == "exit":
+            self.send_message("Exiting. Goodbye!")
+            return Session.CLOSE
+        return Session.LISTING
+
+    def _read_upload_size(self) -> int:
+        """Reads the size header that follows ul/ulat; 0 if it is malformed."""
+        try:
+            return self.read_size_header()
+        except (ValueError, UnicodeDecodeError) as e:
+            log.warning("Invalid UL size header from {}: {}", self.address, e)
+            return 0
+
+    def _reject(self, message: str) -> str:
+        """A malformed command: clients that understand error replies get one (and the usual listing), the original
+        protocol sends nothing at all."""
+        log.warning("{} from {}", message, self.address)
+        if not self.reports_errors:
+            return Session.NO_REPLY
+        self.send_error(message)
+        return Session.LISTING
+
+    def close(self) -> None:
+        try:
+            self.service_socket.close()
+        except Exception:
+            pass
+        if not self._closed:
+            self._closed = True
+            self.server_obj.metrics.add("active_sessions", -1)
+            self.server_obj.session_closed()
+        log.info("Connection closed from: {}", self.address, sample="connection")
+
+
+class ClientThread(Thread):
+    def __init__(
+        self,
+        server: Server,
+        service_socket: socket.socket,
+        address: str,
+        eof_token: str,
+    ):
+        Thread.__init__(self)
+        self.server_obj = server
+        self.service_socket = service_socket
+        self.address = address
+        self.eof_token = eof_token
+        self.session = Session(server, service_socket, address, eof_token)
+
     def run(self):
-        print ("Connection from : ", self.address)
+        log.info("Connection from: {}", self.address, sample="connection")
         # raise NotImplementedError("Your implementation here.")
 
         try:
-            # establish working directory for current client
-            current_working_directory = os.path.abspath(os.getcwd())
             # send the current dir info
-            dir_info = self.server_obj.get_working_directory_info(current_working_directory)
-            self.service_socket.sendall((dir_info + self.eof_token).encode('utf-8'))
+            self.session.send_listing()
 
             while True:
                 # get the command and arguments and call the corresponding method
-                raw_msg = self._read_frame()
-                try:
-                    command_and_arg = raw_msg.decode('utf-8').strip()
-                except UnicodeDecodeError:
-                    # If decoding fails, we most likely consumed a leftover binary chunk
-                    # (e.g., from an upload). Discard and continue waiting for the next
-                    # proper UTF-8 command instead of crashing.
-                    print(f"Warning: Discarded non-UTF-8 payload of {len(raw_msg)} bytes from {self.address}")
+                raw_msg = self.session.read_frame()
+                outcome = self.session.execute(raw_msg)
+                if outcome == Session.CLOSE:
+                    break
+                if outcome == Session.NO_REPLY:
                     continue
-                print(f"Received command: {command_and_arg} from {self.address}")
-                if not command_and_arg:
-                    break  # client disconnected
-                # Handle mkdir command
-                if command_and_arg.startswith("mkdir "):
-                    directory_name = command_and_arg[6:].strip()
-                    self.server_obj.handle_mkdir(current_working_directory, directory_name)
-                # Handle cd command
-                elif command_and_arg.startswith("cd "):
-                    new_working_directory = command_and_arg[3:].strip()
-                    current_working_directory = self.server_obj.handle_cd(current_working_directory, new_working_directory)
-                # Handle ul command
-                elif command_and_arg.startswith("ul "):
-                    file_name = command_and_arg[3:].strip()
-                    # Next frame is the size header
-                    size_header = self._read_frame()
-                    try:
-                        expected_len = int(size_header.decode('utf-8').strip())
-                    except Exception:
-                        print(f"Invalid UL size header from {self.address}: {size_header!r}")
-                        expected_len = 0
-                    # Any bytes already in buffer belong to file payload
-                    initial = bytes(self._recv_buffer)
-                    self._recv_buffer.clear()
-                    self.server_obj.handle_ul(
-                        current_working_directory,
-                        file_name,
-                        self.service_socket,
-                        self.eof_token,
-                        expected_len,
-                        initial,
-                    )
-                # Handle dl command
-                elif command_and_arg.startswith("dl "):
-                    file_name = command_and_arg[3:].strip()
-                    self.server_obj.handle_dl(current_working_directory, file_name, self.service_socket, self.eof_token)
-                # Handle wordcount command
-                elif command_and_arg.startswith("wordcount "):
-                    file_name = command_and_arg[10:].strip()
-                    self.server_obj.handle_wordcount(current_working_directory, file_name, self.service_socket, self.eof_token)
-                elif command_and_arg.startswith("wordsort "):
-                    file_name = command_and_arg[9:].strip()
-                    self.server_obj.handle_wordsort(current_working_directory, file_name, self.service_socket, self.eof_token)
-                # Handle search command
-                elif command_and_arg.startswith("search "):
-                    parts = command_and_arg[7:].strip().split()
-                    # Handle invalid format
-                    if(len(parts) < 2):
-                        print(f"Invalid search command format from {self.address}")
-                        continue
 
-                    file_name = parts[0]
-                    wordslist = [word.strip() for word in parts[1].split(',')]
+                # sleep before sending the current dir info (no pause in fast mode)
+                if self.session.command_delay:
+                    time.sleep(self.session.command_delay)
+                self.session.finish_command()
 
-                    self.server_obj.handle_search(current_working_directory, file_name, wordslist, self.service_socket, self.eof_token)
-                # Handle split command
-                elif command_and_arg.startswith("split "):
-                    parts = command_and_arg[6:].strip().split()
-                    # Handle invalid format
-                    if(len(parts) < 2):
-                        print(f"Invalid split command format from {self.address}")
-                        continue
+        except OSError as e:
+            log.error("Error serving {}: {}", self.address, e)
+        finally:
+            self.session.close()
+            self.server_obj.metrics.retire()
 
-                    file_name = parts[0]
-                    splitlist = [split.strip() for split in parts[1].split(',')]
-
-                    self.server_obj.handle_split(current_working_directory, file_name, splitlist, self.service_socket, self.eof_token)
-                # Handle rm command
-                elif command_and_arg.startswith("rm "):
-                    object_name = command_and_arg[3:].strip()
-                    self.server_obj.handle_rm(current_working_directory, object_name)
-                # Handle exit command
-                elif command_and_arg == "exit":
-                    self.service_socket.sendall(("Exiting. Goodbye!" + self.eof_token).encode('utf-8'))
-                    break
 
-                # sleep for 1 second
-                time.sleep(1)
-                # send current dir info
-                dir_info = self.server_obj.get_working_directory_info(current_working_directory)
-                self.service_socket.sendall((dir_info + self.eof_token).encode('utf-8'))
+def descriptor_session_limit() -> int:
+    """
+    Most sessions the event engine can hold: the open file limit, raised to its hard limit where allowed, less
+    RESERVED_DESCRIPTORS. 0 (no limit) where the platform has no such limit.
+    """
+    if resource is None:
+        return 0
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    if soft == resource.RLIM_INFINITY:
+        return 0
+    return max(1, soft - RESERVED_DESCRIPTORS)
+
+
+class EventLoopServer(Server):
+    """
+    Server engine that parks every idle connection in a single selectors event loop instead of giving it a thread.
+    When a session has a command to read it is handed to a bounded worker pool, which runs the same Session/handle_*
+    code as ClientThread and then gives the socket back to the loop. The pause before each directory listing is a
+    timer on the loop, so it does not hold a worker either.
+    """
+    def __init__(self, host, port, max_workers=32):
+        super().__init__(host, port)
+        self.max_workers = max_workers
+        # Idle sessions cost a file descriptor each rather than a thread, so only the open file limit caps them
+        self.max_sessions = descriptor_session_limit()
+        # Commands that may wait for a worker before further ones are refused (see _refuse_command())
+        self.worker_queue_limit = WORKER_QUEUE_LIMIT
+        # Jobs submitted to the worker pool and not finished yet
+        self._queued = 0
+        self._queued_lock = Lock()
+        self._selector = None
+        self._pool = None
+        # Sessions handed back by workers: (deadline or None, session)
+        self._returned = queue.SimpleQueue()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._timers = []
+        self._timer_seq = 0
+
+    def start(self) -> None:
+        """
+        1) Create server, bind and start listening.
+        2) Run the event loop: accept connections, wait for commands on idle sessions and dispatch them to workers.
+        """
+        self.search_index.start()
+        self.start_metrics_endpoint()
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        with self.server_socket as s, selectors.DefaultSelector() as selector, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            self._selector = selector
+            self._pool = pool
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((self.host, self.port))
+            s.listen(socket.SOMAXCONN)
+            s.setblocking(False)
+            selector.register(s, selectors.EVENT_READ)
+            selector.register(self._wakeup_recv, selectors.EVENT_READ)
+            log.info("Server listening on {}:{} (event loop, {} workers)", self.host, self.port, self.max_workers)
+            while True:
+                timeout = None
+                if self._timers:
+                    timeout = max(0.0, self._timers[0][0] - time.monotonic())
+                for key, events in selector.select(timeout):
+                    if key.fileobj is s:
+                        self._accept(s)
+                    elif key.fileobj is self._wakeup_recv:
+                        self._wakeup_recv.recv(4096)
+                    elif events & selectors.EVENT_WRITE:
+                        # A refused session can take more of its busy replies
+                        self._flush_refused(key.data)
+                    else:
+                        self._read_parked(key.data)
+                self._collect_returned()
+                now = time.monotonic()
+                while self._timers and self._timers[0][0] <= now:
+                    _, _, session = heapq.heappop(self._timers)
+                    self._submit(self._serve, session, True)
+
+    def _accept(self, listening_socket: socket.socket) -> None:
+        """Accept every pending connection and send each one its EOF token."""
+        while True:
+            try:
+                client_socket, client_address = listening_socket.accept()
+            except BlockingIOError:
+                return
+            log.info("Accepted connection from {}", client_address, sample="connection")
+            try:
+                eof_token = self.generate_random_eof_token()
+                if not self.admit_session():
+                    # Best effort: whatever the socket does not take at once is dropped with the connection
+                    client_socket.setblocking(False)
+                    try:
+                        client_socket.send(eof_token.encode('utf-8'))
+                    except OSError:
+                        pass
+                    self.refuse_connection(client_socket, eof_token, client_address)
+                    continue
+                client_socket.setblocking(True)
+                session = Session(self, client_socket, client_address, eof_token)
+                # The worker that sends the first listing sends the token before it
+                session.queue_output()
+                session.sendall(eof_token.encode('utf-8'))
+                self._submit(self._welcome, session)
+            except Exception as e:
+                log.error("Error: {}", e)
+                client_socket.close()
+
+    def _submit(self, function, *args) -> None:
+        """Runs function(*args) on a worker, counted in _queued until it returns."""
+        with self._queued_lock:
+            self._queued += 1
+        self._pool.submit(self._counted, function, *args)
 
+    def _counted(self, function, *args) -> None:
+        try:
+            function(*args)
         finally:
+            with self._queued_lock:
+                self._queued -= 1
+
+    def _read_parked(self, session: Session) -> None:
+        """
+        Loop thread: buffers what a parked session has sent, without waiting for more, and hands the session to a
+        worker only once a whole command frame (or EOF) is buffered, so that a slow or stalled sender holds no
+        worker while its command trickles in.
+        """
+        try:
+            open_ = session.read_available()
+        except OSError:
+            # Let a worker find the broken connection and close the session
+            open_ = False
+        if open_:
+            if not session.has_frame():
+                return
+            if self._queued >= self.max_workers + self.worker_queue_limit and self._refuse_command(session):
+                return
+        self._selector.unregister(session.service_socket)
+        self._submit(self._serve, session)
+
+    def _refuse_command(self, session: Session) -> bool:
+        """
+        Loop thread, with every worker busy and worker_queue_limit jobs waiting: answers the commands the session
+        has sent with busy replies instead of queueing them, so that the queue (and the wait of the commands in it)
+        stays bounded. Only whole frames of commands without a payload, from sessions that understand error replies,
+        are refused; nothing here waits for the client to send more, nor for it to read the replies: they are queued
+        on the session, and what the socket does not take at once is sent when it becomes writable (the session is
+        not read meanwhile) or by the worker that serves the session next.
+        :return: True if the session was dealt with (it stays parked), False if it has to go to a worker after all
+        """
+        if not session.reports_errors:
+            return False
+        session.queue_output()
+        try:
+            while session.has_frame():
+                if session.next_command() in UPLOAD_COMMANDS:
+                    return False
+                session.refuse(session.read_frame())
+            if not session.flush_output(block=False):
+                self._selector.modify(session.service_socket, selectors.EVENT_WRITE, session)
+        except OSError:
+            # Let a worker find the broken connection and close the session
+            return False
+        return True
+
+    def _flush_refused(self, session: Session) -> None:
+        """Loop thread: sends more of the busy replies _refuse_command() queued, and parks the session for reading
+        again once they are all sent."""
+        try:
+            if session.flush_output(block=False):
+                self._selector.modify(session.service_socket, selectors.EVENT_READ, session)
+        except OSError:
+            # Let a worker find the broken connection and close the session
+            self._selector.unregister(session.service_socket)
+            self._submit(self._serve, session)
+
+    def _collect_returned(self) -> None:
+        """Move sessions handed back by workers into the selector or the timer heap (loop thread only)."""
+        while True:
             try:
-                self.service_socket.close()
-            except Exception:
-                pass
-            print('Connection closed from:', self.address)
+                deadline, session = self._returned.get_nowait()
+            except queue.Empty:
+                return
+            if deadline is None:
+                self._selector.register(session.service_socket, selectors.EVENT_READ, session)
+            else:
+                self._timer_seq += 1
+                heapq.heappush(self._timers, (deadline, self._timer_seq, session))
+
+    def _hand_back(self, session: Session, delay=None) -> None:
+        """Return a session to the loop, optionally after a delay (worker threads)."""
+        deadline = None if delay is None else time.monotonic() + delay
+        self._returned.put((deadline, session))
+        self._wakeup_send.send(b"\0")
+
+    def _welcome(self, session: Session) -> None:
+        log.info("Connection from: {}", session.address, sample="connection")
+        try:
+            session.flush_output()
+            session.send_listing()
+            self._hand_back(session)
+        except Exception as e:
+            log.error("Error: {}", e)
+            session.close()
+
+    def _serve(self, session: Session, listing_due=False) -> None:
+        """
+        Worker body: run commands while complete frames are buffered, then park the session again. The loop only
+        submits a session once a whole frame (or EOF) is buffered, so read_frame() does not wait for the client.
+        :param session: the session to serve
+        :param listing_due: True when resuming after the command delay, i.e. the listing must be sent first
+        """
+        try:
+            # Busy replies the loop queued before handing the session over go out before anything else
+            session.flush_output()
+            if listing_due:
+                session.finish_command()
+                if not session.has_frame():
+                    self._hand_back(session)
+                    return
+            while True:
+                outcome = session.execute(session.read_frame())
+                if outcome == Session.CLOSE:
+                    session.close()
+                    return
+                if outcome == Session.LISTING:
+                    if session.command_delay:
+                        self._hand_back(session, session.command_delay)
+                        return
+                    session.finish_command()
+                if not session.has_frame():
+                    self._hand_back(session)
+                    return
+        except Exception as e:
+            log.error("Error serving {}: {}", session.address, e)
+            session.close()
+
+
+def env_number(name, convert=int, minimum=0, maximum=None, value=None):
+    """
+    Reads a numeric setting from the environment. A value that is not a finite number in [minimum, maximum] is
+    ignored with a warning, so that one typo does not stop the server from starting.
+    :param name: name of the environment variable (or of the setting, with value)
+    :param convert: int or float
+    :param minimum: smallest valid value, or None
+    :param maximum: largest valid value, or None
+    :param value: the text to parse instead of the variable's
+    :return: the number, or None if the variable is unset or invalid (the caller keeps its default)
+    """
+    if value is None:
+        value = os.getenv(name)
+        if not value:
+            return None
+    try:
+        number = convert(value)
+        if not math.isfinite(number):
+            raise ValueError("not a finite number")
+        if minimum is not None and number < minimum:
+            raise ValueError(f"less than {minimum}")
+        if maximum is not None and number > maximum:
+            raise ValueError(f"more than {maximum}")
+    except ValueError as e:
+        log.warning("Ignoring {}={}: {}; using the default", name, value, e)
+        return None
+    return number
 
 
 def run_server():
     HOST = "0.0.0.0"
     PORT = 65432
+    MB = 1024 * 1024
+
+    # SERVER_LOG_LEVEL: debug, info (default), warning or error
+    level = os.getenv("SERVER_LOG_LEVEL", "info").lower()
+    if level in LOG_LEVELS:
+        log.level = LOG_LEVELS[level]
+    else:
+        log.warning("Ignoring SERVER_LOG_LEVEL={}: not one of {}; using info", level, ", ".join(LOG_LEVELS))
+    # SERVER_LOG_SAMPLE, e.g. "command=100,connection=10": keep one in N records of these high-volume events
+    for sample in filter(None, os.getenv("SERVER_LOG_SAMPLE", "").split(",")):
+        event, _, every = sample.partition("=")
+        every = env_number(f"SERVER_LOG_SAMPLE {event.strip()}", minimum=1, value=every.strip())
+        if every is not None:
+            log.sample_every[event.strip()] = every
 
-    server = Server(HOST, PORT)
+    # SERVER_ENGINE=event serves every connection from one event loop instead of one thread each
+    if os.getenv("SERVER_ENGINE", "thread") == "event":
+        workers = env_number("SERVER_WORKERS", minimum=1)
+        server = EventLoopServer(HOST, PORT, 32 if workers is None else workers)
+    else:
+        server = Server(HOST, PORT)
+    # SERVER_TOKEN_CACHE_MB sets the memory budget of the shared word statistics cache
+    if (megabytes := env_number("SERVER_TOKEN_CACHE_MB")) is not None:
+        server.token_cache.budget = megabytes * MB
+    # SERVER_RESPONSE_CACHE_MB sets the memory budget of the cached wordcount, wordsort and search replies
+    if (megabytes := env_number("SERVER_RESPONSE_CACHE_MB")) is not None:
+        server.response_cache.budget = megabytes * MB
+    # SERVER_METRICS_PORT serves the metrics over HTTP on that port (SERVER_METRICS_HOST, default 127.0.0.1)
+    if (metrics_port := env_number("SERVER_METRICS_PORT", maximum=65535)) is not None:
+        server.metrics_address = (os.getenv("SERVER_METRICS_HOST", "127.0.0.1"), metrics_port)
+    # SERVER_MAX_SESSIONS, SERVER_MAX_TRANSFERS: admission limits (0: none); SERVER_WORKER_QUEUE: commands that may
+    # wait for an event loop worker before further ones get a busy reply
+    if (limit := env_number("SERVER_MAX_SESSIONS")) is not None:
+        server.max_sessions = limit
+    if (limit := env_number("SERVER_MAX_TRANSFERS")) is not None:
+        server.max_transfers = limit
+    if (limit := env_number("SERVER_WORKER_QUEUE")) is not None and isinstance(server, EventLoopServer):
+        server.worker_queue_limit = limit
+    # SERVER_SESSION_MBPS, SERVER_TOTAL_MBPS: bandwidth limits in MB/s of each session's transfers and of all of them
+    if (rate := env_number("SERVER_SESSION_MBPS", float)) is not None:
+        server.session_bandwidth = rate * MB
+    if (rate := env_number("SERVER_TOTAL_MBPS", float)) is not None:
+        server.total_bandwidth = rate * MB
+    # SERVER_EXTERNAL_ANALYTICS_MB: files above this size get external-memory wordsort and wordcount
+    if (megabytes := env_number("SERVER_EXTERNAL_ANALYTICS_MB")) is not None:
+        server.external_analytics_bytes = megabytes * MB
+    # SERVER_COMPRESSION_LEVEL overrides the codec's default level for compressed replies and downloads
+    if (level := env_number("SERVER_COMPRESSION_LEVEL", minimum=None)) is not None:
+        server.compression_level = level
+    # SERVER_ANALYTICS_PROCESSES sizes the analytics process pool (0: compute analytics in the connection's thread)
+    if (processes := env_number("SERVER_ANALYTICS_PROCESSES")) is not None:
+        server.analytics_processes = processes
+    # SERVER_PARALLEL_ANALYTICS_MB: files at least this large are analyzed on several processes at once
+    if (megabytes := env_number("SERVER_PARALLEL_ANALYTICS_MB")) is not None:
+        server.parallel_analytics_bytes = megabytes * MB
+    # SERVER_ANALYTICS_LIMITS, e.g. "wordsort=1,split=1": most commands of each kind computed at once
+    for limit in filter(None, os.getenv("SERVER_ANALYTICS_LIMITS", "").split(",")):
+        command, _, value = limit.partition("=")
+        value = env_number(f"SERVER_ANALYTICS_LIMITS {command.strip()}", minimum=1, value=value.strip())
+        if value is not None:
+            server.analytics_limits[command.strip()] = value
     server.start()
 
 
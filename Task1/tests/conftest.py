@@ -0,0 +1,69 @@
+"""
+The tests import server.py and client.py as modules, the way the benchmarks do. Neither starts anything on import.
+"""
+import random
+import socket
+import sys
+from pathlib import Path
+
+import pytest
+
+TASK_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(TASK_DIR / "server"))
+sys.path.insert(0, str(TASK_DIR / "client"))
+
+import client  # noqa: E402
+import server  # noqa: E402
+
+# EOF token of the sessions connect() makes
+EOF_TOKEN = "<TestToken>"
+
+# Words for random_text(): punctuation to strip, non-ASCII letters whose case changes, and tokens that are nothing
+# but punctuation
+WORDS = (
+    "the", "The", "THE", "fox,", "(fox)", "dog.", "'quoted'", "...", "--", "naïve", "NAÏVE", "Straße", "İstanbul",
+    "über-long-" * 40, "x", "a1", "日本語", "ÉCOLE!",
+)
+# Separators for random_text(): ASCII whitespace, and Unicode whitespace that only str.split() knows
+SEPARATORS = (" ", " ", " ", "\n", "\t", "  \r\n", "\u00a0", "\u2003", "\x1c", "\u3000")
+
+
+def original_words(text) -> list[str]:
+    """The original handlers' tokenization of a whole text: lowercased, split on whitespace, punctuation stripped."""
+    return [word.strip(server.WORD_PUNCTUATION) for word in text.lower().split()]
+
+
+@pytest.fixture
+def random_text():
+    """Makes random_text(seed, words) -> str: that many words from WORDS, a third of them numbered so that there are
+    many distinct words, joined by SEPARATORS."""
+    def make(seed, words):
+        rng = random.Random(seed)
+        return "".join(
+            rng.choice(WORDS) + (str(rng.randrange(1000)) if rng.random() < 1 / 3 else "") + rng.choice(SEPARATORS)
+            for _ in range(words)
+        )
+    return make
+
+
+@pytest.fixture
+def connect(tmp_path, monkeypatch):
+    """Makes connect(*features) -> (session, client): a Session of a Server serving tmp_path, joined to a Client by a
+    socket pair, both using the given features ("fast", "v2") as if they had been negotiated."""
+    monkeypatch.chdir(tmp_path)
+    server_obj = server.Server("127.0.0.1", 0)
+    sockets = []
+
+    def make(*features):
+        server_end, client_end = socket.socketpair()
+        sockets.extend((server_end, client_end))
+        session = server.Session(server_obj, server_end, "test", EOF_TOKEN)
+        peer = client.Client("127.0.0.1", 0, features=list(features))
+        peer.client_socket, peer.eof_token = client_end, EOF_TOKEN
+        for end in (session, peer):
+            end.fast = "fast" in features
+            end.framing = "v2" if "v2" in features else "token"
+        return session, peer
+    yield make
+    for end in sockets:
+        end.close()
@@ -0,0 +1,103 @@
+"""TokenBucket bandwidth limits: the long-run rate, the burst allowance, and fair sharing between transfers."""
+import threading
+import time
+
+import pytest
+
+import server
+
+
+class Clock:
+    """Stands in for the time module in server.py: sleep() moves monotonic() on instead of waiting."""
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server, "time", clock)
+    return clock
+
+
+def test_burst_passes_at_once(clock):
+    bucket = server.TokenBucket(1000, burst=5000)
+    for _ in range(5):
+        bucket.take(1000)
+    assert clock.slept == 0
+    bucket.take(500)
+    assert clock.slept == pytest.approx(0.5)
+
+
+@pytest.mark.parametrize("rate, chunk", [(1000, 100), (1024 * 1024, 64 * 1024), (8 * 1024 * 1024, 1024 * 1024)])
+def test_rate(clock, rate, chunk):
+    bucket = server.TokenBucket(rate, burst=chunk)
+    total = 50 * chunk
+    for _ in range(total // chunk):
+        bucket.take(chunk)
+    # Everything but the first burst is paid for at the rate
+    assert clock.slept == pytest.approx((total - chunk) / rate)
+
+
+def test_idle_time_refills_only_up_to_the_burst(clock):
+    bucket = server.TokenBucket(1000, burst=2000)
+    bucket.take(2000)
+    clock.now += 3600
+    bucket.take(2000)
+    assert clock.slept == 0
+    bucket.take(1000)
+    assert clock.slept == pytest.approx(1.0)
+
+
+def test_concurrent_transfers_share_the_rate():
+    """Two transfers taking a chunk at a time through one bucket get about half the rate each."""
+    rate, chunk = 4 * 1024 * 1024, 64 * 1024
+    bucket = server.TokenBucket(rate, burst=chunk)
+    taken = [0, 0]
+    stop = threading.Event()
+
+    def transfer(i):
+        while not stop.is_set():
+            bucket.take(chunk)
+            taken[i] += chunk
+    threads = [threading.Thread(target=transfer, args=(i,)) for i in range(2)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    assert sum(taken) <= chunk + rate * elapsed + 2 * chunk
+    assert sum(taken) >= rate * 0.5 * 0.7
+    assert min(taken) >= max(taken) * 0.6
+
+
+def test_bandwidth_limits(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server_obj = server.Server("127.0.0.1", 0)
+    assert server_obj.bandwidth_limits(None) == ([], None)
+    server_obj.session_bandwidth = 1000
+    buckets, session_bucket = server_obj.bandwidth_limits(None)
+    assert buckets == [session_bucket] and session_bucket.rate == 1000
+    # A session keeps its bucket, and gets a new one when the limit changes
+    assert server_obj.bandwidth_limits(session_bucket)[1] is session_bucket
+    server_obj.session_bandwidth = 2000
+    assert server_obj.bandwidth_limits(session_bucket)[1].rate == 2000
+    # The server-wide bucket is shared by every session
+    server_obj.total_bandwidth = 5000
+    first, _ = server_obj.bandwidth_limits(None)
+    second, _ = server_obj.bandwidth_limits(None)
+    assert first[1] is second[1] and first[1].rate == 5000 and first[0] is not second[0]
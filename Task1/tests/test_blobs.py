@@ -0,0 +1,110 @@
+"""The content-addressed BlobStore: uploads with the same bytes share one blob, blobs go when their last link does,
+and ulhash links a file to a stored blob instead of uploading it again."""
+import hashlib
+import os
+
+import pytest
+
+import server
+from conftest import EOF_TOKEN
+
+DATA = b"the same bytes in every upload\n" * 100
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+@pytest.fixture
+def blobs(tmp_path):
+    return server.BlobStore(str(tmp_path / server.BLOB_DIR_NAME))
+
+
+def upload(blobs, tmp_path, name, data=DATA, digest=DIGEST):
+    """Commits data as a finished upload to tmp_path/name, the way the upload handlers do."""
+    temp_path = tmp_path / f".{os.path.basename(name)}.part{server.UPLOAD_TEMP_SUFFIX}"
+    temp_path.write_bytes(data)
+    blobs.commit(str(temp_path), str(tmp_path / name), digest)
+    assert not temp_path.exists()
+
+
+def blob_files(blobs) -> list[str]:
+    return sorted(name for _, _, names in os.walk(blobs.directory) for name in names)
+
+
+def test_same_bytes_are_stored_once(tmp_path, blobs):
+    (tmp_path / "sub").mkdir()
+    upload(blobs, tmp_path, "a.bin")
+    upload(blobs, tmp_path, "sub/b.bin")
+    upload(blobs, tmp_path, "c.bin", digest=None)
+    assert blob_files(blobs) == [DIGEST]
+    blob = os.stat(blobs.path(DIGEST))
+    assert blob.st_nlink == 4
+    for name in ("a.bin", "sub/b.bin", "c.bin"):
+        assert (tmp_path / name).read_bytes() == DATA
+        assert os.stat(tmp_path / name).st_ino == blob.st_ino
+
+
+def test_upload_over_the_same_bytes(tmp_path, blobs):
+    upload(blobs, tmp_path, "a.bin")
+    upload(blobs, tmp_path, "a.bin")
+    assert sorted(os.listdir(tmp_path)) == [server.BLOB_DIR_NAME, "a.bin"]
+    assert os.stat(blobs.path(DIGEST)).st_nlink == 2
+
+
+def test_blob_is_deleted_with_its_last_link(tmp_path, blobs):
+    upload(blobs, tmp_path, "a.bin")
+    upload(blobs, tmp_path, "b.bin")
+    other = b"other bytes"
+    upload(blobs, tmp_path, "a.bin", other, hashlib.sha256(other).hexdigest())
+    assert (tmp_path / "a.bin").read_bytes() == other
+    assert len(blob_files(blobs)) == 2
+    inodes = blobs.linked_inodes(str(tmp_path / "b.bin"))
+    os.remove(tmp_path / "b.bin")
+    blobs.release(inodes)
+    assert blob_files(blobs) == [hashlib.sha256(other).hexdigest()]
+
+
+def test_unlinked_blobs_are_dropped_on_start(tmp_path, blobs):
+    upload(blobs, tmp_path, "a.bin")
+    # As if the server stopped between removing the last link and the blob
+    os.remove(tmp_path / "a.bin")
+    restarted = server.BlobStore(blobs.directory)
+    restarted.release([])
+    assert blob_files(restarted) == []
+
+
+def ulhash(session, peer, digest, size, name) -> str:
+    peer._send_command(f"ulhash {digest} {size} {name}", peer.client_socket, EOF_TOKEN)
+    session.execute(session.read_frame())
+    return peer._receive_reply(peer.client_socket, EOF_TOKEN)
+
+
+def test_ulhash_links_a_stored_blob(tmp_path, connect):
+    session, peer = connect("fast", "v2")
+    upload(session.server_obj.blobs, tmp_path, "a.bin")
+    assert ulhash(session, peer, DIGEST, len(DATA), "copy.bin") == "linked"
+    assert (tmp_path / "copy.bin").read_bytes() == DATA
+    assert os.stat(tmp_path / "copy.bin").st_ino == os.stat(tmp_path / "a.bin").st_ino
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(server.UPLOAD_TEMP_SUFFIX)]
+
+
+@pytest.mark.parametrize("digest, size", [
+    (hashlib.sha256(b"never uploaded").hexdigest(), len(DATA)),
+    (DIGEST, len(DATA) + 1),
+    ("../" + DIGEST[3:], len(DATA)),
+    ("z" * 64, len(DATA)),
+], ids=["unknown digest", "wrong size", "path in digest", "invalid digest"])
+def test_ulhash_missing(tmp_path, connect, digest, size):
+    session, peer = connect("fast", "v2")
+    upload(session.server_obj.blobs, tmp_path, "a.bin")
+    assert ulhash(session, peer, digest, size, "copy.bin") == "missing"
+    assert not (tmp_path / "copy.bin").exists()
+
+
+def test_rm_releases_the_blob(tmp_path, connect):
+    session, peer = connect("fast", "v2")
+    blobs = session.server_obj.blobs
+    upload(blobs, tmp_path, "a.bin")
+    assert ulhash(session, peer, DIGEST, len(DATA), "b.bin") == "linked"
+    session.server_obj.handle_rm(str(tmp_path), "a.bin")
+    assert blob_files(blobs) == [DIGEST]
+    session.server_obj.handle_rm(str(tmp_path), "b.bin")
+    assert blob_files(blobs) == []
@@ -0,0 +1,109 @@
+"""Compressed replies and data frames: every codec round-trips between server.py and client.py, and data that does
+not shrink is sent raw instead."""
+import io
+import random
+import socket
+import threading
+
+import pytest
+
+import client
+import server
+from conftest import EOF_TOKEN
+
+TEXT = ("the quick brown fox jumps over the lazy dog\n" * 2000).encode('utf-8')
+NOISE = random.Random(8).randbytes(20_000)
+
+
+@pytest.fixture(params=sorted(server.CODECS))
+def codec(request):
+    return request.param
+
+
+@pytest.mark.parametrize("data", [b"", b"x", TEXT, NOISE], ids=["empty", "byte", "text", "noise"])
+def test_block_round_trip(codec, data):
+    for compress, decompress in ((server.compress_block, client.decompress_block),
+                                 (client.compress_block, server.decompress_block)):
+        stored = compress(codec, data)
+        assert decompress(codec, stored) == data
+        if data:
+            assert decompress(codec, stored, len(data)) == data
+
+
+def test_levels(codec):
+    for level in (1, 9):
+        assert server.decompress_block(codec, server.compress_block(codec, TEXT, level), len(TEXT)) == TEXT
+
+
+def test_block_larger_than_announced_is_refused(codec):
+    """A block is never inflated past its announced size (no decompression bombs)."""
+    stored = server.compress_block(codec, TEXT)
+    with pytest.raises(ValueError):
+        server.decompress_block(codec, stored, len(TEXT) - 1)
+    with pytest.raises(ValueError):
+        client.decompress_block(codec, stored, len(TEXT) - 1)
+
+
+@pytest.mark.parametrize("payload, compressed", [(TEXT, True), (NOISE, False), (b"short reply", False)],
+                         ids=["text", "noise", "short"])
+def test_reply_is_sent_raw_unless_it_shrinks(connect, codec, payload, compressed):
+    session, peer = connect("fast", "v2")
+    session.codec = peer.codec = codec
+    session._send_frame(server.OP_REPLY, payload)
+    header = peer.client_socket.recv(server.FRAME_HEADER.size, socket.MSG_PEEK)
+    _, flags, length = server.FRAME_HEADER.unpack(header)
+    assert bool(flags & server.FLAG_COMPRESSED) == compressed
+    assert (length < len(payload)) == compressed
+    assert peer._receive_frame(peer.client_socket) == (server.OP_REPLY, payload)
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    """Blocks small enough that one upload mixes compressed blocks and raw ones."""
+    monkeypatch.setattr(server, "TRANSFER_CHUNK_SIZE", 8192)
+    monkeypatch.setattr(client, "TRANSFER_CHUNK_SIZE", 8192)
+
+
+def test_upload_blocks(tmp_path, connect, codec, small_blocks):
+    session, peer = connect("fast", "v2")
+    session.codec = peer.codec = codec
+    data = TEXT[:30_000] + NOISE + TEXT[:5000]
+    path = tmp_path / "upload.bin"
+    path.write_bytes(data)
+    with open(path, 'rb') as f:
+        assert peer._compresses(f, 0, len(data))
+        sender = threading.Thread(target=peer._send_compressed, args=(peer.client_socket, f, 0, len(data)))
+        sender.start()
+        assert session.read_size_header() == len(data)
+        received = io.BytesIO()
+        server.Server._recv_into_file(session.server_obj, session, received, len(data))
+        sender.join()
+    assert received.getvalue() == data
+    assert session.bytes_in < len(data)
+
+
+def test_download_blocks(tmp_path, connect, codec, small_blocks):
+    session, peer = connect("fast", "v2")
+    session.codec = peer.codec = codec
+    data = NOISE + TEXT[:30_000]
+    path = tmp_path / "download.bin"
+    path.write_bytes(data)
+    with open(path, 'rb') as f:
+        assert session.compresses(f, 0, len(data))
+        sender = threading.Thread(target=session.send_compressed, args=(f, 0, len(data)))
+        sender.start()
+        assert peer._receive_size_header(peer.client_socket, EOF_TOKEN) == len(data)
+        received = io.BytesIO()
+        peer._recv_to_file(peer.client_socket, received, len(data))
+        sender.join()
+    assert received.getvalue() == data
+
+
+def test_incompressible_file_takes_the_raw_path(tmp_path, connect, codec):
+    session, peer = connect("fast", "v2")
+    session.codec = peer.codec = codec
+    path = tmp_path / "noise.bin"
+    path.write_bytes(NOISE)
+    with open(path, 'rb') as f:
+        assert not peer._compresses(f, 0, len(NOISE))
+        assert not session.compresses(f, 0, len(NOISE))
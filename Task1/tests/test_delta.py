@@ -0,0 +1,135 @@
+"""uldelta round trips: the server's block_signatures(), the client's delta_instructions() and the server's
+apply_delta() rebuild the new file exactly, whatever was inserted, deleted or changed."""
+import hashlib
+import io
+import random
+
+import pytest
+
+import client
+import server
+
+
+def signatures(basis, block_size) -> list[tuple[int, bytes]]:
+    """The server's signatures of basis, as the client parses them."""
+    records = b"".join(server.block_signatures(io.BytesIO(basis), block_size))
+    return list(server.DELTA_SIGNATURE.iter_unpack(records))
+
+
+def delta_stream(data, block_size, sums, basis_size) -> bytes:
+    """The uldelta records the client sends for data (see Client._delta_ul())."""
+    stream = bytearray()
+    for op, start, end in client.delta_instructions(data, block_size, sums, basis_size):
+        if op == "copy":
+            stream += client.DELTA_OP.pack(client.DELTA_COPY, start, end)
+            continue
+        for offset in range(start, end, client.TRANSFER_CHUNK_SIZE):
+            piece = data[offset:min(end, offset + client.TRANSFER_CHUNK_SIZE)]
+            stream += client.DELTA_OP.pack(client.DELTA_LITERAL, len(piece), 0) + piece
+    stream += client.DELTA_OP.pack(client.DELTA_END, len(data), 0) + hashlib.sha256(data).digest()
+    return bytes(stream)
+
+
+def rebuild(tmp_path, basis, stream, block_size):
+    """apply_delta() over stream against a file holding basis. Returns (new file, literal bytes, copied bytes)."""
+    basis_path = tmp_path / "basis"
+    basis_path.write_bytes(basis)
+    out = io.BytesIO()
+    with open(basis_path, 'rb') as f:
+        literal, copied = server.apply_delta(
+            server.ChunkReader(iter([stream])), f, block_size, out, hashlib.sha256()
+        )
+    return out.getvalue(), literal, copied
+
+
+def round_trip(tmp_path, basis, data):
+    block_size = server.delta_block_size(len(basis))
+    stream = delta_stream(data, block_size, signatures(basis, block_size), len(basis))
+    rebuilt, literal, copied = rebuild(tmp_path, basis, stream, block_size)
+    assert rebuilt == data
+    assert literal + copied == len(data)
+    return literal
+
+
+@pytest.fixture(params=[client.DELTA_ROLL_LIMIT, 4096])
+def roll_limit(request, monkeypatch):
+    """A small roll limit makes the client step a block at a time through unmatched data sooner (see
+    client.block_matches())."""
+    monkeypatch.setattr(client, "DELTA_ROLL_LIMIT", request.param)
+    return request.param
+
+
+BASIS = random.Random(25).randbytes(300_000 + 123)
+BLOCK = server.delta_block_size(len(BASIS))
+
+
+# (edit, new file, most literal bytes it may cost: the changed bytes plus the blocks around them)
+EDITS = [
+    ("unchanged", BASIS, 0),
+    ("insert at start", b"new header" + BASIS, 10 + BLOCK),
+    ("insert in the middle", BASIS[:150_000] + b"x" * 5000 + BASIS[150_000:], 5000 + 2 * BLOCK),
+    ("append", BASIS + b"trailer", 7 + 2 * BLOCK),
+    ("delete at start", BASIS[1000:], BLOCK),
+    ("delete in the middle", BASIS[:100_000] + BASIS[100_777:], 2 * BLOCK),
+    ("truncate", BASIS[:200_001], BLOCK),
+    ("change in place", BASIS[:50_000] + b"\0" * 10 + BASIS[50_010:], 2 * BLOCK),
+    ("move blocks", BASIS[200_000:] + BASIS[:200_000], 3 * BLOCK),
+    ("several edits", b"a" + BASIS[:70_000] + BASIS[71_000:250_000] + b"b" * 3000 + BASIS[250_000:299_000],
+     3000 + 6 * BLOCK),
+]
+
+
+@pytest.mark.parametrize("name, data, most_literal", EDITS, ids=[edit[0] for edit in EDITS])
+def test_edits_send_little_literal_data(tmp_path, name, data, most_literal):
+    assert round_trip(tmp_path, BASIS, data) <= most_literal
+
+
+@pytest.mark.parametrize("name, data, most_literal", EDITS, ids=[edit[0] for edit in EDITS])
+def test_edits_past_the_roll_limit(tmp_path, monkeypatch, name, data, most_literal):
+    """Past DELTA_ROLL_LIMIT unmatched bytes the client steps a block at a time: shifted blocks may be sent as
+    literal data from there on, but the file is still rebuilt exactly and blocks changed in place still match."""
+    monkeypatch.setattr(client, "DELTA_ROLL_LIMIT", 4096)
+    literal = round_trip(tmp_path, BASIS, data)
+    if name in ("unchanged", "truncate", "change in place"):
+        assert literal <= most_literal
+
+
+@pytest.mark.parametrize("basis, data", [
+    (b"", b""),
+    (b"", b"all new"),
+    (b"old contents", b""),
+    (b"short", b"short"),
+    (b"short", b"shorter"),
+    (BASIS, random.Random(26).randbytes(100_000)),
+])
+def test_edge_cases(tmp_path, roll_limit, basis, data):
+    round_trip(tmp_path, basis, data)
+
+
+def test_random_edits(tmp_path, roll_limit):
+    rng = random.Random(roll_limit)
+    basis = rng.randbytes(50_000)
+    for _ in range(30):
+        data = bytearray(basis)
+        for _ in range(rng.randrange(1, 5)):
+            position = rng.randrange(len(data) + 1)
+            if rng.random() < 0.5:
+                data[position:position] = rng.randbytes(rng.randrange(1, 3000))
+            else:
+                del data[position:position + rng.randrange(1, 3000)]
+        round_trip(tmp_path, basis, bytes(data))
+
+
+def test_bad_checksum_is_refused(tmp_path):
+    data = BASIS[:1000] + b"edit" + BASIS[1000:]
+    stream = bytearray(delta_stream(data, BLOCK, signatures(BASIS, BLOCK), len(BASIS)))
+    stream[-1] ^= 1
+    with pytest.raises(ValueError):
+        rebuild(tmp_path, BASIS, bytes(stream), BLOCK)
+
+
+def test_copy_outside_the_basis_is_refused(tmp_path):
+    blocks = -(-len(BASIS) // BLOCK)
+    stream = server.DELTA_OP.pack(server.DELTA_COPY, blocks, 1)
+    with pytest.raises(ValueError):
+        rebuild(tmp_path, BASIS, stream, BLOCK)
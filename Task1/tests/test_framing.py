@@ -0,0 +1,95 @@
+"""Commands and replies between Client and Session, with token framing and with the length-prefixed v2 frames."""
+import threading
+import time
+
+import pytest
+
+import client
+import server
+from conftest import EOF_TOKEN
+
+FRAMINGS = [("fast",), ("v2",), ("fast", "v2")]
+
+
+@pytest.mark.parametrize("features", FRAMINGS)
+def test_commands(connect, features):
+    session, peer = connect(*features)
+    commands = ["ls", "wordcount naïve.txt", "search a b c.txt"]
+    for command in commands:
+        peer._send_command(command, peer.client_socket, EOF_TOKEN)
+    assert [session.read_frame().decode('utf-8') for _ in commands] == commands
+
+
+@pytest.mark.parametrize("features", FRAMINGS)
+def test_replies(connect, features):
+    session, peer = connect(*features)
+    session.send_message("12 words in naïve.txt")
+    session.send_message("")
+    session.send_error("Error counting words in x.txt: no such file")
+    assert peer._receive_reply(peer.client_socket, EOF_TOKEN) == "12 words in naïve.txt"
+    assert peer._receive_reply(peer.client_socket, EOF_TOKEN) == ""
+    with pytest.raises(client.ServerError, match="no such file"):
+        peer._receive_reply(peer.client_socket, EOF_TOKEN)
+
+
+def test_frame_arriving_a_byte_at_a_time(connect):
+    """has_frame() is False until the whole frame is buffered, and read_available() never waits for more."""
+    session, peer = connect("v2")
+    payload = "wordcount about.txt".encode('utf-8')
+    frame = server.FRAME_HEADER.pack(server.OP_COMMAND, 0, len(payload)) + payload
+    for byte in frame:
+        assert not session.has_frame()
+        assert session.read_available()
+        peer.client_socket.send(bytes([byte]))
+        time.sleep(0.001)
+    while session.read_available() and not session.has_frame():
+        pass
+    assert session.read_frame() == payload
+
+
+def test_token_split_across_reads(connect):
+    session, peer = connect("fast")
+    wire = ("wordsort a.txt" + EOF_TOKEN + "ls" + EOF_TOKEN).encode('utf-8')
+    for i in range(0, len(wire), 3):
+        peer.client_socket.send(wire[i:i + 3])
+        time.sleep(0.001)
+        session.read_available()
+    assert session.read_frame() == b"wordsort a.txt"
+    assert session.has_frame()
+    assert session.read_frame() == b"ls"
+
+
+def test_compressed_reply(connect):
+    session, peer = connect("fast", "v2")
+    session.codec = peer.codec = "zlib"
+    message = "the quick brown fox\n" * 1000
+    session.send_message(message)
+    assert session.bytes_out < len(message) // 10
+    assert peer._receive_reply(peer.client_socket, EOF_TOKEN) == message
+
+
+def test_slow_reply(connect):
+    """A v2 reply whose parts arrive further apart than the socket timeout is still read whole."""
+    session, peer = connect("v2")
+    peer.client_socket.settimeout(0.05)
+    payload = "a slow reply".encode('utf-8')
+    frame = server.FRAME_HEADER.pack(server.OP_REPLY, 0, len(payload)) + payload
+
+    def trickle():
+        for part in (frame[:3], frame[3:server.FRAME_HEADER.size], frame[server.FRAME_HEADER.size:]):
+            time.sleep(0.2)
+            session.service_socket.sendall(part)
+    sender = threading.Thread(target=trickle)
+    sender.start()
+    try:
+        assert peer._receive_reply(peer.client_socket, EOF_TOKEN) == "a slow reply"
+    finally:
+        sender.join()
+
+
+def test_closed_mid_frame(connect):
+    session, peer = connect("v2")
+    session.service_socket.sendall(server.FRAME_HEADER.pack(server.OP_REPLY, 0, 100) + b"short")
+    session.service_socket.close()
+    with pytest.raises(ConnectionError):
+        peer._receive_reply(peer.client_socket, EOF_TOKEN)
@@ -0,0 +1,71 @@
+"""Parallel analytics over byte ranges (text_ranges() and the per-range counts and runs) against the serial
+tokenization of the whole file."""
+from collections import Counter
+
+import pytest
+
+import server
+from conftest import original_words
+
+
+@pytest.fixture
+def text_file(tmp_path, random_text):
+    text = random_text(16, 5000)
+    path = tmp_path / "big.txt"
+    path.write_bytes(text.encode('utf-8'))
+    return str(path), text
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    """Small enough that range boundaries search across several reads and the runs spill and merge in passes."""
+    monkeypatch.setattr(server, "TEXT_RANGE_SCAN_BYTES", 16)
+    monkeypatch.setattr(server, "SCAN_WINDOW_BYTES", 4096)
+    monkeypatch.setattr(server, "EXTERNAL_RUN_BYTES", 16 * 1024)
+    monkeypatch.setattr(server, "EXTERNAL_MERGE_FAN_IN", 2)
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 4, 8, 64])
+def test_ranges_cover_the_file_at_whitespace(text_file, count):
+    path, _ = text_file
+    with open(path, 'rb') as f:
+        data = f.read()
+    ranges = server.text_ranges(path, count)
+    assert 1 <= len(ranges) <= count
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+        assert data[start:start + 1] in b" \t\n\r\x0b\x0c"
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 4, 8, 64])
+def test_range_frequencies_merge_to_serial_counts(text_file, count):
+    path, text = text_file
+    merged = Counter()
+    for start, end in server.text_ranges(path, count):
+        merged.update(server.range_frequencies(path, start, end))
+    assert merged == Counter(original_words(text))
+
+
+@pytest.mark.parametrize("count", [1, 2, 4, 8])
+def test_range_runs_merge_to_serial_wordcount_and_wordsort(tmp_path, text_file, count):
+    path, text = text_file
+    work_dir = tmp_path / "runs"
+    work_dir.mkdir()
+    runs = [run for start, end in server.text_ranges(path, count)
+            for run in server.range_runs(path, start, end, str(work_dir))]
+    assert len(runs) > server.EXTERNAL_MERGE_FAN_IN
+    expected = sorted(set(original_words(text)))
+    assert server.merged_wordcount(runs, str(work_dir)) == len(expected)
+    size = server.merged_wordsort(runs, str(work_dir))
+    reply = (work_dir / "reply").read_bytes()
+    assert size == len(reply)
+    assert reply.decode('utf-8') == "\n".join(expected)
+
+
+def test_file_without_whitespace(tmp_path):
+    """One long token cannot be split: a single range."""
+    path = tmp_path / "token.txt"
+    path.write_bytes(b"x" * 1000)
+    assert server.text_ranges(str(path), 8) == [(0, 1000)]
+    assert server.range_frequencies(str(path), 0, 1000) == {"x" * 1000: 1}
@@ -0,0 +1,95 @@
+"""Cached wordcount, wordsort and search replies: repeated commands are answered from the ResponseCache, and a
+changed file gets a new reply whether the server changed it or something else did."""
+import os
+
+import pytest
+
+import server
+from conftest import EOF_TOKEN
+
+
+@pytest.fixture
+def run(connect):
+    """Makes run(command) -> reply, on one session whose analytics run in the session's thread."""
+    session, peer = connect("fast", "v2")
+    session.server_obj.analytics_processes = 0
+
+    def command(text):
+        peer._send_command(text, peer.client_socket, EOF_TOKEN)
+        session.execute(session.read_frame())
+        return peer._receive_reply(peer.client_socket, EOF_TOKEN)
+    command.cache = session.server_obj.response_cache
+    command.server_obj = session.server_obj
+    return command
+
+
+def rewrite(path, text, keep_stat=False):
+    """Writes text to path; with keep_stat, puts the size and mtime back so that the fingerprint does not change."""
+    before = os.stat(path)
+    path.write_text(text)
+    if keep_stat:
+        assert os.path.getsize(path) == before.st_size
+        os.utime(path, ns=(before.st_atime_ns, before.st_mtime_ns))
+
+
+def test_repeated_command_is_a_hit(tmp_path, run):
+    (tmp_path / "a.txt").write_text("one two two three")
+    assert run("wordcount a.txt") == "3"
+    assert run("wordcount a.txt") == "3"
+    assert run.cache.counters()["hits"] == 1
+
+
+def test_file_changed_by_someone_else(tmp_path, run):
+    """The stat() fingerprint changes, and the reply under the old one is dropped rather than left to LRU."""
+    path = tmp_path / "a.txt"
+    path.write_text("one two")
+    assert run("wordsort a.txt") == "one\ntwo"
+    rewrite(path, "three four five")
+    assert run("wordsort a.txt") == "five\nfour\nthree"
+    assert run.cache.counters()["entries"] == 1
+    for i in range(5):
+        rewrite(path, "word " * (i + 2))
+        assert run("wordcount a.txt") == "1"
+    assert run.cache.counters()["entries"] == 2
+
+
+def test_file_changed_by_the_server(tmp_path, run):
+    """_file_changed() drops the reply even when the change keeps the size and mtime."""
+    path = tmp_path / "a.txt"
+    path.write_text("cat dog")
+    first = run("wordsort a.txt")
+    rewrite(path, "eel fox", keep_stat=True)
+    assert run("wordsort a.txt") == first
+    run.server_obj._file_changed(str(path))
+    assert run("wordsort a.txt") == "eel\nfox"
+
+
+def test_glob_search_is_dropped_with_a_file_below_its_directory(tmp_path, run):
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "a.txt").write_text("fox fox")
+    (tmp_path / "docs" / "b.txt").write_text("fox dog")
+    first = run("search docs/*.txt fox")
+    rewrite(tmp_path / "docs" / "b.txt", "fox fox", keep_stat=True)
+    assert run("search docs/*.txt fox") == first
+    run.server_obj._file_changed(str(tmp_path / "docs" / "b.txt"))
+    assert run("search docs/*.txt fox") != first
+
+
+def test_stale_reply_is_not_cached():
+    """A reply computed across an invalidation may be stale: it is sent but not cached."""
+    cache = server.ResponseCache(1024)
+    generation = cache.generation
+    cache.invalidate("/served/a.txt")
+    cache.put(("wordcount", "/served/a.txt", (), 1), b"3", generation)
+    assert cache.get(("wordcount", "/served/a.txt", (), 1)) is None
+
+
+def test_budget():
+    cache = server.ResponseCache(1000)
+    for i in range(20):
+        cache.put(("wordcount", f"/served/{i}.txt", (), 1), b"x" * 100, cache.generation)
+    counters = cache.counters()
+    assert counters["bytes"] <= 1000 and counters["entries"] == 10 and counters["evictions"] == 10
+    # Larger than a RESPONSE_CACHE_ENTRY_SHARE of the budget: sent, never cached
+    cache.put(("wordsort", "/served/big.txt", (), 1), b"x" * 300, cache.generation)
+    assert cache.get(("wordsort", "/served/big.txt", (), 1)) is None
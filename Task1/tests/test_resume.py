@@ -0,0 +1,107 @@
+"""Resumable uploads (ulstat/ulat): partial files kept across dropped connections, resumed from the bytes held, and
+checked against the file's SHA-256 before they are put in place."""
+import hashlib
+import os
+import random
+
+import pytest
+
+import client
+import server
+from conftest import EOF_TOKEN
+
+DATA = random.Random(6).randbytes(60_000)
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+def command(session, peer, text, payload=None) -> str:
+    """Runs one command on session and returns its reply (the listing that follows is not sent)."""
+    peer._send_command(text, peer.client_socket, EOF_TOKEN)
+    if payload is not None:
+        peer.client_socket.sendall(client.FRAME_HEADER.pack(client.OP_DATA, 0, len(payload)) + payload)
+    session.execute(session.read_frame())
+    return peer._receive_reply(peer.client_socket, EOF_TOKEN)
+
+
+def held(session, peer, digest=DIGEST) -> int:
+    return int(command(session, peer, f"ulstat {digest} f.bin"))
+
+
+def ulat(session, peer, offset, end, digest=DIGEST) -> int:
+    return int(command(session, peer, f"ulat {offset} {len(DATA)} {digest} f.bin", DATA[offset:end]))
+
+
+def partials(tmp_path) -> list[str]:
+    return [name for name in os.listdir(tmp_path) if name.endswith(server.UPLOAD_TEMP_SUFFIX)]
+
+
+def test_chunks(tmp_path, connect):
+    session, peer = connect("fast", "v2")
+    assert held(session, peer) == 0
+    for offset in range(0, len(DATA), 15_000):
+        assert ulat(session, peer, offset, offset + 15_000) == min(len(DATA), offset + 15_000)
+    assert (tmp_path / "f.bin").read_bytes() == DATA
+    assert partials(tmp_path) == []
+
+
+def test_resume_after_dropped_connection(tmp_path, connect):
+    session, peer = connect("fast", "v2")
+    peer._send_command(f"ulat 0 {len(DATA)} {DIGEST} f.bin", peer.client_socket, EOF_TOKEN)
+    peer.client_socket.sendall(client.FRAME_HEADER.pack(client.OP_DATA, 0, len(DATA)) + DATA[:25_000])
+    peer.client_socket.close()
+    try:
+        session.execute(session.read_frame())
+    except OSError:
+        pass
+    session, peer = connect("fast", "v2")
+    assert held(session, peer) == 25_000
+    assert ulat(session, peer, 25_000, len(DATA)) == len(DATA)
+    assert (tmp_path / "f.bin").read_bytes() == DATA
+    assert partials(tmp_path) == []
+
+
+@pytest.mark.parametrize("truncate_to", [0, 1, 9_999, 15_000])
+def test_resume_from_a_truncated_partial(tmp_path, connect, truncate_to):
+    """A partial that lost its tail (e.g. in a crash) is resumed from the bytes it still holds: the running hash of
+    the chunks received before does not cover them any more."""
+    session, peer = connect("fast", "v2")
+    assert ulat(session, peer, 0, 20_000) == 20_000
+    [partial] = partials(tmp_path)
+    os.truncate(tmp_path / partial, truncate_to)
+    assert held(session, peer) == truncate_to
+    assert ulat(session, peer, truncate_to, len(DATA)) == len(DATA)
+    assert (tmp_path / "f.bin").read_bytes() == DATA
+
+
+def test_resume_from_an_earlier_offset(tmp_path, connect):
+    session, peer = connect("fast", "v2")
+    assert ulat(session, peer, 0, 30_000) == 30_000
+    assert ulat(session, peer, 10_000, len(DATA)) == len(DATA)
+    assert (tmp_path / "f.bin").read_bytes() == DATA
+
+
+def test_offset_past_the_bytes_held(tmp_path, connect):
+    session, peer = connect("fast", "v2")
+    assert ulat(session, peer, 0, 10_000) == 10_000
+    with pytest.raises(client.ServerError, match="past the 10000 bytes held"):
+        ulat(session, peer, 20_000, len(DATA))
+    # The payload was consumed: the session still reads the next command
+    assert held(session, peer) == 10_000
+
+
+def test_digest_mismatch_is_rejected(tmp_path, connect):
+    session, peer = connect("fast", "v2")
+    wrong = hashlib.sha256(b"other contents").hexdigest()
+    assert ulat(session, peer, 0, 30_000, wrong) == 30_000
+    with pytest.raises(client.ServerError, match="do not match"):
+        ulat(session, peer, 30_000, len(DATA), wrong)
+    assert not (tmp_path / "f.bin").exists()
+    assert partials(tmp_path) == []
+    assert held(session, peer, wrong) == 0
+
+
+def test_invalid_digest(connect):
+    session, peer = connect("fast", "v2")
+    with pytest.raises(client.ServerError, match="Invalid SHA-256"):
+        ulat(session, peer, 0, 100, "not-a-digest")
+    assert held(session, peer) == 0
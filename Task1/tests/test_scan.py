@@ -0,0 +1,74 @@
+"""The mmap bytes-level scan (scan_windows(), scan_frequencies(), scan_words()) against the original handlers'
+tokenization of the decoded text."""
+from collections import Counter
+
+import pytest
+
+import server
+from conftest import original_words
+
+
+@pytest.fixture(params=[64, 1000, server.SCAN_WINDOW_BYTES])
+def window_bytes(request, monkeypatch):
+    """Small windows put window boundaries all over the file."""
+    monkeypatch.setattr(server, "SCAN_WINDOW_BYTES", request.param)
+    return request.param
+
+
+def scan(tmp_path, data, function, *args):
+    path = tmp_path / "scan.txt"
+    path.write_bytes(data)
+    with open(path, 'rb') as f:
+        return function(f, *args)
+
+
+def test_windows_split_at_whitespace(tmp_path, random_text, window_bytes):
+    data = random_text(17, 3000).encode('utf-8')
+    windows = scan(tmp_path, data, lambda f: list(server.scan_windows(f)))
+    assert b"".join(windows) == data
+    # Every window but the first starts at the whitespace that ended the one before, so no token is cut
+    for window in windows[1:]:
+        assert window[:1] in b" \t\n\r\x0b\x0c"
+    assert len(windows) > 1 or len(data) <= window_bytes
+
+
+def test_frequencies_match_the_original_tokenization(tmp_path, random_text, window_bytes):
+    text = random_text(17, 3000)
+    frequencies = scan(tmp_path, text.encode('utf-8'), server.scan_frequencies)
+    assert frequencies == Counter(original_words(text))
+
+
+def test_words_match_the_original_tokenization(tmp_path, random_text, window_bytes):
+    text = random_text(18, 3000)
+    words = scan(tmp_path, text.encode('utf-8'), lambda f: set(server.scan_words(f)))
+    assert words == set(original_words(text))
+
+
+def test_byte_range(tmp_path, random_text, window_bytes):
+    data = random_text(19, 2000).encode('utf-8')
+    start, end = data.index(b" ", 1000), data.index(b" ", 5000)
+    frequencies = scan(tmp_path, data, server.scan_frequencies, start, end)
+    assert frequencies == Counter(original_words(data[start:end].decode('utf-8')))
+
+
+def test_invalid_utf8_is_replaced(tmp_path, window_bytes):
+    """Bad bytes count as U+FFFD, as if the whole file had been decoded with errors='replace'."""
+    data = b"caf\xe9 CAF\xc3\xa9 \xff\xfe word. \xe2\x82 end\xc3 \x80x"
+    frequencies = scan(tmp_path, data, server.scan_frequencies)
+    assert frequencies == Counter(original_words(data.decode('utf-8', 'replace')))
+
+
+def test_empty_file(tmp_path):
+    assert scan(tmp_path, b"", server.scan_frequencies) == {}
+    assert scan(tmp_path, b"", lambda f: list(server.scan_words(f))) == []
+
+
+def test_looks_like_text(tmp_path):
+    path = tmp_path / "sniff"
+    path.write_bytes("naïve text ".encode('utf-8') * 2000)
+    assert server.looks_like_text(str(path))
+    path.write_bytes(b"\x89PNG\r\n\x1a\n\0\0\0\rIHDR")
+    assert not server.looks_like_text(str(path))
+    # A multi-byte character cut by the end of the sample is still text
+    path.write_bytes(b"a" * (server.TEXT_SNIFF_BYTES - 1) + "é".encode('utf-8'))
+    assert server.looks_like_text(str(path))
@@ -0,0 +1,83 @@
+"""split_stream() and split_file() against the original handle_split algorithm."""
+import io
+import random
+
+import pytest
+
+import server
+
+
+def original_splits(text, delimiters):
+    """The original handle_split: split the lowercased text by each delimiter in turn, dropping blank parts."""
+    splits = [text.lower()]
+    for split_word in delimiters:
+        new_splits = []
+        for segment in splits:
+            new_splits.extend(part for part in segment.split(split_word) if part.strip())
+        splits = new_splits
+    return splits
+
+
+def stream_splits(text, delimiters):
+    """The non-blank segments split_stream() yields for text."""
+    segments, pieces = [], []
+    for piece in server.split_stream(io.StringIO(text), delimiters):
+        if piece is None:
+            segments.append("".join(pieces))
+            pieces = []
+        else:
+            pieces.append(piece)
+    segments.append("".join(pieces))
+    return [segment for segment in segments if segment.strip()]
+
+
+@pytest.fixture(params=[3, 7, 64, server.SPLIT_CHUNK_CHARS])
+def chunk_chars(request, monkeypatch):
+    """Small read sizes put delimiters and cuts across chunk boundaries."""
+    monkeypatch.setattr(server, "SPLIT_CHUNK_CHARS", request.param)
+    return request.param
+
+
+@pytest.mark.parametrize("text, delimiters", [
+    ("The quick brown fox. The lazy dog.", ["the"]),
+    ("one, two; three, four", [",", ";"]),
+    ("aaaa", ["aa"]),
+    ("abcabcab", ["ab", "bc"]),
+    ("abcabcab", ["bc", "ab"]),
+    ("xaabaax", ["aba", "aa"]),
+    ("no delimiter here", ["zzz"]),
+    ("  \n  ", ["a"]),
+    ("Mixed CASE text", ["case", "CASE"]),
+])
+def test_examples(chunk_chars, text, delimiters):
+    assert stream_splits(text, delimiters) == original_splits(text, delimiters)
+
+
+def test_random(chunk_chars):
+    """Short alphabets make delimiters overlap each other and themselves."""
+    rng = random.Random(chunk_chars)
+    for _ in range(300):
+        text = "".join(rng.choice("aAb \n") for _ in range(rng.randrange(0, 80)))
+        delimiters = ["".join(rng.choice("ab ") for _ in range(rng.randrange(1, 4))).strip() or "a"
+                      for _ in range(rng.randrange(1, 4))]
+        assert stream_splits(text, delimiters) == original_splits(text, delimiters), (text, delimiters)
+
+
+def test_empty_delimiter():
+    with pytest.raises(ValueError):
+        list(server.split_stream(io.StringIO("text"), ["a", ""]))
+
+
+def test_split_file(tmp_path, chunk_chars):
+    text = "First part. STOP second part.\n\nSTOP STOP third, and last STOP\n"
+    path = tmp_path / "doc.txt"
+    path.write_text(text)
+    count, replaced = server.split_file(str(path), ["stop"])
+    expected = original_splits(text, ["stop"])
+    assert count == len(expected)
+    assert replaced == []
+    assert [(tmp_path / f"doc.txt_split_{i + 1}.txt").read_text() for i in range(count)] == expected
+    assert not (tmp_path / f"doc.txt_split_{count + 1}.txt").exists()
+    # No temp files are left behind
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["doc.txt"] + [f"doc.txt_split_{i + 1}.txt"
+                                                                        for i in range(count)]
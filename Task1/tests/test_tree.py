@@ -0,0 +1,160 @@
+"""uldir/dldir: directory trees round-trip as tar streams, and archive members that would land outside the target
+directory (absolute names, '..') are refused on both sides."""
+import io
+import os
+import tarfile
+import threading
+
+import pytest
+
+import client
+import server
+from conftest import EOF_TOKEN
+
+TREE = {
+    "a.txt": b"alpha\n",
+    "empty.bin": b"",
+    "sub": None,
+    "sub/b.bin": bytes(range(256)) * 300,
+    "sub/deeper": None,
+    "sub/deeper/c.txt": "naïve ünïcode\n".encode('utf-8'),
+    "sub/empty dir": None,
+}
+
+
+def make_tree(root, tree=TREE):
+    os.makedirs(root, exist_ok=True)
+    for name, data in tree.items():
+        path = os.path.join(root, name)
+        if data is None:
+            os.makedirs(path, exist_ok=True)
+        else:
+            with open(path, 'wb') as f:
+                f.write(data)
+
+
+def read_tree(root) -> dict:
+    """name -> bytes for files, None for directories, as in TREE."""
+    tree = {}
+    for parent, directories, names in os.walk(root):
+        relative = os.path.relpath(parent, root)
+        for name in directories:
+            tree[os.path.normpath(os.path.join(relative, name))] = None
+        for name in names:
+            with open(os.path.join(parent, name), 'rb') as f:
+                tree[os.path.normpath(os.path.join(relative, name))] = f.read()
+    return tree
+
+
+def archive(*members) -> bytes:
+    """A tar stream of (name, data) members."""
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w", format=tarfile.GNU_FORMAT) as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return stream.getvalue()
+
+
+@pytest.fixture
+def served(tmp_path, connect):
+    """(session, client) with the session in tmp_path/served and the client in tmp_path/local."""
+    session, peer = connect("fast", "v2")
+    for name in ("served", "local"):
+        (tmp_path / name).mkdir()
+    session.current_working_directory = str(tmp_path / "served")
+    os.chdir(tmp_path / "local")
+    return session, peer
+
+
+def run_with(session, action, *args):
+    """Runs the next command on session while action(*args) talks to it from another thread."""
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault("value", action(*args)))
+    thread.start()
+    session.execute(session.read_frame())
+    thread.join()
+    return result.get("value")
+
+
+@pytest.mark.parametrize("features", [("fast",), ("fast", "v2")])
+def test_uldir_round_trip(tmp_path, connect, features):
+    session, peer = connect(*features)
+    (tmp_path / "served").mkdir()
+    session.current_working_directory = str(tmp_path / "served")
+    make_tree(str(tmp_path / "tree"))
+    run_with(session, peer._send_tree, "uldir tree", peer.client_socket, EOF_TOKEN)
+    files = sum(data is not None for data in TREE.values())
+    size = sum(len(data) for data in TREE.values() if data is not None)
+    assert peer._receive_reply(peer.client_socket, EOF_TOKEN) == f"{files} {size}"
+    assert read_tree(tmp_path / "served" / "tree") == read_tree(tmp_path / "tree")
+
+
+def test_dldir_round_trip(tmp_path, served):
+    session, peer = served
+    make_tree(str(tmp_path / "served" / "tree"))
+    peer._send_command("dldir tree", peer.client_socket, EOF_TOKEN)
+    files, size = run_with(session, peer._receive_tree, "dldir tree", peer.client_socket, EOF_TOKEN)
+    assert (files, size) == (
+        sum(data is not None for data in TREE.values()), sum(len(data) for data in TREE.values() if data is not None)
+    )
+    assert read_tree(tmp_path / "local" / "tree") == read_tree(tmp_path / "served" / "tree")
+
+
+@pytest.mark.parametrize("name", [
+    "/etc/evil.txt", "../evil.txt", "sub/../../evil.txt", "sub\\..\\..\\evil.txt", "./../evil.txt",
+])
+def test_tree_path_refuses_names_outside_the_root(name):
+    for tree_path in (server.tree_path, client.tree_path):
+        with pytest.raises(ValueError):
+            tree_path("/served/tree", name)
+
+
+def test_tree_path():
+    for tree_path in (server.tree_path, client.tree_path):
+        assert tree_path("/served/tree", "a.txt") == "/served/tree/a.txt"
+        assert tree_path("/served/tree", "./sub//b.bin") == "/served/tree/sub/b.bin"
+        assert tree_path("/served/tree", "sub\\b.bin") == "/served/tree/sub/b.bin"
+        assert tree_path("/served/tree", "x..y") == "/served/tree/x..y"
+
+
+@pytest.mark.parametrize("name", [
+    server.BLOB_DIR_NAME + "/ab/cd", "sub/" + server.INDEX_DIR_NAME + "/search.sqlite", "f" + server.UPLOAD_TEMP_SUFFIX,
+])
+def test_server_refuses_its_own_names(name):
+    with pytest.raises(ValueError):
+        server.tree_path("/served/tree", name)
+
+
+@pytest.mark.parametrize("name", ["../evil.txt", "/evil.txt", "sub/../../evil.txt"])
+def test_uldir_refuses_members_outside_the_directory(tmp_path, served, name):
+    session, peer = served
+    data = archive(("good.txt", b"fine"), (name, b"evil"), ("later.txt", b"not reached"))
+    peer._send_command("uldir tree", peer.client_socket, EOF_TOKEN)
+    for offset in range(0, len(data), 1000):
+        peer._send_chunk(peer.client_socket, data[offset:offset + 1000], EOF_TOKEN)
+    peer._send_chunk(peer.client_socket, b"", EOF_TOKEN)
+    session.execute(session.read_frame())
+    with pytest.raises(client.ServerError, match="Invalid path in archive"):
+        peer._receive_reply(peer.client_socket, EOF_TOKEN)
+    assert read_tree(tmp_path / "served") == {"tree": None, "tree/good.txt": b"fine"}
+    assert not (tmp_path / "evil.txt").exists()
+    # The rest of the stream was consumed: the session still reads the next command
+    peer._send_command(f"ulstat {'0' * 64} x", peer.client_socket, EOF_TOKEN)
+    session.execute(session.read_frame())
+    assert peer._receive_reply(peer.client_socket, EOF_TOKEN) == "0"
+
+
+@pytest.mark.parametrize("name", ["../evil.txt", "sub/../../evil.txt"])
+def test_dldir_refuses_members_outside_the_directory(tmp_path, served, name):
+    """A client does not trust the server's archive either."""
+    session, peer = served
+    data = archive(("good.txt", b"fine"), (name, b"evil"))
+    session.send_chunk(data)
+    session.send_chunk(b"")
+    session.send_message("2 8")
+    with pytest.raises(ValueError, match="Invalid path in archive"):
+        peer._receive_tree("dldir tree", peer.client_socket, EOF_TOKEN)
+    assert read_tree(tmp_path / "local") == {"tree": None, "tree/good.txt": b"fine"}
+    assert not (tmp_path / "evil.txt").exists()